@@ -11,6 +11,7 @@ import multiprocessing
 import platform
 import signal
 import tempfile
+import time
 import uuid
 
 help_funs = """
@@ -34,29 +35,234 @@ def time_limit(seconds: float):
 """
 
 def _pack_test_cases(test_cases, timeout):
+    """
+    `timeout` is the time limit of every test case, or a list with one limit per test case. A test case that runs out
+    of memory fails and is counted in `final_memory_exceeded`.
+    """
+    timeouts = timeout if isinstance(timeout, list) else [timeout] * len(test_cases)
     blank_4 = ' ' * 4
     blank_8 = ' ' * 8
     blank_12 = ' ' * 12
-    result = f'def check():\n    pass_result = []\n'
+    result = f'def check():\n    pass_result = []\n    durations = []\n    memory_exceeded = 0\n'
     for idx, tc in enumerate(test_cases):
         multi_line_assertion = tc.strip().replace('\n', f'\n{blank_12}')
-        result += f'\n{blank_4}try:\n{blank_8}with time_limit({timeout}):\n{blank_12}{multi_line_assertion}\
-                    \n{blank_12}pass_result.append(True)\n{blank_4}except Exception as e:\n{blank_8}pass_result.append(False)\n'
-    result += '\n    return pass_result\n'
+        result += f'\n{blank_4}start = perf_counter()\n{blank_4}try:\n{blank_8}with time_limit({timeouts[idx]}):\n{blank_12}{multi_line_assertion}\
+                    \n{blank_12}pass_result.append(True)\n{blank_4}except MemoryError:\n{blank_8}pass_result.append(False)\
+                    \n{blank_8}memory_exceeded += 1\n{blank_4}except Exception as e:\n{blank_8}pass_result.append(False)\
+                    \n{blank_4}durations.append(perf_counter() - start)\n'
+    result += '\n    return pass_result, durations, memory_exceeded\n'
+    result += f'\nglobal final_result, final_durations, final_memory_exceeded\nfinal_result, final_durations, final_memory_exceeded = check()'
+    return result
+
+
+def _status_bytes(field):
+    """A kB field of /proc/self/status (VmRSS, VmHWM) in bytes, None without procfs"""
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith(field + ':'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+
+def _start_usage():
+    """
+    rusage and resident memory of the sandbox process at its start, `resource` has to be imported before
+    `reliability_guard` removes it. The forked sandbox inherits the resident memory of its parent, so the
+    high-water mark is reset (Linux) and the peak is reported as the growth over the memory at start.
+    """
+    import resource
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except OSError:
+        pass
+    start = resource.getrusage(resource.RUSAGE_SELF)
+    start_rss = _status_bytes('VmRSS')
+    return resource, (start, start_rss if start_rss is not None else _maxrss_bytes(start))
+
+
+def _maxrss_bytes(usage):
+    # ru_maxrss is in kilobytes on Linux, in bytes on macOS
+    return usage.ru_maxrss if platform.uname().system == 'Darwin' else usage.ru_maxrss * 1024
+
+
+def _usage_since(resource, start_usage):
+    start, start_rss = start_usage
+    end = resource.getrusage(resource.RUSAGE_SELF)
+    peak = _status_bytes('VmHWM')
+    peak = peak if peak is not None else _maxrss_bytes(end)
+    return dict(cpu_time=(end.ru_utime - start.ru_utime) + (end.ru_stime - start.ru_stime), peak_rss=max(peak - start_rss, 0))
+
+
+MEMORY_EXCEEDED = "memory limit exceeded"
+MEMORY_ERROR = "error: MemoryError"
+
+
+def exceeded_memory(result):
+    """Whether a sandbox run hit its memory limit, as a whole or in some of its test cases / calls"""
+    return result['result'] == MEMORY_EXCEEDED or bool(result.get('memory_exceeded'))
+
+
+def _address_space_limit(memory_limit):
+    """
+    RLIMIT_AS for a sandbox allowed to allocate `memory_limit` more bytes: the forked child already maps the address space
+    of its parent, so the limit is counted from its current size.
+    """
+    if memory_limit is None:
+        return None
+    with open('/proc/self/statm') as f:
+        size_pages = int(f.read().split()[0])
+    return size_pages * os.sysconf('SC_PAGE_SIZE') + memory_limit
+
+
+def _status_without_result(p, killed, memory_limit):
+    """
+    Status of a sandbox that returned nothing: killed at the deadline, or died on its own. With a memory limit, a death
+    by SIGKILL (OOM killer) or SIGABRT (failed allocation in native code) is counted as a memory failure,
+    other exits (e.g. a segfault) as failures.
+    """
+    if killed:
+        return "timed out"
+    if p.exitcode is not None and p.exitcode < 0:
+        if memory_limit is not None and -p.exitcode in (signal.SIGKILL, signal.SIGABRT):
+            return MEMORY_EXCEEDED
+        try:
+            return f"failed: {signal.Signals(-p.exitcode).name}"
+        except ValueError:
+            return f"failed: signal {-p.exitcode}"
+    return f"failed: exit code {p.exitcode}"
+
+
+def _pack_calls(calls, timeout):
+    blank_4 = ' ' * 4
+    blank_8 = ' ' * 8
+    blank_12 = ' ' * 12
+    result = f'def check():\n    outputs = []\n'
+    for call in calls:
+        result += f'\n{blank_4}try:\n{blank_8}with time_limit({timeout}):\n{blank_12}outputs.append(output_signature({call}))\
+                    \n{blank_4}except TimeoutException:\n{blank_8}outputs.append("timed out")\
+                    \n{blank_4}except Exception as e:\n{blank_8}outputs.append("error: " + type(e).__name__)\n'
+    result += '\n    return outputs\n'
     result += f'\nglobal final_result\nfinal_result = check()'
     return result
 
 
-def check_correctness_with_test_cases(task_id, prompt, completion, test_cases, timeout, debug=False):
+def _canonical_repr(value):
+    """repr that does not depend on the iteration order of sets and dicts, floats are rounded"""
+    if isinstance(value, float):
+        return repr(round(value, 9))
+    if isinstance(value, (list, tuple)):
+        return type(value).__name__ + "(" + ",".join(_canonical_repr(v) for v in value) + ")"
+    if isinstance(value, (set, frozenset)):
+        return type(value).__name__ + "(" + ",".join(sorted(_canonical_repr(v) for v in value)) + ")"
+    if isinstance(value, dict):
+        return "dict(" + ",".join(sorted(_canonical_repr(k) + ":" + _canonical_repr(v) for k, v in value.items())) + ")"
+    return repr(value)
+
+
+def output_signature(value):
+    return hashlib.md5(_canonical_repr(value).encode('utf-8')).hexdigest()[:16]
+
+
+def run_calls_with_outputs(task_id, prompt, completion, calls, timeout, memory_limit=None):
+    """
+    Run the extracted calls of the entry point on a solution and record a hash of each return value
+    (or the exception type, or "timed out"), in the order of `calls`.
+    `memory_limit` is the number of bytes the solution may allocate, it fails with "memory limit exceeded" above it,
+    the calls that run out of memory are counted in `memory_exceeded`.
+    """
+    extend_timeout = timeout*len(calls)
+
+    def unsafe_execute():
+
+        with create_tempdir():
+
+            # These system calls are needed when cleaning up tempdir.
+            import os
+            import shutil
+            rmtree = shutil.rmtree
+            rmdir = os.rmdir
+            chdir = os.chdir
+
+            resource, start_usage = _start_usage()
+
+            # Disable functionalities that can make destructive changes to the test.
+            reliability_guard(maximum_memory_bytes=_address_space_limit(memory_limit))
+
+            # Construct the program and run it.
+            program = (
+                prompt + completion + "\n" +
+                _pack_calls(calls, timeout)
+            )
+
+            try:
+                exec_globals = {'time_limit': time_limit, 'TimeoutException': TimeoutException, 'output_signature': output_signature}
+                with swallow_io():
+                    exec(program, exec_globals)
+                result.append(exec_globals['final_result'])
+            except TimeoutException:
+                result.append("timed out")
+            except MemoryError:
+                result.append(MEMORY_EXCEEDED)
+            except BaseException as e:
+                result.append(f"failed: {e}")
+
+            usage.update(_usage_since(resource, start_usage))
+
+            # Needed for cleaning up.
+            shutil.rmtree = rmtree
+            os.rmdir = rmdir
+            os.chdir = chdir
+
+    manager = multiprocessing.Manager()
+    result = manager.list()
+    usage = manager.dict()
+
+    start = time.monotonic()
+    p = multiprocessing.Process(target=unsafe_execute)
+    p.start()
+    p.join(timeout=extend_timeout + 0.1)
+    killed = p.is_alive()
+    if killed:
+        p.kill()
+    elapsed = time.monotonic() - start
+
+    if not result:
+        result.append(_status_without_result(p, killed, memory_limit))
+
+    return dict(
+        task_id=task_id,
+        calls=calls,
+        prompt=prompt,
+        completion=completion,
+        passed=(type(result[0]) == list) and len(result[0]) > 0,
+        result=result[0],
+        memory_exceeded=sum(output == MEMORY_ERROR for output in result[0]) if type(result[0]) == list else 0,
+        elapsed=elapsed,
+        cpu_time=usage.get('cpu_time'),
+        peak_rss=usage.get('peak_rss'),
+    )
+
+
+def check_correctness_with_test_cases(task_id, prompt, completion, test_cases, timeout, debug=False, deadline=None, memory_limit=None):
     """
     Evaluates the functional correctness of a solution_content by running the test
     suite provided in the problem. 
+    `timeout` is the limit of each test case (one value or one per test case), the process is killed after
+    `deadline` seconds, by default the sum of the test case limits. `memory_limit` is the number of bytes
+    the solution may allocate (enforced with RLIMIT_AS), it fails with "memory limit exceeded" above it when the
+    allocation happens outside the test cases, a test case that runs out of memory fails and is counted in `memory_exceeded`.
+    The per test case durations, the wall time of the process, its CPU time and peak RSS (growth over the memory
+    inherited from the parent, None when it was killed) are returned with the results.
     """
     if debug:
         dir_path = f'/home/ec2-user/SyntheticCodes/data/check_program/{task_id}/'
         if not os.path.exists(dir_path):
             os.makedirs(dir_path)
-    extend_timeout = timeout*len(test_cases)
+    extend_timeout = deadline if deadline is not None else (sum(timeout) if isinstance(timeout, list) else timeout*len(test_cases))
 
     def unsafe_execute():
 
@@ -69,8 +275,10 @@ def check_correctness_with_test_cases(task_id, prompt, completion, test_cases, t
             rmdir = os.rmdir
             chdir = os.chdir
 
+            resource, start_usage = _start_usage()
+
             # Disable functionalities that can make destructive changes to the test.
-            reliability_guard()
+            reliability_guard(maximum_memory_bytes=_address_space_limit(memory_limit))
 
             # Construct the check program and run it.
             check_program = (
@@ -83,18 +291,24 @@ def check_correctness_with_test_cases(task_id, prompt, completion, test_cases, t
                 hash_obj.update(check_program.encode('utf-8'))
                 file_name = dir_path + hash_obj.hexdigest()
                 with open(file_name, 'w') as file:
-                    file.write(help_funs + check_program + "\nprint(final_result)")
+                    file.write(help_funs + "from time import perf_counter\n" + check_program + "\nprint(final_result)")
 
             try:
-                exec_globals = {'time_limit': time_limit}
+                exec_globals = {'time_limit': time_limit, 'perf_counter': time.perf_counter}
                 with swallow_io():
                     exec(check_program, exec_globals)
                 result.append(exec_globals['final_result'])
+                durations.extend(exec_globals['final_durations'])
+                usage['memory_exceeded'] = exec_globals['final_memory_exceeded']
             except TimeoutException:
                 result.append("timed out")
+            except MemoryError:
+                result.append(MEMORY_EXCEEDED)
             except BaseException as e:
                 result.append(f"failed: {e}")
 
+            usage.update(_usage_since(resource, start_usage))
+
             # Needed for cleaning up.
             shutil.rmtree = rmtree
             os.rmdir = rmdir
@@ -102,15 +316,20 @@ def check_correctness_with_test_cases(task_id, prompt, completion, test_cases, t
 
     manager = multiprocessing.Manager()
     result = manager.list()
+    usage = manager.dict()
+    durations = manager.list()
 
+    start = time.monotonic()
     p = multiprocessing.Process(target=unsafe_execute)
     p.start()
     p.join(timeout=extend_timeout + 0.1)
-    if p.is_alive():
+    killed = p.is_alive()
+    if killed:
         p.kill()
+    elapsed = time.monotonic() - start
 
     if not result:
-        result.append("timed out")
+        result.append(_status_without_result(p, killed, memory_limit))
 
     return dict(
         task_id=task_id,
@@ -118,7 +337,12 @@ def check_correctness_with_test_cases(task_id, prompt, completion, test_cases, t
         prompt=prompt,
         completion=completion,
         passed=(type(result[0]) == list) and len(result[0]) > 0,
-        result=result[0]
+        result=result[0],
+        durations=list(durations) if type(result[0]) == list else None,
+        memory_exceeded=usage.get('memory_exceeded', 0),
+        elapsed=elapsed,
+        cpu_time=usage.get('cpu_time'),
+        peak_rss=usage.get('peak_rss'),
     )
 
 def check_correctness(task_id: str, prompt: str, completion: str, test: str, entry_point: str, timeout: float) -> Dict:
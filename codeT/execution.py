@@ -8,8 +8,13 @@ libgcc_s = ctypes.CDLL('libgcc_s.so.1')
 
 from collections import defaultdict
 from concurrent.futures import as_completed, ProcessPoolExecutor
+import asyncio
+import contextlib
 import logging
-from codeT._execution import check_correctness_with_test_cases, check_correctness
+import statistics
+from codeT._execution import check_correctness_with_test_cases, check_correctness, run_calls_with_outputs
+from codeT.prescreen import prescreen, rejected_result
+from codeT.scheduler import SandboxScheduler
 
 logging.basicConfig(
     format="SystemLog: [%(asctime)s][%(name)s][%(levelname)s] - %(message)s",
@@ -104,42 +109,262 @@ def evaluate_with_test_cases(
     logger.info('execution finished!')
     return results_list
 
-def best_solution(
-    exercise,
-    timeout,
-    limit,
-    debug = False
-):
+def _executor(scheduler):
+    """The shared scheduler (left open), or a process pool for one exercise"""
+    return contextlib.nullcontext(scheduler) if scheduler is not None else ProcessPoolExecutor()
+
+def _run_candidates(executor, exercise, completions, test_cases, timeout, debug, deadline=None):
+    futures = []
+    results_list = []
+    for completion in completions:
+        args = (exercise['exercise_id'], exercise['problem'], completion, test_cases, timeout, debug, deadline, getattr(executor, 'memory_limit', None))
+        future = executor.submit(check_correctness_with_test_cases, *args)
+        futures.append(future)
+
+    logger.info(f'{len(futures)} execution requests are submitted')
+    for idx, future in enumerate(as_completed(futures)):
+        logger.info('[{}/{}] execution completed'.format(idx+1, len(futures)))
+        result = future.result()
+        results_list.append(result)
+    return results_list
+
+class TimeoutPolicy:
+    """
+    Per exercise time limits. The first `calibration` candidates run with the `ceiling` limit, the limit of each test case
+    is then the median of the durations of the runs that pass it times `factor`, between `floor` and `ceiling`. A test case
+    none of them passes keeps the ceiling: a wrong answer fails fast, and a slower correct candidate would time out
+    on the very test case that tells it apart.
+    `cpu_budget` (seconds of sandbox time per exercise) caps the deadline of the other candidates: what the calibration
+    left of it is shared evenly between them.
+    """
+
+    def __init__(self, factor=10.0, floor=0.05, ceiling=0.5, calibration=3, cpu_budget=None):
+        self.factor = factor
+        self.floor = floor
+        self.ceiling = ceiling
+        self.calibration = calibration
+        self.cpu_budget = cpu_budget
+
+    def calibrate(self, results, n_tests):
+        timeouts = []
+        for i in range(n_tests):
+            passed = [
+                r['durations'][i] for r in results
+                if r.get('durations') is not None and len(r['durations']) == n_tests
+                and r['result'][i] is True and r['durations'][i] < self.ceiling
+            ]
+            if not passed:
+                timeouts.append(self.ceiling)
+                continue
+            median = statistics.median(passed)
+            timeouts.append(round(min(max(median * self.factor, self.floor), self.ceiling), 4))
+        return timeouts
+
+    def deadline(self, timeouts, n_candidates, spent):
+        deadline = sum(timeouts)
+        if self.cpu_budget is not None and n_candidates > 0:
+            deadline = min(deadline, max(self.cpu_budget - spent, 0.0) / n_candidates)
+        return deadline
+
+def discriminative_tests(results, n_tests):
+    """
+    Indices of the test cases on which the probed candidates disagree. A test passed (or failed) by every candidate
+    does not tell them apart. None when no candidate produced per test results.
+    """
+    per_test = [r['result'] for r in results if isinstance(r['result'], list) and len(r['result']) == n_tests]
+    if not per_test:
+        return None
+    return [i for i in range(n_tests) if len({result[i] for result in per_test}) > 1]
+
+def _restrict_result(result, keep, test_cases):
+    if not isinstance(result['result'], list):
+        return dict(result, test_cases=test_cases)
+    kept = [result['result'][i] for i in keep]
+    durations = [result['durations'][i] for i in keep] if result.get('durations') is not None else None
+    return dict(result, test_cases=test_cases, result=kept, durations=durations, passed=len(kept) > 0)
+
+def _prepare_candidates(exercise, limit):
+    """Selected test cases, results of the candidates rejected by the pre-screen and completions left to execute"""
     test_cases_by_task = []
     entry_point = get_function_name(exercise['problem'])
     for sample in exercise['tests']:
         test_cases = PostProcessor.test_case_extract(sample, entry_point)
         test_cases_by_task.append(test_cases)
     
-    # print(test_cases_by_task)
-    # get limited test cases
-    limited_task_test_cases = [cases_per_sample[:limit] for cases_per_sample in test_cases_by_task]
-    limited_task_test_cases = sum(limited_task_test_cases, [])
-    # print(limited_task_test_cases)
-    logger.info(f'{len(exercise["solutions"])} solutions, {len(limited_task_test_cases)} test cases')
-    with ProcessPoolExecutor() as executor:
-        futures = []
-        results_list = []
-        for sample in exercise['solutions']:
-            completion = PostProcessor.solution_extract(sample)
-            args = (exercise['exercise_id'], exercise['problem'], completion, list(set(limited_task_test_cases)), timeout, debug)
-            future = executor.submit(check_correctness_with_test_cases, *args)
-            futures.append(future)
+    test_cases = PostProcessor.select_test_cases(test_cases_by_task, limit)
+    logger.info(f'{len(exercise["solutions"])} solutions, {len(test_cases)} test cases')
+    results_list = []
+    completions = []
+    for sample in exercise['solutions']:
+        completion = PostProcessor.solution_extract(sample)
+        # hopeless candidates are failed here without a sandbox
+        reason = prescreen(exercise['problem'], completion, entry_point)
+        if reason is not None:
+            results_list.append(rejected_result(exercise['exercise_id'], exercise['problem'], completion, test_cases, reason))
+            continue
+        completions.append(completion)
+    logger.info(f'{len(results_list)} executions saved by the pre-screen')
+    return test_cases, results_list, completions
+
+def _first_round(completions, test_cases, timeout, probe, timeouts):
+    """Number of candidates of the probe / calibration round (0 to skip it) and their time limit"""
+    n_first = max(probe, timeouts.calibration if timeouts is not None else 0)
+    if n_first > 0 and len(completions) > n_first and test_cases:
+        return n_first, timeouts.ceiling if timeouts is not None else timeout
+    return 0, timeout
+
+def _plan_rest(first, test_cases, n_rest, timeout, probe, timeouts):
+    """Test cases, time limits and deadline of the remaining candidates from the results of the first round"""
+    test_timeouts = timeout
+    deadline = None
+    if first:
+        spent = sum(r['elapsed'] for r in first)
+        if timeouts is not None:
+            test_timeouts = timeouts.calibrate(first, len(test_cases))
+            logger.info(f'calibrated time limits: {test_timeouts}')
+        keep = discriminative_tests(first, len(test_cases)) if probe > 0 and len(test_cases) > 1 else None
+        if keep:
+            logger.info(f'probe round: {len(test_cases) - len(keep)} of {len(test_cases)} test cases dropped')
+            test_cases = [test_cases[i] for i in keep]
+            first = [_restrict_result(r, keep, test_cases) for r in first]
+            if isinstance(test_timeouts, list):
+                test_timeouts = [test_timeouts[i] for i in keep]
+    else:
+        spent = 0.0
+    if timeouts is not None:
+        if not isinstance(test_timeouts, list):
+            test_timeouts = [timeouts.ceiling] * len(test_cases)
+        deadline = timeouts.deadline(test_timeouts, n_rest, spent)
+    return first, test_cases, test_timeouts, deadline
+
+def best_solution(
+    exercise,
+    timeout,
+    limit,
+    debug = False,
+    probe = 0,
+    timeouts: TimeoutPolicy | None = None,
+    scheduler: SandboxScheduler | None = None,
+):
+    """
+    Execute the solutions of an exercise against its test cases. Test cases are the first `limit` assertions of each test sample,
+    deduplicated by AST. With `probe` > 0, the first `probe` candidates run on every test case and only the test cases
+    they disagree on are kept for all candidates (the probed results are restricted to them so that counts stay comparable).
+    With a `timeouts` policy, the first candidates also calibrate the time limit of each test case and the deadline of the others.
+    The candidates run on `scheduler` (memory limited sandboxes) when given, on a process pool of the exercise otherwise.
+    """
+    test_cases, results_list, completions = _prepare_candidates(exercise, limit)
+    with _executor(scheduler) as executor:
+        n_first, first_timeout = _first_round(completions, test_cases, timeout, probe, timeouts)
+        first = _run_candidates(executor, exercise, completions[:n_first], test_cases, first_timeout, debug) if n_first else []
+        rest = completions[n_first:]
+        first, test_cases, test_timeouts, deadline = _plan_rest(first, test_cases, len(rest), timeout, probe, timeouts)
+        results_list += first
+        results_list += _run_candidates(executor, exercise, rest, test_cases, test_timeouts, debug, deadline)
             
-        logger.info(f'{len(futures)} execution requests are submitted')
+    logger.info('execution finished!')
+    return results_list
+
+async def _run_candidates_async(scheduler, exercise, completions, test_cases, timeout, debug, deadline=None):
+    runs = [
+        scheduler.run(check_correctness_with_test_cases, exercise['exercise_id'], exercise['problem'], completion, test_cases, timeout, debug, deadline, scheduler.memory_limit)
+        for completion in completions
+    ]
+    logger.info(f'{len(runs)} execution requests are submitted')
+    return list(await asyncio.gather(*runs))
+
+async def run_candidates(
+    exercise,
+    scheduler: SandboxScheduler,
+    timeout = 0.5,
+    limit = 5,
+    debug = False,
+    probe = 0,
+    timeouts: TimeoutPolicy | None = None,
+):
+    """
+    Coroutine version of `best_solution` on a shared `scheduler`: the sandbox runs are awaited instead of blocking,
+    so that an event loop can execute an exercise as soon as its samples are generated while other exercises are in flight.
+    """
+    test_cases, results_list, completions = _prepare_candidates(exercise, limit)
+    n_first, first_timeout = _first_round(completions, test_cases, timeout, probe, timeouts)
+    first = await _run_candidates_async(scheduler, exercise, completions[:n_first], test_cases, first_timeout, debug) if n_first else []
+    rest = completions[n_first:]
+    first, test_cases, test_timeouts, deadline = _plan_rest(first, test_cases, len(rest), timeout, probe, timeouts)
+    results_list += first
+    results_list += await _run_candidates_async(scheduler, exercise, rest, test_cases, test_timeouts, debug, deadline)
+    logger.info(f'execution of {exercise["exercise_id"]} finished!')
+    return results_list
+
+def cluster_solutions(
+    exercise,
+    timeout,
+    limit,
+    debug = False,
+    scheduler: SandboxScheduler | None = None,
+):
+    """
+    Run every distinct solution once on each distinct call of the entry point extracted from the test cases,
+    the result of a solution is the list of signatures (hash of the return value, exception type or "timed out") of its outputs.
+    Solutions are then grouped with `cluster_by_outputs`, the generated expected values are not used.
+    """
+    entry_point = get_function_name(exercise['problem'])
+    test_cases_by_task = [PostProcessor.test_case_extract(sample, entry_point) for sample in exercise['tests']]
+    calls = PostProcessor.extract_call_inputs(PostProcessor.select_test_cases(test_cases_by_task, limit), entry_point)
+    logger.info(f'{len(exercise["solutions"])} solutions, {len(calls)} distinct inputs')
+    results_list = []
+    completions = []
+    for sample in exercise['solutions']:
+        completion = PostProcessor.solution_extract(sample)
+        reason = prescreen(exercise['problem'], completion, entry_point)
+        if reason is not None:
+            results_list.append(rejected_result(exercise['exercise_id'], exercise['problem'], completion, calls, reason))
+            continue
+        completions.append(completion)
+    if not calls:
+        return results_list
+
+    distinct = list(dict.fromkeys(completions))
+    outputs = {}
+    with _executor(scheduler) as executor:
+        memory_limit = getattr(executor, 'memory_limit', None)
+        futures = [
+            executor.submit(run_calls_with_outputs, exercise['exercise_id'], exercise['problem'], completion, calls, timeout, memory_limit)
+            for completion in distinct
+        ]
+        logger.info(f'{len(futures)} execution requests are submitted ({len(completions) - len(distinct)} duplicate solutions)')
         for idx, future in enumerate(as_completed(futures)):
             logger.info('[{}/{}] execution completed'.format(idx+1, len(futures)))
             result = future.result()
-            results_list.append(result)
-            
+            outputs[result['completion']] = result
+
     logger.info('execution finished!')
-    # print(results_list)
-    return results_list
+    return results_list + [dict(outputs[completion]) for completion in completions]
+
+def cluster_by_outputs(execution_result):
+    """
+    Group the solutions with the same output signature, largest clusters first (agreement among solutions),
+    then the ones with the most inputs answered without error. Clusters that only error are left out.
+    """
+    clusters = defaultdict(list)
+    for item in execution_result:
+        if not isinstance(item['result'], list):
+            continue
+        answered = sum(1 for output in item['result'] if not output.startswith(('error: ', 'timed out')))
+        if answered == 0:
+            continue
+        clusters[tuple(item['result'])].append(item)
+    return sorted(
+        clusters.values(),
+        key=lambda cluster: (len(cluster), sum(1 for output in cluster[0]['result'] if not output.startswith(('error: ', 'timed out')))),
+        reverse=True,
+    )
+
+def most_agreed_solution(execution_result):
+    clusters = cluster_by_outputs(execution_result)
+    if not clusters:
+        return None
+    return clusters[0][0]
 
 def pass_most_solution(execution_result):
     max_true_result = None
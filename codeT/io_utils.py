@@ -1,14 +1,39 @@
 # Copyright (c) Microsoft Corporation.
 # Licensed under the MIT license.
 
+import gzip
+import io
 import json
 import pickle
 
+
+def open_file(path, mode='r', encoding='utf8'):
+    """
+    `open` that decompresses `.gz` / `.zst` / `.zstd` files, including the multi-frame files written by
+    `dataset_gen.compression`. Compressed files are read-only here, they are written with `dataset_gen.compression.open_file`.
+    """
+    path = str(path)
+    text = 'b' not in mode
+    if not path.endswith(('.gz', '.zst', '.zstd')):
+        return open(path, mode, encoding=encoding if text else None)
+    if mode.replace('t', '').replace('b', '') != 'r':
+        raise ValueError(f"Compressed file {path} can only be read here, write it with dataset_gen.compression.open_file")
+    raw = open(path, 'rb')
+    if path.endswith('.gz'):
+        stream = gzip.GzipFile(fileobj=raw, mode='rb')
+    else:
+        try:
+            import zstandard
+        except ImportError as e:
+            raise ImportError("zstd compressed files need zstandard, install it with `pip install zstandard`") from e
+        stream = io.BufferedReader(zstandard.ZstdDecompressor().stream_reader(raw, read_across_frames=True, closefd=True))
+    return io.TextIOWrapper(stream, encoding=encoding) if text else stream
+
 class Tools:
     @staticmethod
     def load_jsonl(file_path):
         json_objects = []
-        with open(file_path, 'r', encoding='utf8') as f:
+        with open_file(file_path, 'r', encoding='utf8') as f:
             for line in f:
                 json_objects.append(json.loads(line.strip()))
         return json_objects
@@ -23,15 +48,15 @@ class Tools:
     
     @staticmethod
     def dump_pickle(path, content):
-        with open(path, 'wb') as f:
+        with open_file(path, 'wb') as f:
             pickle.dump(content, f)
     
     @staticmethod
     def load_pickle(path):
-        with open(path, 'rb') as f:
+        with open_file(path, 'rb') as f:
             return pickle.load(f)
         
     @staticmethod
     def write_file(path, content):
-        with open(path, 'w', encoding='utf8') as f:
+        with open_file(path, 'w', encoding='utf8') as f:
             f.write(content)
\ No newline at end of file
@@ -1,6 +1,8 @@
 # Copyright (c) Microsoft Corporation.
 # Licensed under the MIT license.
 
+import ast
+import re
 from collections import defaultdict
 
 from codeT.io_utils import Tools
@@ -111,6 +113,54 @@ class PostProcessor:
         checked_assertions = [i for i in truncated_test_cases if PostProcessor._check_test_case_validation(i)]
         return checked_assertions
 
+    @staticmethod
+    def canonical_test_case(test_case):
+        """AST dump of the assertion: formatting, assertion messages and the side of `==`/`!=` operands do not matter"""
+        try:
+            tree = ast.parse(test_case)
+        except (SyntaxError, ValueError):
+            return test_case.strip()
+        for node in ast.walk(tree):
+            if isinstance(node, ast.Assert):
+                node.msg = None
+            if isinstance(node, ast.Compare) and len(node.ops) == 1 and isinstance(node.ops[0], (ast.Eq, ast.NotEq)):
+                left, right = sorted([node.left, node.comparators[0]], key=ast.dump)
+                node.left, node.comparators = left, [right]
+        return ast.dump(tree, annotate_fields=False)
+
+    @staticmethod
+    def select_test_cases(test_cases_by_sample, limit):
+        """First `limit` assertions of every test sample, without the equivalent ones, in a deterministic order (first seen)"""
+        selected = []
+        seen = set()
+        for cases_per_sample in test_cases_by_sample:
+            for test_case in cases_per_sample[:limit]:
+                key = PostProcessor.canonical_test_case(test_case)
+                if key in seen:
+                    continue
+                seen.add(key)
+                selected.append(test_case)
+        return selected
+
+    @staticmethod
+    def extract_call_inputs(test_cases, entry_point):
+        """Distinct calls of the entry point found in the assertions (`entry_point(args)` without the expected value), first seen first"""
+        calls = []
+        seen = set()
+        for test_case in test_cases:
+            try:
+                tree = ast.parse(test_case)
+            except (SyntaxError, ValueError):
+                continue
+            for node in ast.walk(tree):
+                if isinstance(node, ast.Call) and isinstance(node.func, ast.Name) and node.func.id == entry_point:
+                    key = ast.dump(node, annotate_fields=False)
+                    if key in seen:
+                        continue
+                    seen.add(key)
+                    calls.append(ast.unparse(node))
+        return calls
+
     @staticmethod
     def _check_test_case_validation(test_case):
         if len(test_case.strip()) < 1:
@@ -125,5 +175,9 @@ class PostProcessor:
         except Exception:
             return False
         
+_FUNCTION_NAME = re.compile(r"^\s*def\s+(\w+)\s*\(", re.MULTILINE)
+
 def get_function_name(problem: str):
-    return problem.split("def")[1].split('(')[0].strip()
\ No newline at end of file
+    """Name of the first function defined by the problem, "" when there is none"""
+    match = _FUNCTION_NAME.search(problem)
+    return match.group(1) if match else ""
\ No newline at end of file
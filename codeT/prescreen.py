@@ -0,0 +1,58 @@
+import ast
+from typing import Optional
+
+REJECTED = "rejected: "
+
+
+def _is_trivial_statement(node: ast.stmt) -> bool:
+    """Docstring, `pass`, `...` or `raise NotImplementedError`"""
+    if isinstance(node, ast.Pass):
+        return True
+    if isinstance(node, ast.Expr) and isinstance(node.value, ast.Constant):
+        return isinstance(node.value.value, str) or node.value.value is Ellipsis
+    if isinstance(node, ast.Raise) and node.exc is not None:
+        exc = node.exc.func if isinstance(node.exc, ast.Call) else node.exc
+        return isinstance(exc, ast.Name) and exc.id == "NotImplementedError"
+    return False
+
+
+def prescreen(prompt: str, completion: str, entry_point: str) -> Optional[str]:
+    """
+    Static check of a candidate before it is sent to a sandbox, with a single parse of `prompt + completion`.
+    Returns the reason of the rejection, None when the candidate has to be executed.
+    """
+    if not completion.strip():
+        return "empty completion"
+    try:
+        tree = ast.parse(prompt + completion)
+    except (SyntaxError, ValueError) as e:
+        return f"syntax error: {getattr(e, 'msg', e)} (line {getattr(e, 'lineno', None)})"
+    # the last definition is the one `exec` binds, e.g. when the completion restates the function of the prompt
+    function = next(
+        (
+            node for node in reversed(tree.body)
+            if isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef)) and node.name == entry_point
+        ),
+        None,
+    )
+    if function is None:
+        return f"entry point {entry_point} not defined"
+    if all(_is_trivial_statement(node) for node in function.body):
+        return "trivial body"
+    return None
+
+
+def rejected_result(task_id, prompt, completion, test_cases, reason: str) -> dict:
+    """Result of a rejected candidate, shaped like the ones of `check_correctness_with_test_cases`"""
+    return dict(
+        task_id=task_id,
+        test_cases=test_cases,
+        prompt=prompt,
+        completion=completion,
+        passed=False,
+        result=REJECTED + reason,
+    )
+
+
+def is_rejected(result: dict) -> bool:
+    return isinstance(result["result"], str) and result["result"].startswith(REJECTED)
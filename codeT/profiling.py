@@ -0,0 +1,85 @@
+import json
+from collections import defaultdict
+
+from codeT._execution import exceeded_memory
+
+
+class ExecutionProfile:
+    """
+    Aggregate the resource usage of the sandbox runs (`elapsed`, `cpu_time`, `peak_rss` as the memory grown by the
+    solution over the sandbox start, per test case `durations`, test cases / calls over the memory limit)
+    returned by `best_solution` / `cluster_solutions`, to find the exercises, candidates and test cases that eat the budget.
+    """
+
+    def __init__(self, top: int = 10):
+        self.top = top
+        self.runs = 0
+        self.killed = 0
+        self.memory_exceeded = 0
+        self.wall_time = 0.0
+        self.cpu_time = 0.0
+        self.peak_rss = 0
+        self._exercises = defaultdict(lambda: {"runs": 0, "wall_time": 0.0, "cpu_time": 0.0, "peak_rss": 0})
+        self._candidates = []
+        self._tests = []
+
+    def add(self, exercise_id, results):
+        for r in results:
+            if r.get("elapsed") is None:  # rejected before the sandbox
+                continue
+            cpu_time = r.get("cpu_time")
+            peak_rss = r.get("peak_rss") or 0
+            self.runs += 1
+            self.killed += cpu_time is None
+            self.memory_exceeded += exceeded_memory(r)
+            self.wall_time += r["elapsed"]
+            self.cpu_time += cpu_time or 0.0
+            self.peak_rss = max(self.peak_rss, peak_rss)
+            exercise = self._exercises[exercise_id]
+            exercise["runs"] += 1
+            exercise["wall_time"] += r["elapsed"]
+            exercise["cpu_time"] += cpu_time or 0.0
+            exercise["peak_rss"] = max(exercise["peak_rss"], peak_rss)
+            self._candidates.append({
+                "exercise_id": exercise_id,
+                "completion": r["completion"][:200],
+                "wall_time": r["elapsed"],
+                "cpu_time": cpu_time,
+                "peak_rss": r.get("peak_rss"),
+                "result": r["result"] if isinstance(r["result"], str) else None,
+                "memory_exceeded": r.get("memory_exceeded") or 0,
+            })
+            for test_case, duration in zip(r.get("test_cases") or [], r.get("durations") or []):
+                self._tests.append({"exercise_id": exercise_id, "test_case": test_case, "duration": duration})
+            # only the slowest items are kept
+            if len(self._candidates) > 4 * self.top:
+                self._candidates = sorted(self._candidates, key=lambda c: c["wall_time"], reverse=True)[:self.top]
+            if len(self._tests) > 4 * self.top:
+                self._tests = sorted(self._tests, key=lambda t: t["duration"], reverse=True)[:self.top]
+
+    def report(self) -> dict:
+        exercises = sorted(self._exercises.items(), key=lambda item: item[1]["wall_time"], reverse=True)[:self.top]
+        return {
+            "runs": self.runs,
+            "killed": self.killed,
+            "memory_exceeded": self.memory_exceeded,
+            "wall_time": self.wall_time,
+            "cpu_time": self.cpu_time,
+            "max_peak_rss": self.peak_rss,
+            "slowest_exercises": [dict(exercise_id=exercise_id, **stats) for exercise_id, stats in exercises],
+            "slowest_candidates": sorted(self._candidates, key=lambda c: c["wall_time"], reverse=True)[:self.top],
+            "slowest_test_cases": sorted(self._tests, key=lambda t: t["duration"], reverse=True)[:self.top],
+        }
+
+    def export(self, path: str):
+        with open(path, "w") as file:
+            json.dump(self.report(), file, indent=2)
+
+    def print_summary(self):
+        report = self.report()
+        print(f"sandbox runs: {report['runs']} ({report['killed']} killed, "
+              f"{report['memory_exceeded']} over the memory limit), wall time {report['wall_time']:.1f}s, "
+              f"cpu time {report['cpu_time']:.1f}s, max peak RSS {report['max_peak_rss'] / 2**20:.0f} MiB")
+        for exercise in report["slowest_exercises"][:5]:
+            print(f"  {exercise['exercise_id']}: {exercise['runs']} runs, wall {exercise['wall_time']:.2f}s, "
+                  f"cpu {exercise['cpu_time']:.2f}s, peak RSS {exercise['peak_rss'] / 2**20:.0f} MiB")
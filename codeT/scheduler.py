@@ -0,0 +1,115 @@
+import asyncio
+import os
+import threading
+from concurrent.futures import Future, ProcessPoolExecutor
+from typing import Optional
+
+
+def host_memory() -> int:
+    """Physical memory of the host in bytes"""
+    return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+
+
+def process_rss() -> int:
+    """Resident memory of the current process in bytes"""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except OSError:
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class SandboxScheduler:
+    """
+    Process pool for the sandbox runs that admits jobs against a total memory budget.
+    Every job reserves `memory_limit` bytes (the memory its sandbox may allocate, enforced with RLIMIT_AS) plus
+    `job_overhead` of `memory_budget` until it completes, `submit` blocks while the budget is used up. The overhead covers
+    the processes of a job besides the solution: the pool worker, the `multiprocessing.Manager` server and the forked
+    sandbox, which all start from the resident memory of this process (three times it by default).
+    Since candidates cannot grow past their limit, the number of `workers` can exceed the number of cores without
+    making the host swap.
+    Without a budget it is a plain process pool. `run` is the asyncio entry point, one scheduler can serve the whole process.
+    """
+
+    def __init__(self, workers=None, memory_budget=None, memory_limit=None, job_overhead=None):
+        if memory_budget is not None and memory_limit is None:
+            raise ValueError("a memory budget needs a per sandbox memory limit")
+        self.memory_limit = memory_limit
+        self.memory_budget = memory_budget
+        self.job_overhead = job_overhead if job_overhead is not None else 3 * process_rss()
+        self.admission_waits = 0
+        self._available = memory_budget
+        self._condition = threading.Condition()
+        self._executor = ProcessPoolExecutor(max_workers=workers)
+
+    def _reserve(self, memory, cancelled=None) -> bool:
+        """Wait until `memory` fits in the budget and take it, False when `cancelled` is set first"""
+        with self._condition:
+            if self._available < memory:
+                self.admission_waits += 1
+            self._condition.wait_for(lambda: self._available >= memory or (cancelled is not None and cancelled.is_set()))
+            if cancelled is not None and cancelled.is_set():
+                return False
+            self._available -= memory
+            return True
+
+    def _release(self, memory):
+        with self._condition:
+            self._available += memory
+            self._condition.notify_all()
+
+    def _submit(self, fn, args, kwargs, cancelled=None, submitted=None) -> Optional[Future]:
+        if self.memory_budget is None:
+            return self._executor.submit(fn, *args, **kwargs)
+        memory = min(self.memory_limit + self.job_overhead, self.memory_budget)
+        if not self._reserve(memory, cancelled):
+            return None
+        try:
+            future = self._executor.submit(fn, *args, **kwargs)
+        except BaseException:
+            self._release(memory)
+            raise
+        future.add_done_callback(lambda _: self._release(memory))
+        if submitted is not None:
+            with self._condition:
+                submitted.append(future)
+                if cancelled.is_set():
+                    future.cancel()
+        return future
+
+    def submit(self, fn, *args, **kwargs) -> Future:
+        return self._submit(fn, args, kwargs)
+
+    async def run(self, fn, *args):
+        """
+        Awaitable `submit`, the sandbox future is bridged to the running event loop. Admission against the memory
+        budget blocks, so it waits in the default thread pool of the loop instead of the loop itself.
+        Cancelling the coroutine withdraws a job still waiting for admission (it never runs nor holds budget) and cancels
+        a job still queued in the pool. A sandbox that already started runs until its deadline, its budget is then released.
+        """
+        loop = asyncio.get_running_loop()
+        if self.memory_budget is None:
+            future = self.submit(fn, *args)
+        else:
+            cancelled = threading.Event()
+            submitted = []
+            try:
+                future = await loop.run_in_executor(None, self._submit, fn, args, {}, cancelled, submitted)
+            except asyncio.CancelledError:
+                with self._condition:
+                    cancelled.set()
+                    self._condition.notify_all()
+                    for job in submitted:
+                        job.cancel()
+                raise
+        return await asyncio.wrap_future(future, loop=loop)
+
+    def shutdown(self, wait=True):
+        self._executor.shutdown(wait=wait)
+
+    def __enter__(self) -> "SandboxScheduler":
+        return self
+
+    def __exit__(self, *exc):
+        self.shutdown()
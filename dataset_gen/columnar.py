@@ -0,0 +1,104 @@
+import json
+from typing import Dict, Iterable, Iterator, List, Optional, Union
+from pathlib import Path
+
+from dataset_gen.compression import open_file
+
+# columns of each kind of dataset, "list" columns hold the samples of an exercise
+SCHEMAS: Dict[str, Dict[str, str]] = {
+    "exercises": {"exercise_id": "string", "problem": "string", "solution": "string"},
+    "solutions": {"exercise_id": "string", "problem": "string", "solutions": "list"},
+    "tests": {"exercise_id": "string", "problem": "string", "tests": "list"},
+    "solutions_with_tests": {"exercise_id": "string", "problem": "string", "solutions": "list", "tests": "list"},
+    "codet": {"exercise_id": "string", "problem": "string", "solution": "string"},
+}
+
+
+def _pyarrow():
+    try:
+        import pyarrow
+        import pyarrow.parquet
+    except ImportError as e:
+        raise ImportError("Parquet datasets need pyarrow, install it with `pip install pyarrow`") from e
+    return pyarrow, pyarrow.parquet
+
+
+def is_parquet(path: Union[Path, str]) -> bool:
+    return str(path).endswith(".parquet")
+
+
+def arrow_schema(kind: str):
+    pa, _ = _pyarrow()
+    types = {"string": pa.string(), "list": pa.list_(pa.string())}
+    return pa.schema([(name, types[t]) for name, t in SCHEMAS[kind].items()])
+
+
+def write_parquet(path: Union[Path, str], records: Iterable[dict], kind: str, row_group_size: int = 10_000) -> int:
+    """Stream the records to a Parquet file, one row group every `row_group_size` records"""
+    pa, pq = _pyarrow()
+    schema = arrow_schema(kind)
+    n = 0
+    with pq.ParquetWriter(str(path), schema) as writer:
+        batch = []
+        for record in records:
+            batch.append(record)
+            if len(batch) >= row_group_size:
+                writer.write_table(pa.Table.from_pylist(batch, schema=schema))
+                n += len(batch)
+                batch = []
+        if batch or n == 0:
+            writer.write_table(pa.Table.from_pylist(batch, schema=schema))
+            n += len(batch)
+    return n
+
+
+def read_table(path: Union[Path, str], columns: Optional[List[str]] = None, row_groups: Optional[List[int]] = None):
+    """Arrow table of a Parquet dataset, only the requested columns and row groups are read"""
+    _, pq = _pyarrow()
+    parquet_file = pq.ParquetFile(str(path))
+    if row_groups is not None:
+        return parquet_file.read_row_groups(row_groups, columns=columns)
+    return parquet_file.read(columns=columns)
+
+
+def read_dataframe(path: Union[Path, str], columns: Optional[List[str]] = None, row_groups: Optional[List[int]] = None):
+    """pandas DataFrame of a Parquet dataset, for ad hoc analysis"""
+    return read_table(path, columns, row_groups).to_pandas()
+
+
+def num_row_groups(path: Union[Path, str]) -> int:
+    _, pq = _pyarrow()
+    return pq.ParquetFile(str(path)).num_row_groups
+
+
+def iter_records(path: Union[Path, str], columns: Optional[List[str]] = None, row_groups: Optional[List[int]] = None, batch_size: int = 10_000) -> Iterator[dict]:
+    """
+    Records of a Parquet or JSONL dataset. Parquet files are read by batches with only the requested columns and row groups,
+    JSONL lines still have to be decoded whole (`row_groups` does not apply to them).
+    """
+    if is_parquet(path):
+        _, pq = _pyarrow()
+        parquet_file = pq.ParquetFile(str(path))
+        for batch in parquet_file.iter_batches(batch_size=batch_size, row_groups=row_groups, columns=columns):
+            yield from batch.to_pylist()
+        return
+    with open_file(path, "r") as file:
+        for line in file:
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            yield record if columns is None else {c: record.get(c) for c in columns}
+
+
+def write_records(path: Union[Path, str], records: Iterable[dict], kind: str, mode: str = "w") -> int:
+    """Write a dataset as Parquet or JSONL depending on the extension of `path`"""
+    if is_parquet(path):
+        if mode != "w":
+            raise ValueError(f"Parquet datasets cannot be appended to, use a .jsonl output instead of {path}")
+        return write_parquet(path, records, kind)
+    n = 0
+    with open_file(path, mode) as file:
+        for record in records:
+            file.write(json.dumps(record) + "\n")
+            n += 1
+    return n
@@ -0,0 +1,107 @@
+import gzip
+import io
+from pathlib import Path
+from typing import Callable, Optional, Union
+
+SUFFIXES = {".gz": "gzip", ".zst": "zstd", ".zstd": "zstd"}
+EXTENSIONS = {"": "", "gzip": ".gz", "zstd": ".zst"}
+FRAME_SIZE = 1 << 20
+
+
+def _zstandard():
+    try:
+        import zstandard
+    except ImportError as e:
+        raise ImportError("zstd compressed datasets need zstandard, install it with `pip install zstandard`") from e
+    return zstandard
+
+
+def compression_of(path: Union[Path, str]) -> Optional[str]:
+    """`gzip` or `zstd` from the extension of the path, None for plain files"""
+    return SUFFIXES.get(Path(path).suffix)
+
+
+def extension(compression: str) -> str:
+    """File name extension of a compression option (`gzip`, `zstd` or empty for none)"""
+    if compression not in EXTENSIONS:
+        raise ValueError(f"Unknown compression {compression}, expected one of {[c for c in EXTENSIONS if c]}")
+    return EXTENSIONS[compression]
+
+
+def _compressor(compression: str, level: Optional[int]) -> Callable[[bytes], bytes]:
+    if compression == "gzip":
+        return lambda data: gzip.compress(data, compresslevel=level if level is not None else 6)
+    compressor = _zstandard().ZstdCompressor(level=level if level is not None else 3)
+    return compressor.compress
+
+
+class FrameWriter(io.RawIOBase):
+    """
+    Compress the written bytes as a sequence of independent frames (gzip members, zstd frames) of about `frame_size`
+    uncompressed bytes, cut at line ends so that every frame holds whole JSONL records and can be decompressed on its own.
+    Concatenated frames are still a valid stream for the usual readers, appending to a file adds frames.
+    """
+
+    def __init__(self, file, compress: Callable[[bytes], bytes], frame_size: int = FRAME_SIZE):
+        self._file = file
+        self._compress = compress
+        self._frame_size = frame_size
+        self._buffer = bytearray()
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, data) -> int:
+        self._buffer += data
+        if len(self._buffer) >= self._frame_size:
+            end = self._buffer.rfind(b"\n") + 1
+            if end > 0:
+                self._file.write(self._compress(bytes(self._buffer[:end])))
+                del self._buffer[:end]
+        return len(data)
+
+    def close(self):
+        if not self.closed:
+            if self._buffer:
+                self._file.write(self._compress(bytes(self._buffer)))
+                self._buffer.clear()
+            self._file.close()
+        super().close()
+
+
+def open_file(path: Union[Path, str], mode: str = "r", encoding: str = "utf-8", level: Optional[int] = None, frame_size: int = FRAME_SIZE):
+    """
+    `open` for dataset files, `.gz` and `.zst` paths are decompressed when read and compressed by frames when written
+    (modes `r`, `w`, `a`, text or binary).
+    """
+    compression = compression_of(path)
+    if compression is None:
+        return open(path, mode, encoding=None if "b" in mode else encoding)
+
+    binary_mode = mode.replace("t", "").replace("b", "")
+    if binary_mode == "r":
+        raw = open(path, "rb")
+        if compression == "gzip":
+            stream = gzip.GzipFile(fileobj=raw, mode="rb")
+        else:
+            stream = _zstandard().ZstdDecompressor().stream_reader(raw, read_across_frames=True, closefd=True)
+        stream = io.BufferedReader(stream) if compression == "zstd" else stream
+    elif binary_mode in ("w", "a"):
+        stream = io.BufferedWriter(FrameWriter(open(path, binary_mode + "b"), _compressor(compression, level), frame_size))
+    else:
+        raise ValueError(f"Unsupported mode {mode} for compressed file {path}")
+
+    if "b" in mode:
+        return stream
+    return io.TextIOWrapper(stream, encoding=encoding)
+
+
+def decompress(data: bytes, path: Union[Path, str]) -> bytes:
+    """Decompress the raw content of `path` according to its extension, every frame of the stream is read"""
+    compression = compression_of(path)
+    if compression == "gzip":
+        return gzip.decompress(data)
+    if compression == "zstd":
+        with _zstandard().ZstdDecompressor().stream_reader(io.BytesIO(data), read_across_frames=True) as reader:
+            return reader.read()
+    return data
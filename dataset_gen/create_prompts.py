@@ -1,6 +1,12 @@
 from __future__ import annotations
+import ast
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
 import itertools
-from typing import List, Optional
+import re
+import threading
+import time
+from typing import List, Optional, Protocol
 from pydantic import BaseModel
 import random
 import pandas as pd
@@ -8,7 +14,7 @@ import numpy as np
 import openai
 import os
 import json
-from rich.progress import track
+from rich.progress import Progress, TimeElapsedColumn, track
 
 
 class Topic(BaseModel):
@@ -58,24 +64,97 @@ def create_prompt_query(topic_1: Topic, topic_2: Topic, profession: str) -> str:
     return query
 
 
-def create_subtopics(topic: Topic, n: int, retries: int = 10) -> List[Topic]:
+class ChatBackend(Protocol):
+    name: str  # part of the expansion cache key, replies of different backends are not mixed
+
+    def complete(self, query: str) -> str:
+        ...
+
+
+class OpenAIChat:
+    def __init__(self, model: str = "gpt-4", temperature: float = 1.5):
+        self.model = model
+        self.temperature = temperature
+
+    @property
+    def name(self) -> str:
+        return f"openai/{self.model}"
+
+    def complete(self, query: str) -> str:
+        completion = openai.ChatCompletion.create(
+            model=self.model,
+            messages=[
+                {"role": "system", "content": "You are a helpful assistant."},
+                {"role": "user", "content": query},
+            ],
+            temperature=self.temperature,
+        )
+        return completion.choices[0].message["content"]
+
+
+class MonkeyChat:
+    """
+    A local chat backend answering subtopic queries with made-up titles, for debugging and tests
+    """
+
+    name = "monkey"
+
+    def __init__(self, speed: float = 0.0):
+        self.speed = speed
+
+    def complete(self, query: str) -> str:
+        match = re.search(r"give me (\d+) subtopics of (.*), formatted", query)
+        n, topic = int(match.group(1)), match.group(2).strip()
+        if self.speed > 0:
+            time.sleep(random.random() * self.speed)
+        return str([f"{topic} {i}" for i in range(n)])
+
+
+class RateLimiter:
+    """Space the calls of all the threads sharing it to at most `rate` per second"""
+
+    def __init__(self, rate: float):
+        self.interval = 1 / rate if rate > 0 else 0.0
+        self._lock = threading.Lock()
+        self._next = time.monotonic()
+
+    def acquire(self):
+        with self._lock:
+            now = time.monotonic()
+            wait = self._next - now
+            self._next = max(now, self._next) + self.interval
+        if wait > 0:
+            time.sleep(wait)
+
+
+def parse_subtopics(content: str) -> List[str]:
+    """Read the Python list of titles in a reply, the list may be surrounded by text or a code fence"""
+    start, end = content.find("["), content.rfind("]")
+    if start < 0 or end < start:
+        raise ValueError(f"no list in reply: {content}")
+    titles = ast.literal_eval(content[start:end + 1])
+    if not isinstance(titles, list) or not all(isinstance(t, str) for t in titles):
+        raise ValueError(f"not a list of titles: {content}")
+    return titles
+
+
+def create_subtopics(
+    topic: Topic,
+    n: int,
+    retries: int = 10,
+    backend: Optional[ChatBackend] = None,
+    rate_limiter: Optional[RateLimiter] = None,
+) -> List[Topic]:
     success = False
     query = create_subtopic_query(topic.topic, n)
-    print(query)
+    backend = backend or OpenAIChat()
     for i in range(retries):
         try:
-            completion = openai.ChatCompletion.create(
-                model="gpt-4",
-                messages=[
-                    {"role": "system", "content": "You are a helpful assistant."},
-                    {"role": "user", "content": query},
-                ],
-                temperature=1.5,
-            )
-
+            if rate_limiter is not None:
+                rate_limiter.acquire()
             result = [
                 Topic(topic=i, mixing=topic.mixing, parent=topic)
-                for i in eval(completion.choices[0].message["content"])
+                for i in parse_subtopics(backend.complete(query))
             ]
             success = True
         except Exception:
@@ -89,6 +168,115 @@ def create_subtopics(topic: Topic, n: int, retries: int = 10) -> List[Topic]:
         return []
 
 
+def _expansion_cache_path(cache_dir: str, topic: Topic, n: int, backend: ChatBackend) -> str:
+    key = json.dumps([backend.name, topic.dict(), n])
+    return os.path.join(cache_dir, hashlib.md5(key.encode("utf-8")).hexdigest() + ".json")
+
+
+def expand_topic(
+    topic: Topic,
+    n: int,
+    backend: ChatBackend,
+    cache_dir: Optional[str] = None,
+    rate_limiter: Optional[RateLimiter] = None,
+    retries: int = 10,
+) -> List[Topic]:
+    """Subtopics of a node, read from the on-disk cache when this node was already expanded"""
+    cache_path = _expansion_cache_path(cache_dir, topic, n, backend) if cache_dir else None
+    if cache_path and os.path.exists(cache_path):
+        with open(cache_path, "r") as f:
+            return [Topic(topic=t, mixing=topic.mixing, parent=topic) for t in json.load(f)]
+
+    subtopics = create_subtopics(topic, n, retries=retries, backend=backend, rate_limiter=rate_limiter)
+    if cache_path and subtopics:
+        tmp_path = cache_path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump([t.topic for t in subtopics], f)
+        os.replace(tmp_path, cache_path)
+    return subtopics
+
+
+def expand_topics(
+    topics: List[Topic],
+    n: int,
+    backend: ChatBackend,
+    cache_dir: Optional[str] = None,
+    workers: int = 8,
+    rate_limiter: Optional[RateLimiter] = None,
+    retries: int = 10,
+) -> List[List[Topic]]:
+    """Expand the nodes concurrently, results are in the order of `topics`"""
+    if cache_dir and not os.path.exists(cache_dir):
+        os.makedirs(cache_dir)
+
+    with Progress(
+        *Progress.get_default_columns(),
+        "•",
+        TimeElapsedColumn(),
+    ) as progress:
+        progress_task = progress.add_task("[red]Expanding...", total=len(topics))
+
+        def expand(topic: Topic) -> List[Topic]:
+            subtopics = expand_topic(topic, n, backend, cache_dir, rate_limiter, retries)
+            progress.update(progress_task, advance=1)
+            return subtopics
+
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            return list(executor.map(expand, topics))
+
+
+def load_base_topics(topics_path: str) -> List[Topic]:
+    """Topics of the csv marked for use, as children of the Python root"""
+    topics = pd.read_csv(topics_path)
+    topics = topics.fillna(0)
+    topics = topics.iloc[:, :3]
+    topics.Topic = topics.Topic.str.split(".").str[1]
+    topics.Use = topics.Use.astype(int)
+    topics.Mixing = topics.Mixing.astype(int)
+    topics_df = topics[topics.Use == 1].reset_index(drop=True)
+    topics_df = topics_df.drop("Use", axis=1)
+
+    root = Topic(topic="Python", mixing=1)
+    return [
+        Topic(topic=top, mixing=mix, parent=root)
+        for (top, mix) in zip(topics_df.Topic, topics_df.Mixing)
+    ]
+
+
+def build_tree(
+    topics_path: str,
+    output_dir: str,
+    backend: ChatBackend,
+    cache_dir: Optional[str] = None,
+    n_base_topics: int = 0,
+    n_subtopics: int = 10,
+    n_subsubtopics: int = 5,
+    workers: int = 8,
+    requests_per_second: float = 1.0,
+) -> List[Topic]:
+    """
+    Expand the base topics into subtopics then sub-subtopics and write `subtopics.json` and `subsubtopics.json`.
+    Every node expansion is cached in `cache_dir`, so an interrupted run resumes where it stopped.
+    """
+    rate_limiter = RateLimiter(requests_per_second)
+    os.makedirs(output_dir, exist_ok=True)
+    base_topics = load_base_topics(topics_path)
+    if n_base_topics > 0:
+        base_topics = base_topics[:n_base_topics]
+
+    subtopics = expand_topics(base_topics, n_subtopics, backend, cache_dir, workers, rate_limiter)
+    subtopics_list = list(itertools.chain(*subtopics))
+    with open(os.path.join(output_dir, "subtopics.json"), "w") as outfile:
+        outfile.write(json.dumps([x.dict() for x in subtopics_list]))
+
+    subsubtopics = expand_topics(subtopics_list, n_subsubtopics, backend, cache_dir, workers, rate_limiter)
+    subsubtopics_list = list(itertools.chain(*subsubtopics))
+    with open(os.path.join(output_dir, "subsubtopics.json"), "w") as outfile:
+        outfile.write(json.dumps([x.dict() for x in subsubtopics_list]))
+
+    return subsubtopics_list
+
+
 def create_prompts(
     topic: Topic,
     combination_options: List[Topic],
@@ -99,8 +287,8 @@ def create_prompts(
     prompts: List[Query] = []
 
     for loc_topic in combination_options:
-        # if len(prompts) == n:
-        #     break
+        if len(prompts) == n:
+            break
 
         if loc_topic.mixing and loc_topic.parent != topic.parent and loc_topic.topic != topic.topic:
             profession = professions[np.random.randint(0, len(professions))]
@@ -110,68 +298,94 @@ def create_prompts(
     return prompts
 
 
-if __name__ == "__main__":
-    # Load list of topics
-    API_KEY = os.environ["OPENAI_API_KEY"]
-    TOPICS_PATH = "tree/topics.csv"
-    openai.api_key = API_KEY
-
-    topics = pd.read_csv(TOPICS_PATH)
-    topics = topics.fillna(0)
-    topics = topics.iloc[:, :3]
-    topics.Topic = topics.Topic.str.split(".").str[1]
-    topics.Use = topics.Use.astype(int)
-    topics.Mixing = topics.Mixing.astype(int)
-    topics_df = topics[topics.Use == 1].reset_index(drop=True)
-    topics_df = topics_df.drop("Use", axis=1)
-    topics_list = list(zip(topics_df.Topic, topics_df.Mixing))
-
-    # Debug mode to create few prompts
-    DEBUG = True
-    if DEBUG:
-        n_base_topics = 5
-        n_combinations = 2
-    else:
-        n_base_topics = len(topics_df)
-        n_combinations = 200
-
-    root = Topic(topic="Python", mixing=1)
-    base_topics = [
-        Topic(topic=top, mixing=mix, parent=root)
-        for (top, mix) in zip(topics_df.Topic, topics_df.Mixing)
-    ]
-    subtopics = [create_subtopics(t, 10) for t in base_topics[:n_base_topics]]
-    subtopics_list = list(itertools.chain(*subtopics))
-    subtopics_json = json.dumps([x.dict() for x in subtopics_list])
-
-    with open("tree/subtopics.json", "w") as outfile:
-        outfile.write(subtopics_json)
+def _parent_key(topic: Topic) -> tuple:
+    """Hashable identity of the parent chain, two topics share a parent iff their keys are equal"""
+    key = []
+    parent = topic.parent
+    while parent is not None:
+        key.append((parent.topic, parent.mixing))
+        parent = parent.parent
+    return tuple(key)
 
-    subsubtopics: List[List[Topic]] = [
-        create_subtopics(t, 5)
-        for t in track(itertools.chain(*subtopics), description="Processing...")
-    ]
-    subsubtopics_list = list(itertools.chain(*subsubtopics))
-    subsubtopics_json: str = json.dumps([x.dict() for x in subsubtopics_list])
 
-    with open("tree/subsubtopics.json", "w") as outfile:
-        outfile.write(subsubtopics_json)
+class PairSampler:
+    """
+    Draw the topic pairs of the prompts. A pair (topic, other) is valid when `other` is a mixing topic,
+    has another parent than `topic` and another title.
+    The mixing leaves are indexed by parent once, so drawing `n` pairs for a topic costs O(n) instead of a scan of all the leaves.
+    """
 
-    with open("tree/professions.json", "r") as openfile:
-        # Reading from json file
-        professions = list(json.load(openfile))
+    def __init__(self, leaves: List[Topic], seed: Optional[int] = None):
+        self.leaves = leaves
+        self.rng = np.random.default_rng(seed)
+        parent_ids = {}
+        self._groups = np.array([parent_ids.setdefault(_parent_key(t), len(parent_ids)) for t in leaves], dtype=np.int64)
+        self._titles = np.array([t.topic for t in leaves], dtype=object)
+
+        mixing = np.flatnonzero(np.array([bool(t.mixing) for t in leaves], dtype=bool))
+        # mixing leaves sorted by parent: the leaves sharing a parent are a contiguous slice of the pool
+        self._pool = mixing[np.argsort(self._groups[mixing], kind="stable")]
+        pool_groups = self._groups[self._pool]
+        group_ids = np.arange(len(parent_ids))
+        self._start = np.searchsorted(pool_groups, group_ids, side="left")
+        self._end = np.searchsorted(pool_groups, group_ids, side="right")
+
+    def sample(self, index: int, n: int) -> np.ndarray:
+        """Indices of up to `n` distinct leaves forming a valid pair with `leaves[index]`"""
+        group = self._groups[index]
+        start, end = self._start[group], self._end[group]
+        available = len(self._pool) - (end - start)
+        k = min(n, available)
+        if k <= 0:
+            return np.empty(0, dtype=np.int64)
+        # draw positions in the pool without the slice of the topic's parent, then shift them over the slice
+        positions = self.rng.choice(available, size=k, replace=False)
+        positions = positions + (positions >= start) * (end - start)
+        picked = self._pool[positions]
+        valid = picked[self._titles[picked] != self._titles[index]]
+        if len(valid) < k:
+            # a topic with the same title under another parent, redraw among all the valid leaves
+            mask = np.ones(len(self._pool), dtype=bool)
+            mask[start:end] = False
+            mask &= self._titles[self._pool] != self._titles[index]
+            remaining = np.setdiff1d(self._pool[mask], valid)
+            extra = self.rng.choice(remaining, size=min(k - len(valid), len(remaining)), replace=False)
+            valid = np.concatenate([valid, extra])
+        return valid
+
+    def draw_pairs(self, professions: List[str], n: int) -> List[tuple]:
+        """(topic index, other topic index, profession index) triples, `n` per leaf (fewer when there are not enough valid pairs)"""
+        pairs = [(i, self.sample(i, n)) for i in range(len(self.leaves))]
+        total = sum(len(others) for _, others in pairs)
+        profession_ids = self.rng.integers(0, len(professions), size=total)
+
+        triples = []
+        offset = 0
+        for i, others in pairs:
+            for j, p in zip(others, profession_ids[offset:offset + len(others)]):
+                triples.append((i, int(j), int(p)))
+            offset += len(others)
+        return triples
+
+    def create_prompts(self, professions: List[str], n: int) -> List[Query]:
+        """`n` prompts per leaf, professions are drawn in bulk"""
+        prompts: List[Query] = []
+        for i, j, p in self.draw_pairs(professions, n):
+            topic, loc_topic = self.leaves[i], self.leaves[j]
+            query = create_prompt_query(topic, loc_topic, professions[p])
+            prompts.append(Query(query=query, topic_1=topic, topic_2=loc_topic))
+        return prompts
 
-    prompts: List[List[Query]] = [
-        create_prompts(
-            i,
-            combination_options=subsubtopics_list,
-            professions=professions,
-            n=n_combinations,
-        )
-        for i in track(itertools.chain(*subsubtopics), description="Processing...")
-    ]
+if __name__ == "__main__":
+    # Expand the topic tree, prompts are then created with `python generate.py prompts`
+    openai.api_key = os.environ["OPENAI_API_KEY"]
 
-    prompts_list = list(itertools.chain(*prompts))
-    prompts_json = json.dumps([p.dict() for p in prompts_list])
-    with open("tree/prompts.json", "w") as outfile:
-        outfile.write(prompts_json)
\ No newline at end of file
+    # Debug mode to expand few topics
+    DEBUG = True
+    build_tree(
+        "tree/topics.csv",
+        "tree",
+        OpenAIChat(),
+        cache_dir="tree/cache",
+        n_base_topics=5 if DEBUG else 0,
+    )
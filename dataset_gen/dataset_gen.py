@@ -1,25 +1,34 @@
 
 
+import ast
 from concurrent.futures import ThreadPoolExecutor
 import hashlib
 import json
+import logging
 import os
 from pathlib import Path
 import random
+import re
 import threading
 import time
-from typing import Callable, List, Protocol
+from typing import Callable, Iterable, List, Optional, Protocol
 from openai import OpenAIError
 from pydantic import BaseModel
 
-from dataset_gen.create_prompts import Topic, Query
+from dataset_gen.create_prompts import Topic
+from dataset_gen.columnar import is_parquet, iter_records
+from dataset_gen.compression import extension, open_file
+from dataset_gen.prompt_set import load_topic_table
 from rich.progress import (
     Progress,
     TimeElapsedColumn,
     TextColumn,
 )
 
-from falcon.TextGenerationInference import TGI, GenerateParameters, GenerateRequest
+from falcon.TextGenerationInference import TGI, GenerateParameters, GenerateRequest, HedgePolicy
+from falcon.metrics import MetricsRecorder, TokenBudget
+
+logger = logging.getLogger(__name__)
 
 class Exercise(BaseModel):
     exercise_id: str
@@ -75,10 +84,11 @@ class MonkeyGenerator:
             time.sleep(seed / 100 * self.speed)
         # if not (seed % 50):
         #     raise GenerationError("Monkey failed")
+        # distinct functions per prompt, that pass the exercise filter
+        name = "gorilla_" + hashlib.md5(prompt.encode("utf-8")).hexdigest()[:8]
         return Result(
             prompt=prompt,
-            output='def gorilla(): """Empty function for a gorilla"""\n    return 0'
-            * self.n_functions,
+            output="".join(f'def {name}_{i}():\n    """Empty function for a gorilla"""\n    return 0\n\n' for i in range(self.n_functions)),
         )
 
     def generate_solutions(self, exercise: Exercise, n_solutions: int) -> ExerciseSolutions:
@@ -100,18 +110,37 @@ class FalconGenerator:
     def __init__(
         self,
         endpoint: str = "40B-code-exercises-2024-03-07-07-30-02",
-        region: str = "us-west-2"
+        region: str = "us-west-2",
+        model: TGI | None = None,
+        hedge: HedgePolicy | None = None,
+        observers: list | None = None,
+        budget: TokenBudget | None = None,
     ):
         self.endpoint = endpoint
         self.region = region
+        self.model = model
+        self.hedge = hedge
+        self.observers = observers
+        self.budget = budget
+
+    def _get_model(self) -> TGI:
+        """A shared model (e.g. a `BalancedTGI` over several endpoints) takes precedence over endpoint/region"""
+        if self.model is not None:
+            return self.model
+        return TGI(endpoint_name=self.endpoint, region_name=self.region, hedge=self.hedge, observers=self.observers)
+
+    def _max_new_tokens(self, kind: str) -> int:
+        if self.budget is None:
+            return 512
+        return self.budget.max_new_tokens(kind)
 
     def generate(self, prompt: str) -> Result:
-        model = TGI(endpoint_name=self.endpoint, region_name=self.region)
+        model = self._get_model()
         # stop_words = ["\nclass", "\ndef", "\n#", "\n@", "\nprint", "\nif", "\n```"]
         stop_words = ["\ndef", "\n#", "\n```"]
         # stop_regex = re.compile("|".join(map(re.escape, stop_words)))
 
-        params = GenerateParameters( max_new_tokens=512, 
+        params = GenerateParameters( max_new_tokens=self._max_new_tokens("exercise"), 
                             temperature=1, 
                             stop =stop_words, 
                             top_p = 0.95,
@@ -119,9 +148,8 @@ class FalconGenerator:
                             )
 
         req = GenerateRequest(prompt + "\ndef", params)
-        _outputs = model.sm_query(req)
-        print(prompt + "\n")
-        print(f"completion: \n{_outputs[0]['generated_text']}")
+        _outputs = model.sm_query(req, "exercise")
+        logger.debug("prompt: %s\ncompletion: %s", prompt, _outputs[0]["generated_text"])
 
         result = Result(
             prompt=prompt, output= "def" + _outputs[0]["generated_text"]
@@ -130,10 +158,10 @@ class FalconGenerator:
         return result
     
     def generate_solutions(self, exercise: Exercise, n_solutions: int) -> ExerciseSolutions:
-        model = TGI(endpoint_name=self.endpoint, region_name=self.region)
+        model = self._get_model()
         stop_words = ["\ndef", "\n#", "\n```"]
         params = GenerateParameters( 
-                            max_new_tokens=512, 
+                            max_new_tokens=self._max_new_tokens("solution"), 
                             temperature=1, 
                             stop =stop_words, 
                             top_p = 0.95,
@@ -142,7 +170,7 @@ class FalconGenerator:
                             )
         
         requests = [GenerateRequest(exercise.problem, params) for i in range(n_solutions)]
-        results = model.create_from_objects(requests)
+        results = model.create_from_objects(requests, "solution")
         
         return ExerciseSolutions(
             exercise_id=exercise.exercise_id,
@@ -153,10 +181,10 @@ class FalconGenerator:
     def generate_tests(self, exercise: Exercise, n_tests) -> ExerciseTests:
         entry_point = get_function_name(exercise.problem)
         
-        model = TGI(endpoint_name=self.endpoint, region_name=self.region)
+        model = self._get_model()
         stop_words = ["\ndef", "\n#", "\n```"]
         params = GenerateParameters( 
-                            max_new_tokens=512, 
+                            max_new_tokens=self._max_new_tokens("test"), 
                             temperature=1, 
                             stop =stop_words, 
                             top_p = 0.95,
@@ -165,7 +193,7 @@ class FalconGenerator:
                             )
         problem=f"{exercise.problem}\n    pass\n\n# check the correctness of {entry_point}\nassert "
         requests = [GenerateRequest(problem, params) for i in range(n_tests)]
-        results = model.create_from_objects(requests)
+        results = model.create_from_objects(requests, "test")
         
         return ExerciseTests(
             exercise_id=exercise.exercise_id,
@@ -174,8 +202,12 @@ class FalconGenerator:
         )
         
 
+_FUNCTION_NAME = re.compile(r"^\s*def\s+(\w+)\s*\(", re.MULTILINE)
+
 def get_function_name(problem: str):
-    return problem.split("def")[1].split('(')[0].strip()
+    """Name of the first function defined by the problem, "" when there is none"""
+    match = _FUNCTION_NAME.search(problem)
+    return match.group(1) if match else ""
 
 def mass_solutions_generation(
     exercises: List[Exercise],
@@ -184,6 +216,8 @@ def mass_solutions_generation(
     pool_size: int = 10,
     retries: int = 10,
     n_solutions: int = 5,
+    metrics: MetricsRecorder | None = None,
+    compression: str = "",
 ):      
     with Progress(
         *Progress.get_default_columns(),
@@ -214,6 +248,8 @@ def mass_solutions_generation(
                         update_progress,
                         save_dir,
                         retries,
+                        metrics,
+                        compression,
                     )
                 )
 
@@ -230,8 +266,10 @@ def _solutions_generation_wrapper(
     update_progress: Callable,
     save_dir: str,
     retries: int,
+    metrics: MetricsRecorder | None = None,
+    compression: str = "",
 ):
-    file_path = os.path.join(save_dir, exercise.exercise_id + ".jsonl")
+    file_path = os.path.join(save_dir, exercise.exercise_id + ".jsonl" + extension(compression))
 
     if os.path.exists(file_path):  # we don't regenerate each query
         print(f"skip {file_path} generation because it already exist ")
@@ -239,7 +277,9 @@ def _solutions_generation_wrapper(
 
     generator = get_generator()
 
-    result = solutions_generation(exercise, n_solutions, generator, update_progress, retries)
+    result = solutions_generation(exercise, n_solutions, generator, update_progress, retries, metrics)
+    if metrics is not None and isinstance(result, ExerciseSolutions):
+        metrics.record_accepted("solution", len(result.solutions))
 
     write_solutions_to_jsonl(file_path, result)
     
@@ -249,6 +289,7 @@ def solutions_generation(
     generator: Generator,
     update_progress: Callable,
     retries: int,
+    metrics: MetricsRecorder | None = None,
 ) -> ExerciseSolutions:
     success = False
     time.sleep(random.random())
@@ -258,6 +299,8 @@ def solutions_generation(
             success = True
         except GenerationError:
             print(f"Generation failed for exercise {exercise}, retrying {i + 1}/{retries}")
+            if metrics is not None:
+                metrics.record_retry("solution")
             time.sleep(1)
         else:
             break
@@ -276,6 +319,8 @@ def mass_tests_generation(
     pool_size: int = 10,
     retries: int = 10,
     n_solutions: int = 5,
+    metrics: MetricsRecorder | None = None,
+    compression: str = "",
 ):      
     with Progress(
         *Progress.get_default_columns(),
@@ -306,6 +351,8 @@ def mass_tests_generation(
                         update_progress,
                         save_dir,
                         retries,
+                        metrics,
+                        compression,
                     )
                 )
 
@@ -322,8 +369,10 @@ def _tests_generation_wrapper(
     update_progress: Callable,
     save_dir: str,
     retries: int,
+    metrics: MetricsRecorder | None = None,
+    compression: str = "",
 ):
-    file_path = os.path.join(save_dir, exercise.exercise_id + ".jsonl")
+    file_path = os.path.join(save_dir, exercise.exercise_id + ".jsonl" + extension(compression))
 
     if os.path.exists(file_path):  # we don't regenerate each query
         print(f"skip {file_path} generation because it already exist ")
@@ -331,7 +380,9 @@ def _tests_generation_wrapper(
 
     generator = get_generator()
 
-    result = tests_generation(exercise, n_solutions, generator, update_progress, retries)
+    result = tests_generation(exercise, n_solutions, generator, update_progress, retries, metrics)
+    if metrics is not None and isinstance(result, ExerciseTests):
+        metrics.record_accepted("test", len(result.tests))
 
     write_tests_to_jsonl(file_path, result)
     
@@ -341,6 +392,7 @@ def tests_generation(
     generator: Generator,
     update_progress: Callable,
     retries: int,
+    metrics: MetricsRecorder | None = None,
 ) -> ExerciseSolutions:
     success = False
     time.sleep(random.random())
@@ -350,6 +402,8 @@ def tests_generation(
             success = True
         except GenerationError:
             print(f"Generation failed for exercise {exercise}, retrying {i + 1}/{retries}")
+            if metrics is not None:
+                metrics.record_retry("test")
             time.sleep(1)
         else:
             break
@@ -363,15 +417,22 @@ def tests_generation(
 
 
 def mass_generation(
-    prompts: List[str],
+    prompts: Iterable[str],
     get_generator: Callable[[], Generator],
     save_dir: str,
     pool_size: int = 10,
     retries: int = 10,
+    metrics: MetricsRecorder | None = None,
+    total: Optional[int] = None,
+    compression: str = "",
 ):
     """
-    Generate from a list of prompts. Use a thread pool to parallelize the generation with catch and retry mechanism
+    Generate from a list or a stream of prompts. Use a thread pool to parallelize the generation with catch and retry mechanism.
+    Prompts are pulled from the iterable as workers free up, so a generator is never fully materialized.
+    With `compression` (`gzip` or `zstd`) the generation files are written compressed.
     """
+    if total is None and hasattr(prompts, "__len__"):
+        total = len(prompts)
     with Progress(
         *Progress.get_default_columns(),
         "•",
@@ -380,7 +441,7 @@ def mass_generation(
         with ThreadPoolExecutor(max_workers=pool_size) as executor:
             progress_task = progress.add_task(
                 "[red]Generating...",
-                total=len(prompts),
+                total=total,
             )
 
             def update_progress():
@@ -389,31 +450,34 @@ def mass_generation(
                     advance=1,
                 )
 
-            tasks = []
+            in_flight = threading.BoundedSemaphore(2 * pool_size)
 
-            for prompt in prompts:
-                tasks.append(
-                    executor.submit(
-                        _generation_wrapper,
-                        prompt,
-                        get_generator,
-                        update_progress,
-                        save_dir,
-                        retries,
-                    )
-                )
-
-            for task in tasks:
+            def task_done(task):
+                in_flight.release()
                 try:
                     task.result()
                 except Exception as e:
                     print(e)
 
+            for prompt in prompts:
+                in_flight.acquire()
+                executor.submit(
+                    _generation_wrapper,
+                    prompt,
+                    get_generator,
+                    update_progress,
+                    save_dir,
+                    retries,
+                    metrics,
+                    compression,
+                ).add_done_callback(task_done)
+
 def generation(
     prompt: str,
     generator: Generator,
     update_progress: Callable,
     retries: int,
+    metrics: MetricsRecorder | None = None,
 ) -> List[Exercise]:
     success = False
     time.sleep(random.random())
@@ -423,6 +487,8 @@ def generation(
             success = True
         except GenerationError:
             print(f"Generation failed for prompt {prompt}, retrying {i + 1}/{retries}")
+            if metrics is not None:
+                metrics.record_retry("exercise")
             time.sleep(1)
         else:
             break
@@ -443,12 +509,14 @@ def _generation_wrapper(
     update_progress: Callable,
     save_dir: str,
     retries: int,
+    metrics: MetricsRecorder | None = None,
+    compression: str = "",
 ):
     file_path_sum = hashlib.md5(prompt.encode("utf-8")).hexdigest()
 
     dir_path, file_path = file_path_sum[:4], file_path_sum[4:]
     dir_path = os.path.join(save_dir, dir_path)
-    file_path = os.path.join(dir_path, file_path + ".jsonl")
+    file_path = os.path.join(dir_path, file_path + ".jsonl" + extension(compression))
 
     if not os.path.exists(dir_path):
         os.makedirs(dir_path)
@@ -459,22 +527,20 @@ def _generation_wrapper(
 
     generator = get_generator()
 
-    results = generation(prompt, generator, update_progress, retries)
+    results = generation(prompt, generator, update_progress, retries, metrics)
+    if metrics is not None:
+        metrics.record_accepted("exercise", len([r for r in results if r.exercise_id]))
 
     write_results_to_jsonl(file_path, results)
                     
 def load_leaves(file: str) -> List[Topic]:
-    with open(file, "r") as f:
+    if file.endswith(".jsonl"):  # compact topic table
+        return load_topic_table(file).leaves()
+    with open_file(file, "r") as f:
         lines = json.load(f)
     topics = [Topic.parse_obj(line) for line in lines]
     return topics
 
-def load_prompts(file: str) -> List[Query]:
-    with open(file, "r") as f:
-        lines = json.load(f)
-    prompts = [Query.parse_obj(line) for line in lines]
-    return prompts
-
 def generator_to_exercises(output: str) -> List[Exercise]:
     exercises = split_exercises(output)
     exercises = [i for i in exercises if check_exercise(i)]
@@ -500,7 +566,15 @@ def split_exercises(output: str) -> List[str]:
     return ["def" + i for i in output.split("def")[1:]]
 
 
-def check_exercise(exercise: str) -> bool:
+def check_exercise(exercise: str, tree: Optional[ast.Module] = None) -> bool:
+    """The exercise must return or print something. With the parsed `tree` of the exercise, return statements and print calls are looked up in the code rather than in the text"""
+    if tree is not None:
+        for node in ast.walk(tree):
+            if isinstance(node, ast.Return) and node.value is not None:
+                return True
+            if isinstance(node, ast.Call) and isinstance(node.func, ast.Name) and node.func.id == "print":
+                return True
+        return False
     try:
         if (
             "return" not in exercise.split('"""')[2]
@@ -513,22 +587,24 @@ def check_exercise(exercise: str) -> bool:
         return False
 
 def write_results_to_jsonl(file_path: str, results: List[Exercise|ExerciseSolutions|ExerciseTests]):
-    with open(file_path, "w") as file:
+    with open_file(file_path, "w") as file:
         for item in results:
             json.dump(item.dict(), file)
             file.write("\n")
 
 def load_exercises(path: Path) -> List[Exercise]:
-    with open(path, "r") as f:
+    if is_parquet(path):
+        return [Exercise(**record) for record in iter_records(path)]
+    with open_file(path, "r") as f:
         lines = f.readlines()
     return [Exercise.parse_raw(line) for line in lines]
 
 def write_solutions_to_jsonl(file_path: str, result: ExerciseSolutions):
-    with open(file_path, "w") as file:
+    with open_file(file_path, "w") as file:
         json.dump(result.dict(), file)
         file.write("\n")
         
 def write_tests_to_jsonl(file_path: str, result: ExerciseTests):
-    with open(file_path, "w") as file:
+    with open_file(file_path, "w") as file:
         json.dump(result.dict(), file)
         file.write("\n")
\ No newline at end of file
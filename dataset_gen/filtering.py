@@ -1,145 +1,314 @@
+import ast
+from collections import Counter, deque
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
 import json
-from typing import List, Union
+from typing import Callable, Dict, Iterable, Iterator, List, NamedTuple, Optional, Union
 import os
 from pathlib import Path
 
-from dataset_gen.dataset_gen import Exercise, ExerciseSolutions, ExerciseTests
-
-def read_jsonl(file_path):
-    with open(file_path, 'r') as file:
-        return {json.loads(line)['exercise_id']: json.loads(line) for line in file}
-
-def merge_dicts(dict1, dict2):
-    """ Merge dictionaries based on shared keys (id). """
-    merged_dict = {}
-    for key in dict1:
-        if key in dict2:  # Check if the key exists in both dictionaries
-            # Create a new entry with merged data from both dictionaries
-            merged_entry = dict1[key].copy()  # Start with the first dict's data
-            merged_entry.update(dict2[key])  # Update with the second dict's data
-            merged_dict[key] = merged_entry
-    return merged_dict
-
-def write_jsonl(data, file_path):
-    with open(file_path, 'w') as file:
-        for item in data.values():
-            file.write(json.dumps(item) + '\n')
-            
-def load_solutions_with_tests(file_path):
-    with open(file_path, 'r') as file:
-        return [json.loads(line) for line in file]
-
-def load_one_file(path: Union[Path, str]) -> List[Exercise]:
-    with open(path, "r") as f:
-        lines = f.readlines()
-    return [Exercise.parse_raw(line) for line in lines]
-
-
-def load_all_exo(path: Union[Path, str]) -> List[Exercise]:
-    if isinstance(path, str):
-        path = Path(path)
-    exos: List[Exercise] = []
-    for sub_dir in os.listdir(path):
-        for fn in os.listdir(path / sub_dir):
-            exos += load_one_file(path / sub_dir / fn)
-    return exos
+from dataset_gen.columnar import iter_records
+from dataset_gen.compression import open_file
+from dataset_gen.dataset_gen import Exercise, ExerciseSolutions, ExerciseTests, check_exercise, get_function_name
+from dataset_gen.manifest import FileEntry, FileTask, FilterManifest, read_task
+from dataset_gen.near_dedup import MinHasher, MinHashLSH, near_dedup_samples
 
-def load_all_solutions(path: Union[Path, str]) -> List[ExerciseSolutions]:
+def load_solutions_with_tests(file_path, columns: Optional[List[str]] = None, row_groups: Optional[List[int]] = None):
+    """Records of a JSONL or Parquet dataset, only the requested columns (and row groups) are read from Parquet"""
+    return list(iter_records(file_path, columns, row_groups))
+
+def exo_files(path: Union[Path, str]) -> List[Path]:
+    """Generation files of the `generate` command, stored in sub directories"""
     if isinstance(path, str):
         path = Path(path)
-    solutions: List[ExerciseSolutions] = []
-    for file in os.listdir(path):
-        with open(path / file, "r") as f:
-            lines = f.readlines()
-
-        sls = [ExerciseSolutions.parse_raw(line) for line in lines]
-        for s in sls:
-            good_samples = []
-            for sample in s.solutions:
-                if filter_syntax_check(s.problem + sample):
-                    good_samples.append(sample)
-            if len(good_samples) > 0:
-                s.solutions = good_samples
-                solutions.append(s)
-    
-    return solutions
+    return [path / sub_dir / fn for sub_dir in sorted(os.listdir(path)) for fn in sorted(os.listdir(path / sub_dir))]
 
-def load_all_tests(path: Union[Path, str]) -> List[ExerciseTests]:
+
+def sample_files(path: Union[Path, str]) -> List[Path]:
+    """Generation files of the `solutions` and `tests` commands"""
     if isinstance(path, str):
         path = Path(path)
-    cases: List[ExerciseTests] = []
-    for file in os.listdir(path):
-        with open(path / file, "r") as f:
-            lines = f.readlines()
-
-        sls = [ExerciseTests.parse_raw(line) for line in lines]
-        for s in sls:
-            good_samples = []
-            for sample in s.tests:
-                if filter_syntax_check(s.problem + sample):
-                    good_samples.append(sample)
+    return [path / fn for fn in sorted(os.listdir(path))]
+
+
+def _chunks(items: List, size: int) -> Iterator[List]:
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
+def _imap_bounded(fn: Callable, items: Iterable, workers: int, max_in_flight: int) -> Iterator:
+    """Ordered map over a process pool with at most `max_in_flight` pending results, inline when `workers` <= 1"""
+    if workers <= 1:
+        yield from map(fn, items)
+        return
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        pending = deque()
+        for item in items:
+            pending.append(executor.submit(fn, item))
+            if len(pending) >= max_in_flight:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+class SyntaxCheck(NamedTuple):
+    tree: Optional[ast.Module]
+    error_type: Optional[str] = None
+    lineno: Optional[int] = None
+    message: Optional[str] = None
+
+    @property
+    def ok(self) -> bool:
+        return self.tree is not None
+
+
+def check_syntax(code: str) -> SyntaxCheck:
+    """Parse once, the tree is returned for the checks that follow. Compiling the tree keeps the errors raised past the parser (e.g. return outside function)"""
+    try:
+        tree = ast.parse(code)
+        compile(tree, "<string>", "exec")
+    except (SyntaxError, ValueError) as e:
+        return SyntaxCheck(None, type(e).__name__, getattr(e, "lineno", None), getattr(e, "msg", str(e)))
+    return SyntaxCheck(tree)
+
+
+def defines_function(tree: ast.Module, name: str) -> bool:
+    return any(isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef)) and node.name == name for node in tree.body)
+
+
+class Rejections:
+    """
+    Reasons of the rejected samples, aggregated into counters. When `path` is given (or `keep_samples` for the process pool workers),
+    the samples are also kept with their reason and written to `path` as JSONL.
+    """
+
+    def __init__(self, path: Optional[str] = None, keep_samples: bool = False):
+        self.counts = Counter()
+        self.keep_samples = keep_samples or path is not None
+        self.samples: List[dict] = []
+        self._file = open_file(path, "w") if path else None
+
+    def add(self, reason: str, exercise_id: str, code: str, check: Optional[SyntaxCheck] = None):
+        self.counts[reason] += 1
+        if self.keep_samples:
+            sample = {"exercise_id": exercise_id, "reason": reason, "code": code}
+            if check is not None:
+                sample.update(lineno=check.lineno, message=check.message)
+            self.samples.append(sample)
+            self._flush()
+
+    def merge(self, other: "Rejections"):
+        self.counts.update(other.counts)
+        if self.keep_samples:
+            self.samples += other.samples
+            self._flush()
+
+    def _flush(self):
+        if self._file is not None:
+            for sample in self.samples:
+                self._file.write(json.dumps(sample) + "\n")
+            self.samples = []
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+class _Chunk(NamedTuple):
+    records: List[dict]
+    total: int
+    signatures: Optional[list]
+    rejections: Rejections
+    files: Dict[str, FileEntry]
+
+
+def _filter_exo_chunk(tasks: List[FileTask], hasher: Optional[MinHasher] = None, keep_rejected: bool = False) -> _Chunk:
+    rejections = Rejections(keep_samples=keep_rejected)
+    records = []
+    total = 0
+    files = {}
+    for task in tasks:
+        lines, entry = read_task(task)
+        files[task.key] = entry
+        if lines is None:
+            continue
+        exos = [Exercise.parse_raw(line) for line in lines]
+        total += len(exos)
+        clean_exos = filter_bad_exos(exos, rejections=rejections)
+        remove_extra(clean_exos)
+        records += [exo.dict() for exo in clean_exos]
+        entry.records, entry.kept = len(exos), len(clean_exos)
+    signatures = hasher.signatures([r["problem"] for r in records]) if hasher is not None else None
+    return _Chunk(records, total, signatures, rejections, files)
+
+
+def filter_samples(exercise_id: str, problem: str, samples: List[str], near_dup_threshold: float = 0.0, rejections: Optional[Rejections] = None) -> List[str]:
+    """Samples of an exercise that compile after its problem, near duplicates removed when `near_dup_threshold` > 0"""
+    rejections = rejections if rejections is not None else Rejections()
+    good_samples = []
+    for sample in samples:
+        check = check_syntax(problem + sample)
+        if check.ok:
+            good_samples.append(sample)
+        else:
+            rejections.add(f"syntax: {check.error_type}", exercise_id, problem + sample, check)
+    if near_dup_threshold > 0:
+        good_samples = near_dedup_samples(good_samples, near_dup_threshold)
+    return good_samples
+
+
+def _filter_samples_chunk(tasks: List[FileTask], field: str, near_dup_threshold: float = 0.0, keep_rejected: bool = False) -> _Chunk:
+    model = ExerciseSolutions if field == "solutions" else ExerciseTests
+    rejections = Rejections(keep_samples=keep_rejected)
+    records = []
+    total = 0
+    files = {}
+    for task in tasks:
+        lines, entry = read_task(task)
+        files[task.key] = entry
+        if lines is None:
+            continue
+        for line in lines:
+            s = model.parse_raw(line)
+            entry.records += 1
+            good_samples = filter_samples(s.exercise_id, s.problem, getattr(s, field), near_dup_threshold, rejections)
             if len(good_samples) > 0:
-                s.tests = good_samples
-                cases.append(s)
-    
-    return cases
+                setattr(s, field, good_samples)
+                records.append(s.dict())
+                entry.kept += 1
+        total += entry.records
+    return _Chunk(records, total, None, rejections, files)
+
+
+def _file_tasks(path: Union[Path, str], files: List[Path], manifest: Optional[FilterManifest], counts: Counter) -> List[FileTask]:
+    root = Path(path)
+    if manifest is None:
+        return [FileTask(file, str(file.relative_to(root))) for file in files]
+    tasks = manifest.tasks(root, files)
+    counts["files"] += len(files)
+    counts["files to filter"] += len(tasks)
+    return tasks
+
+
+def _record_files(manifest: Optional[FilterManifest], chunk: _Chunk, counts: Counter):
+    if manifest is None:
+        return
+    counts["unchanged files"] += manifest.update(chunk.files)
+
+
+def iter_filtered_exos(
+    path: Union[Path, str],
+    near_dup_threshold: float = 0.0,
+    workers: int = 1,
+    chunk_size: int = 64,
+    counts: Optional[Counter] = None,
+    rejections: Optional[Rejections] = None,
+    manifest: Optional[FilterManifest] = None,
+) -> Iterator[dict]:
+    """
+    Stream the clean exercises of a generation directory. Files are parsed and filtered by chunks on `workers` processes
+    (with the MinHash signatures when near dedup is on), the exact and near dedup run in order in the calling process.
+    With a `manifest`, only the new or changed files are filtered and the dedup state of the previous runs is reused (and updated).
+    """
+    counts = counts if counts is not None else Counter()
+    lsh = None
+    if near_dup_threshold > 0:
+        lsh = manifest.lsh if manifest is not None and manifest.lsh is not None else MinHashLSH(near_dup_threshold)
+    seen = manifest.seen if manifest is not None else set()
+    if manifest is not None:
+        manifest.lsh = lsh
+    rejections = rejections if rejections is not None else Rejections()
+    worker = partial(_filter_exo_chunk, hasher=lsh.hasher if lsh is not None else None, keep_rejected=rejections.keep_samples)
+    tasks = _file_tasks(path, exo_files(path), manifest, counts)
+    for chunk in _imap_bounded(worker, _chunks(tasks, chunk_size), workers, 4 * workers):
+        rejections.merge(chunk.rejections)
+        counts["all"] += chunk.total
+        counts["after filter"] += len(chunk.records)
+        for i, record in enumerate(chunk.records):
+            if record["exercise_id"] in seen:
+                continue
+            seen.add(record["exercise_id"])
+            counts["after dedup"] += 1
+            if lsh is not None:
+                if lsh.add(chunk.signatures[i]) is not None:
+                    continue
+                counts["after near dedup"] += 1
+            yield record
+        _record_files(manifest, chunk, counts)
+    if lsh is not None:
+        stats = lsh.stats()
+        counts["near dup clusters"] = stats.clusters
+        counts["largest near dup cluster"] = stats.largest_cluster
+        counts["near dup comparisons"] = stats.comparisons
+
+
+def iter_filtered_samples(
+    path: Union[Path, str],
+    field: str,
+    near_dup_threshold: float = 0.0,
+    workers: int = 1,
+    chunk_size: int = 64,
+    counts: Optional[Counter] = None,
+    rejections: Optional[Rejections] = None,
+    manifest: Optional[FilterManifest] = None,
+) -> Iterator[dict]:
+    """
+    Stream the records of a `solutions` or `tests` generation directory keeping only their samples that compile.
+    With a `manifest`, only the new or changed files are filtered, records of exercises already in the dataset are skipped.
+    """
+    counts = counts if counts is not None else Counter()
+    rejections = rejections if rejections is not None else Rejections()
+    worker = partial(_filter_samples_chunk, field=field, near_dup_threshold=near_dup_threshold, keep_rejected=rejections.keep_samples)
+    tasks = _file_tasks(path, sample_files(path), manifest, counts)
+    for chunk in _imap_bounded(worker, _chunks(tasks, chunk_size), workers, 4 * workers):
+        rejections.merge(chunk.rejections)
+        counts["all"] += chunk.total
+        for record in chunk.records:
+            if manifest is not None:
+                if record["exercise_id"] in manifest.seen:
+                    counts["already in dataset"] += 1
+                    continue
+                manifest.seen.add(record["exercise_id"])
+            counts["kept"] += 1
+            yield record
+        _record_files(manifest, chunk, counts)
 
 
 def filter_bad_exos(
-    exos: List[Exercise], carac_to_remove=["??", "___", "Docstring explaining the exercise", "name(args)"]
+    exos: List[Exercise], carac_to_remove=["??", "___", "Docstring explaining the exercise", "name(args)"], rejections: Optional[Rejections] = None
 ) -> List[Exercise]:
+    rejections = rejections if rejections is not None else Rejections()
     clean_exos: List[Exercise] = []
     for exo in exos:
-        keep = True
-        
-        if filter_syntax_check(exo.problem + exo.solution) == False:
-            keep = False
+        code = exo.problem + exo.solution
+        check = check_syntax(code)
+        if not check.ok:
+            rejections.add(f"syntax: {check.error_type}", exo.exercise_id, code, check)
             continue
-        
-        for carac in carac_to_remove:
-            if carac in exo.solution or carac in exo.problem:
-                keep = False
-                break
 
-        if keep:
-            clean_exos.append(exo)
+        carac = next((c for c in carac_to_remove if c in exo.solution or c in exo.problem), None)
+        if carac is not None:
+            rejections.add("placeholder text", exo.exercise_id, code)
+            continue
 
-    return clean_exos
+        if not defines_function(check.tree, get_function_name(exo.problem)):
+            rejections.add("no entry point", exo.exercise_id, code)
+            continue
 
-def filter_syntax_check(code: str) -> bool:
-    # return True
-    try:
-        compile(code, "<string>", "exec")
-        return True
-    except SyntaxError as e: 
-        # print the error message
-        print(f"Syntax error in {code}")
-        return False
+        if not check_exercise(code, check.tree):
+            rejections.add("no return or print", exo.exercise_id, code)
+            continue
+
+        clean_exos.append(exo)
 
+    return clean_exos
 
 def remove_extra(exos: List[Exercise], carac_to_split=["# Test", "```"]):
     for exo in exos:
         for carac in carac_to_split:
             exo.solution = exo.solution.split(carac)[0]
 
-def deduplicate(exos: List[Exercise]):
-    seen = set()
-    deduplicated = [item for item in exos if item.exercise_id not in seen and not seen.add(item.exercise_id)]
-
-    return deduplicated
-
-
-def load_and_filter_exos(path: Union[Path, str]) -> List[Exercise]:
-    exos = load_all_exo(path)
-    print(f"all: {len(exos)}")
-
-    clean_exos = filter_bad_exos(exos)
-    remove_extra(clean_exos)
-    print(f"after filter: {len(clean_exos)}")
-
-    clean_exos = deduplicate(clean_exos)
-    print(f"after dedup: {len(clean_exos)}")
-    
-    return clean_exos
-
-    
+def print_counts(counts: Counter):
+    for name, n in counts.items():
+        print(f"{name}: {n}")
@@ -0,0 +1,125 @@
+import json
+import mmap
+import os
+import re
+from pathlib import Path
+from typing import Dict, Iterator, List, Optional, Tuple, Union
+
+from dataset_gen.columnar import is_parquet, iter_records
+from dataset_gen.compression import compression_of
+
+_EXERCISE_ID = re.compile(rb'"exercise_id":\s*"([^"\\]*)"')
+
+
+def index_path(path: Union[Path, str]) -> str:
+    return f"{path}.idx"
+
+
+def _scan(file) -> Iterator[Tuple[str, int, int]]:
+    """(exercise_id, offset, length) of every record line"""
+    offset = 0
+    for line in file:
+        length = len(line)
+        if line.strip():
+            match = _EXERCISE_ID.search(line)
+            exercise_id = match.group(1).decode("utf-8") if match else json.loads(line)["exercise_id"]
+            yield exercise_id, offset, length
+        offset += length
+
+
+def build_index(path: Union[Path, str]) -> Dict[str, Tuple[int, int]]:
+    """
+    Index the records of a JSONL dataset in one pass, the sidecar `<path>.idx` starts with the size and mtime of the dataset
+    followed by one `exercise_id offset length` line per record. The last record of a duplicated id wins.
+    """
+    stat = os.stat(path)
+    offsets = {}
+    with open(path, "rb") as file:
+        for exercise_id, offset, length in _scan(file):
+            offsets[exercise_id] = (offset, length)
+    tmp_path = index_path(path) + ".tmp"
+    with open(tmp_path, "w") as file:
+        file.write(f"{stat.st_size} {stat.st_mtime_ns}\n")
+        for exercise_id, (offset, length) in offsets.items():
+            file.write(f"{exercise_id} {offset} {length}\n")
+    os.replace(tmp_path, index_path(path))
+    return offsets
+
+
+def load_index(path: Union[Path, str]) -> Optional[Dict[str, Tuple[int, int]]]:
+    """Offsets of the sidecar index, None when it is missing or older than the dataset"""
+    if not os.path.exists(index_path(path)):
+        return None
+    stat = os.stat(path)
+    with open(index_path(path), "r") as file:
+        size, mtime_ns = map(int, file.readline().split())
+        if size != stat.st_size or mtime_ns != stat.st_mtime_ns:
+            return None
+        offsets = {}
+        for line in file:
+            exercise_id, offset, length = line.rsplit(" ", 2)
+            offsets[exercise_id] = (int(offset), int(length))
+    return offsets
+
+
+class JsonlIndex:
+    """
+    Random access by exercise_id into a JSONL dataset through a memory map of the file and its sidecar offset index,
+    the index is built on first use and rebuilt when the dataset changed.
+    """
+
+    def __init__(self, path: Union[Path, str]):
+        self.path = path
+        offsets = load_index(path)
+        self.offsets = offsets if offsets is not None else build_index(path)
+        self._file = open(path, "rb")
+        self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ) if os.path.getsize(path) else b""
+
+    def __len__(self) -> int:
+        return len(self.offsets)
+
+    def __contains__(self, exercise_id: str) -> bool:
+        return exercise_id in self.offsets
+
+    def get(self, exercise_id: str) -> Optional[dict]:
+        location = self.offsets.get(exercise_id)
+        if location is None:
+            return None
+        offset, length = location
+        return json.loads(self._map[offset:offset + length])
+
+    def get_many(self, ids: List[str]) -> List[dict]:
+        """Records of the ids found in the dataset, in the order of `ids`"""
+        return [record for record in (self.get(i) for i in ids) if record is not None]
+
+    def close(self):
+        if isinstance(self._map, mmap.mmap):
+            self._map.close()
+        self._file.close()
+
+    def __enter__(self) -> "JsonlIndex":
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def parse_ids(ids: str) -> List[str]:
+    """`--ids` option: comma separated exercise ids, or the path of a file with one id per line"""
+    if os.path.isfile(ids):
+        with open(ids, "r") as file:
+            return [line.strip() for line in file if line.strip()]
+    return [i.strip() for i in ids.split(",") if i.strip()]
+
+
+def load_by_ids(path: Union[Path, str], ids: List[str]) -> List[dict]:
+    """Records of the given exercise ids, through the offset index for plain JSONL (Parquet and compressed files are scanned)"""
+    if is_parquet(path) or compression_of(path) is not None:
+        wanted = set(ids)
+        return [record for record in iter_records(path) if record["exercise_id"] in wanted]
+    with JsonlIndex(path) as index:
+        records = index.get_many(ids)
+    missing = len(set(ids)) - len({r["exercise_id"] for r in records})
+    if missing:
+        print(f"{missing} ids not found in {path}")
+    return records
@@ -0,0 +1,128 @@
+import hashlib
+import json
+import os
+import pickle
+from pathlib import Path
+from typing import Dict, List, NamedTuple, Optional, Set, Tuple
+
+from pydantic import BaseModel
+
+from dataset_gen.compression import decompress
+
+
+class FileEntry(BaseModel):
+    size: int
+    mtime_ns: int
+    sha1: str
+    records: int = 0
+    kept: int = 0
+
+
+class FileTask(NamedTuple):
+    path: Path
+    key: str
+    sha1: str = ""  # content hash recorded by the manifest, the file is not parsed again when it is unchanged
+
+
+def read_task(task: FileTask) -> Tuple[Optional[List[str]], FileEntry]:
+    """Non empty lines of the file and its manifest entry, lines are None when the content hash matches the recorded one"""
+    with open(task.path, "rb") as f:
+        data = f.read()
+        mtime_ns = os.fstat(f.fileno()).st_mtime_ns
+    entry = FileEntry(size=len(data), mtime_ns=mtime_ns, sha1=hashlib.sha1(data).hexdigest())
+    if entry.sha1 == task.sha1:
+        return None, entry
+    return [line for line in decompress(data, task.path).decode("utf-8").splitlines() if line.strip()], entry
+
+
+class FilterManifest:
+    """
+    Generation files already filtered into a dataset, with their size, mtime, content hash and filter outcome,
+    plus the dedup state (seen exercise ids, MinHash LSH index) so that a re-run only filters the new or changed files
+    and appends their records to the dataset. Stored next to the dataset as `<dataset>.manifest.json` and `<dataset>.state.pkl`.
+    A changed file is filtered again, its records whose exercise id is already in the dataset are skipped.
+    """
+
+    def __init__(self, kind: str, params: dict):
+        self.kind = kind
+        self.params = params
+        self.files: Dict[str, FileEntry] = {}
+        self.dataset_size = 0
+        self.seen: Set[str] = set()
+        self.lsh = None
+
+    @staticmethod
+    def paths(dataset_file: str) -> Tuple[str, str]:
+        return f"{dataset_file}.manifest.json", f"{dataset_file}.state.pkl"
+
+    @classmethod
+    def open(cls, dataset_file: str, kind: str, params: dict) -> "FilterManifest":
+        """Manifest of the previous run, or an empty one (full run) when there is none or it does not match the dataset"""
+        manifest = cls(kind, params)
+        manifest_path, state_path = cls.paths(dataset_file)
+        if not os.path.exists(manifest_path) or not os.path.exists(state_path) or not os.path.exists(dataset_file):
+            return manifest
+        with open(manifest_path, "r") as f:
+            data = json.load(f)
+        if data["kind"] != kind or data["params"] != params:
+            print(f"Filter parameters changed since the last run ({data['params']}), filtering everything again")
+            return manifest
+        if os.path.getsize(dataset_file) < data["dataset_size"]:
+            print(f"{dataset_file} is smaller than recorded in the manifest, filtering everything again")
+            return manifest
+        with open(state_path, "rb") as f:
+            state = pickle.load(f)
+        manifest.files = {key: FileEntry(**entry) for key, entry in data["files"].items()}
+        manifest.dataset_size = data["dataset_size"]
+        manifest.seen = state["seen"]
+        manifest.lsh = state["lsh"]
+        return manifest
+
+    def tasks(self, root: Path, files: List[Path]) -> List[FileTask]:
+        """Files to filter: new ones and the ones whose size or mtime changed (their hash is checked by the worker)"""
+        tasks = []
+        for file in files:
+            key = str(file.relative_to(root))
+            entry = self.files.get(key)
+            if entry is not None:
+                stat = os.stat(file)
+                if stat.st_size == entry.size and stat.st_mtime_ns == entry.mtime_ns:
+                    continue
+            tasks.append(FileTask(file, key, entry.sha1 if entry is not None else ""))
+        return tasks
+
+    def update(self, entries: Dict[str, FileEntry]) -> int:
+        """Record the filtered files, returns how many of them had the recorded content (only their mtime changed)"""
+        unchanged = 0
+        for key, entry in entries.items():
+            previous = self.files.get(key)
+            if previous is not None and previous.sha1 == entry.sha1:
+                entry.records, entry.kept = previous.records, previous.kept
+                unchanged += 1
+            self.files[key] = entry
+        return unchanged
+
+    def prepare_dataset(self, dataset_file: str) -> str:
+        """File mode to write the dataset with. Records written after the last saved manifest (interrupted run) are cut off"""
+        if not self.files:
+            return "w"
+        if os.path.getsize(dataset_file) > self.dataset_size:
+            with open(dataset_file, "r+b") as f:
+                f.truncate(self.dataset_size)
+        return "a"
+
+    def save(self, dataset_file: str):
+        self.dataset_size = os.path.getsize(dataset_file)
+        manifest_path, state_path = self.paths(dataset_file)
+        data = {
+            "kind": self.kind,
+            "params": self.params,
+            "dataset_size": self.dataset_size,
+            "files": {key: entry.dict() for key, entry in self.files.items()},
+        }
+        with open(state_path + ".tmp", "wb") as f:
+            pickle.dump({"seen": self.seen, "lsh": self.lsh}, f, protocol=pickle.HIGHEST_PROTOCOL)
+        with open(manifest_path + ".tmp", "w") as f:
+            json.dump(data, f)
+        os.replace(state_path + ".tmp", state_path)
+        os.replace(manifest_path + ".tmp", manifest_path)
@@ -0,0 +1,142 @@
+import heapq
+import pickle
+import tempfile
+from typing import IO, Iterator, List, Optional, Tuple
+
+from pydantic import BaseModel
+
+from dataset_gen.columnar import iter_records, write_records
+from dataset_gen.jsonl_index import load_by_ids
+
+Record = Tuple[str, dict]
+
+
+class MergeStats(BaseModel):
+    left: int = 0
+    right: int = 0
+    merged: int = 0
+    written: int = 0
+    unmatched_left: List[str] = []
+    unmatched_right: List[str] = []
+    spilled_runs: int = 0
+
+
+def keyed_records(path: str) -> Iterator[Record]:
+    """(exercise_id, record) of every record of a JSONL or Parquet dataset, each record is decoded once"""
+    for record in iter_records(path):
+        yield record["exercise_id"], record
+
+
+def _spill(records: List[Record], directory: str) -> str:
+    with tempfile.NamedTemporaryFile("wb", dir=directory, suffix=".run", delete=False) as file:
+        for record in records:
+            pickle.dump(record, file, protocol=pickle.HIGHEST_PROTOCOL)
+        return file.name
+
+
+def _read_run(file: IO[bytes]) -> Iterator[Record]:
+    while True:
+        try:
+            yield pickle.load(file)
+        except EOFError:
+            return
+
+
+def sorted_records(records: Iterator[Record], run_size: int = 100_000, tmp_dir: Optional[str] = None, stats: Optional[MergeStats] = None) -> Iterator[Record]:
+    """
+    Sort the records by id, in memory when they fit in one run of `run_size` records, otherwise as an external sort:
+    sorted runs are pickled to temporary files and merged lazily. The sort is stable, records sharing an id keep their file order.
+    """
+    run: List[Record] = []
+    run_paths: List[str] = []
+    with tempfile.TemporaryDirectory(dir=tmp_dir) as directory:
+        for record in records:
+            run.append(record)
+            if len(run) >= run_size:
+                run.sort(key=lambda r: r[0])
+                run_paths.append(_spill(run, directory))
+                run = []
+        run.sort(key=lambda r: r[0])
+        if not run_paths:
+            yield from run
+            return
+
+        if stats is not None:
+            stats.spilled_runs += len(run_paths)
+        files = [open(path, "rb") for path in run_paths]
+        try:
+            # the in memory run is the last one so that equal ids stay in file order
+            yield from heapq.merge(*[_read_run(f) for f in files], iter(run), key=lambda r: r[0])
+        finally:
+            for f in files:
+                f.close()
+
+
+def _last_by_id(records: Iterator[Record]) -> Iterator[Record]:
+    """Collapse the sorted records sharing an id to the last one, so the last record of a duplicated id wins"""
+    previous = None
+    for record in records:
+        if previous is not None and record[0] != previous[0]:
+            yield previous
+        previous = record
+    if previous is not None:
+        yield previous
+
+
+def merge_join(left: Iterator[Record], right: Iterator[Record], outer: bool = False, stats: Optional[MergeStats] = None) -> Iterator[dict]:
+    """
+    Merge join of two id sorted record streams, the fields of `right` override the ones of `left`.
+    Records without a match are dropped (inner join) or written as they are (outer join), their ids are kept in the stats.
+    """
+    stats = stats if stats is not None else MergeStats()
+    left = _last_by_id(left)
+    right = _last_by_id(right)
+    l = next(left, None)
+    r = next(right, None)
+    while l is not None or r is not None:
+        if r is None or (l is not None and l[0] < r[0]):
+            stats.left += 1
+            stats.unmatched_left.append(l[0])
+            if outer:
+                yield l[1]
+            l = next(left, None)
+        elif l is None or r[0] < l[0]:
+            stats.right += 1
+            stats.unmatched_right.append(r[0])
+            if outer:
+                yield r[1]
+            r = next(right, None)
+        else:
+            stats.left += 1
+            stats.right += 1
+            stats.merged += 1
+            merged = l[1]
+            merged.update(r[1])
+            yield merged
+            l = next(left, None)
+            r = next(right, None)
+
+
+def merge_files(
+    left_path: str,
+    right_path: str,
+    output_path: str,
+    outer: bool = False,
+    run_size: int = 100_000,
+    tmp_dir: Optional[str] = None,
+    ids: Optional[List[str]] = None,
+) -> MergeStats:
+    """
+    Stream both datasets (JSONL, compressed JSONL or Parquet) through an external sort by exercise_id and merge join them to `output_path`, in id order.
+    The output is written as Parquet when `output_path` ends with `.parquet`.
+    With `ids`, only these exercises are fetched from both files through their offset index.
+    """
+    stats = MergeStats()
+    if ids is not None:
+        left = sorted(((r["exercise_id"], r) for r in load_by_ids(left_path, ids)), key=lambda r: r[0])
+        right = sorted(((r["exercise_id"], r) for r in load_by_ids(right_path, ids)), key=lambda r: r[0])
+    else:
+        left = sorted_records(keyed_records(left_path), run_size, tmp_dir, stats)
+        right = sorted_records(keyed_records(right_path), run_size, tmp_dir, stats)
+    stats.written = write_records(output_path, merge_join(left, right, outer, stats), "solutions_with_tests")
+    return stats
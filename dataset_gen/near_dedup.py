@@ -0,0 +1,150 @@
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+import re
+from typing import Callable, Dict, List, Optional, Tuple, TypeVar
+import zlib
+
+import numpy as np
+from pydantic import BaseModel
+
+T = TypeVar("T")
+
+TOKEN = re.compile(r"\w+|[^\w\s]")
+PRIME = (1 << 31) - 1  # shingle hashes are 32 bits, a * hash + b stays below 2**63
+
+
+class NearDedupStats(BaseModel):
+    items: int = 0
+    kept: int = 0
+    removed: int = 0
+    clusters: int = 0
+    largest_cluster: int = 0
+    comparisons: int = 0
+    cluster_sizes: Dict[int, int] = {}
+
+
+def optimal_bands(threshold: float, num_perm: int) -> Tuple[int, int]:
+    """(bands, rows) whose S-curve (1/bands)^(1/rows) is the closest to the Jaccard threshold"""
+    best = None
+    for rows in range(1, num_perm + 1):
+        bands = num_perm // rows
+        error = abs((1 / bands) ** (1 / rows) - threshold)
+        if best is None or error < best[0]:
+            best = (error, bands, rows)
+    return best[1], best[2]
+
+
+class MinHasher:
+    def __init__(self, num_perm: int = 128, shingle_size: int = 5, seed: int = 1):
+        self.num_perm = num_perm
+        self.shingle_size = shingle_size
+        rng = np.random.RandomState(seed)
+        self._a = rng.randint(1, PRIME, size=num_perm).astype(np.uint64)
+        self._b = rng.randint(0, PRIME, size=num_perm).astype(np.uint64)
+
+    def shingles(self, text: str) -> np.ndarray:
+        """Hashes of the token k-grams, a text shorter than k is one shingle"""
+        tokens = TOKEN.findall(text)
+        k = min(self.shingle_size, len(tokens))
+        grams = {" ".join(tokens[i:i + k]) for i in range(len(tokens) - k + 1)} if k else set()
+        return np.fromiter((zlib.crc32(g.encode("utf-8")) for g in grams), dtype=np.uint64, count=len(grams))
+
+    def signature(self, text: str) -> np.ndarray:
+        hashes = self.shingles(text)
+        if len(hashes) == 0:
+            return np.full(self.num_perm, PRIME, dtype=np.uint64)
+        return ((hashes[:, None] * self._a + self._b) % PRIME).min(axis=0)
+
+    def signatures(self, texts: List[str]) -> List[np.ndarray]:
+        return [self.signature(t) for t in texts]
+
+
+def compute_signatures(hasher: MinHasher, texts: List[str], workers: int = 1, chunk_size: int = 1000) -> List[np.ndarray]:
+    if workers <= 1 or len(texts) <= chunk_size:
+        return hasher.signatures(texts)
+    chunks = [texts[i:i + chunk_size] for i in range(0, len(texts), chunk_size)]
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        return [s for chunk in executor.map(hasher.signatures, chunks) for s in chunk]
+
+
+class MinHashLSH:
+    """
+    Incremental near-duplicate index: items are banded MinHash signatures, an item is a duplicate when an indexed item
+    sharing one of its band buckets has an estimated Jaccard similarity of at least `threshold`.
+    Only the items of the shared buckets are compared, not the whole index.
+    """
+
+    def __init__(self, threshold: float = 0.8, num_perm: int = 128, shingle_size: int = 5):
+        self.threshold = threshold
+        self.hasher = MinHasher(num_perm, shingle_size)
+        self.bands, self.rows = optimal_bands(threshold, num_perm)
+        self._buckets: List[Dict[bytes, List[int]]] = [dict() for _ in range(self.bands)]
+        self._signatures: List[np.ndarray] = []
+        self._cluster_sizes: List[int] = []
+        self.comparisons = 0
+
+    def _band_keys(self, signature: np.ndarray) -> List[bytes]:
+        return [signature[b * self.rows:(b + 1) * self.rows].tobytes() for b in range(self.bands)]
+
+    def query(self, signature: np.ndarray) -> Optional[int]:
+        """Index of the first indexed item similar to the signature"""
+        seen = set()
+        for band, key in enumerate(self._band_keys(signature)):
+            for candidate in self._buckets[band].get(key, ()):
+                if candidate in seen:
+                    continue
+                seen.add(candidate)
+                self.comparisons += 1
+                if np.mean(self._signatures[candidate] == signature) >= self.threshold:
+                    return candidate
+        return None
+
+    def add(self, signature: np.ndarray) -> Optional[int]:
+        """Index the signature unless it is a near duplicate, returns the index of the item it duplicates"""
+        duplicate = self.query(signature)
+        if duplicate is not None:
+            self._cluster_sizes[duplicate] += 1
+            return duplicate
+        index = len(self._signatures)
+        self._signatures.append(signature)
+        self._cluster_sizes.append(1)
+        for band, key in enumerate(self._band_keys(signature)):
+            self._buckets[band].setdefault(key, []).append(index)
+        return None
+
+    def add_text(self, text: str) -> Optional[int]:
+        return self.add(self.hasher.signature(text))
+
+    def stats(self) -> NearDedupStats:
+        sizes = Counter(self._cluster_sizes)
+        items = sum(self._cluster_sizes)
+        return NearDedupStats(
+            items=items,
+            kept=len(self._signatures),
+            removed=items - len(self._signatures),
+            clusters=sum(n for size, n in sizes.items() if size > 1),
+            largest_cluster=max(sizes) if sizes else 0,
+            comparisons=self.comparisons,
+            cluster_sizes=dict(sorted(sizes.items())),
+        )
+
+
+def near_deduplicate(
+    items: List[T],
+    key: Callable[[T], str],
+    threshold: float = 0.8,
+    num_perm: int = 128,
+    shingle_size: int = 5,
+    workers: int = 1,
+) -> Tuple[List[T], NearDedupStats]:
+    """Keep the first item of every cluster of near duplicates, in the original order. Signatures are computed by `workers` processes"""
+    lsh = MinHashLSH(threshold, num_perm, shingle_size)
+    signatures = compute_signatures(lsh.hasher, [key(item) for item in items], workers)
+    kept = [item for item, signature in zip(items, signatures) if lsh.add(signature) is None]
+    return kept, lsh.stats()
+
+
+def near_dedup_samples(samples: List[str], threshold: float = 0.8, num_perm: int = 64, shingle_size: int = 3) -> List[str]:
+    """Near duplicate removal among the samples (solutions or tests) of one exercise"""
+    kept, _ = near_deduplicate(samples, lambda s: s, threshold, num_perm, shingle_size)
+    return kept
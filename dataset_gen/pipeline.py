@@ -0,0 +1,189 @@
+import asyncio
+import queue
+import statistics
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Iterable, Iterator, List, NamedTuple, Optional
+
+from pydantic import BaseModel
+
+_DONE = object()
+
+
+class Stage(NamedTuple):
+    """
+    A step of the pipeline: `fn` maps an item to the items of the next stage (none to drop it, several to fan out).
+    When `fn` is a coroutine function, the stage runs on its own event loop with up to `workers` items in flight
+    instead of `workers` threads.
+    """
+    name: str
+    fn: Callable[[Any], Iterable]
+    workers: int = 1
+    queue_size: int = 0  # capacity of the input queue, 2 * workers when 0
+
+
+class StageStats(BaseModel):
+    name: str
+    workers: int
+    queue_size: int
+    received: int = 0
+    emitted: int = 0
+    errors: int = 0
+    busy_time: float = 0.0
+    max_queue: int = 0
+    first_time: Optional[float] = None
+    last_time: Optional[float] = None
+
+    @property
+    def throughput(self) -> float:
+        """Items emitted per second while the stage was active"""
+        if self.first_time is None or self.last_time is None or self.last_time <= self.first_time:
+            return 0.0
+        return self.emitted / (self.last_time - self.first_time)
+
+    @property
+    def mean_time(self) -> float:
+        """Mean seconds spent by a worker on an item"""
+        return self.busy_time / self.received if self.received else 0.0
+
+
+class Pipeline:
+    """
+    Stream items through stages running on their own threads. Every stage reads from a bounded queue, so a slow stage
+    holds back the ones before it instead of letting items pile up in memory, and an item reaches the end as soon
+    as each stage is done with it. An item whose stage raises is dropped and counted in the errors of the stage.
+    Items that several branches need at once are handled inside a stage (e.g. by a thread pool of its own).
+    """
+
+    def __init__(self, stages: List[Stage]):
+        self.stages = stages
+        self.stats = [
+            StageStats(name=s.name, workers=s.workers, queue_size=s.queue_size or 2 * s.workers) for s in stages
+        ]
+        self.latencies: List[float] = []
+        self._lock = threading.Lock()
+        self._feed_error: Optional[BaseException] = None
+
+    def _feed(self, items: Iterable, inbox: queue.Queue, workers: int):
+        try:
+            for item in items:
+                inbox.put((time.perf_counter(), item))
+        except BaseException as e:
+            self._feed_error = e
+        finally:
+            for _ in range(workers):
+                inbox.put(_DONE)
+
+    def _record(self, i: int, t: float, outputs: list, failed: bool):
+        stats = self.stats[i]
+        with self._lock:
+            stats.received += 1
+            stats.errors += failed
+            stats.emitted += len(outputs)
+            stats.busy_time += time.perf_counter() - t
+            stats.first_time = t if stats.first_time is None else stats.first_time
+            stats.last_time = time.perf_counter()
+
+    def _stage_done(self, i: int, outbox: queue.Queue, remaining: List[int], next_workers: int):
+        with self._lock:
+            remaining[i] -= 1
+            last = remaining[i] == 0
+        if last:
+            for _ in range(next_workers):
+                outbox.put(_DONE)
+
+    def _work(self, i: int, inbox: queue.Queue, outbox: queue.Queue, remaining: List[int], next_workers: int):
+        stage = self.stages[i]
+        while True:
+            entry = inbox.get()
+            if entry is _DONE:
+                break
+            start_time, item = entry
+            t = time.perf_counter()
+            try:
+                outputs = list(stage.fn(item))
+                failed = False
+            except Exception as e:
+                print(f"{stage.name}: {e!r}")
+                outputs = []
+                failed = True
+            self._record(i, t, outputs, failed)
+            for output in outputs:
+                outbox.put((start_time, output))
+        self._stage_done(i, outbox, remaining, next_workers)
+
+    def _work_async(self, i: int, inbox: queue.Queue, outbox: queue.Queue, remaining: List[int], next_workers: int):
+        stage = self.stages[i]
+        # the queues block, they are served by their own threads so that the default executor of the loop stays free
+        queue_io = ThreadPoolExecutor(max_workers=2 * stage.workers)
+
+        async def worker():
+            loop = asyncio.get_running_loop()
+            while True:
+                entry = await loop.run_in_executor(queue_io, inbox.get)
+                if entry is _DONE:
+                    break
+                start_time, item = entry
+                t = time.perf_counter()
+                try:
+                    outputs = list(await stage.fn(item))
+                    failed = False
+                except Exception as e:
+                    print(f"{stage.name}: {e!r}")
+                    outputs = []
+                    failed = True
+                self._record(i, t, outputs, failed)
+                for output in outputs:
+                    await loop.run_in_executor(queue_io, outbox.put, (start_time, output))
+            self._stage_done(i, outbox, remaining, next_workers)
+
+        async def workers():
+            await asyncio.gather(*(worker() for _ in range(stage.workers)))
+
+        try:
+            asyncio.run(workers())
+        finally:
+            queue_io.shutdown()
+
+    def run(self, items: Iterable) -> Iterator:
+        """Outputs of the last stage, in completion order. An error raised by `items` is raised once the pipeline is drained"""
+        queues = [queue.Queue(maxsize=s.queue_size) for s in self.stats] + [queue.Queue()]
+        remaining = [s.workers for s in self.stages]
+        threads = [threading.Thread(target=self._feed, args=(items, queues[0], self.stages[0].workers), daemon=True)]
+        for i, stage in enumerate(self.stages):
+            next_workers = self.stages[i + 1].workers if i + 1 < len(self.stages) else 1
+            args = (i, queues[i], queues[i + 1], remaining, next_workers)
+            if asyncio.iscoroutinefunction(stage.fn):
+                threads.append(threading.Thread(target=self._work_async, args=args, daemon=True))
+            else:
+                threads += [threading.Thread(target=self._work, args=args, daemon=True) for _ in range(stage.workers)]
+        for thread in threads:
+            thread.start()
+        monitor = threading.Thread(target=self._monitor, args=(queues, threads), daemon=True)
+        monitor.start()
+        while True:
+            entry = queues[-1].get()
+            if entry is _DONE:
+                break
+            start_time, output = entry
+            self.latencies.append(time.perf_counter() - start_time)
+            yield output
+        if self._feed_error is not None:
+            raise self._feed_error
+
+    def _monitor(self, queues: List[queue.Queue], threads: List[threading.Thread], interval: float = 0.1):
+        """Sample the depth of the input queues while the pipeline runs"""
+        while any(thread.is_alive() for thread in threads):
+            for stats, q in zip(self.stats, queues):
+                stats.max_queue = max(stats.max_queue, q.qsize())
+            time.sleep(interval)
+
+    def print_stats(self):
+        for stats in self.stats:
+            print(f"{stats.name}: {stats.received} in, {stats.emitted} out, {stats.errors} errors, "
+                  f"{stats.workers} workers, {stats.mean_time:.2f}s per item, {stats.throughput:.2f} items/s, "
+                  f"queue {stats.max_queue}/{stats.queue_size}")
+        if self.latencies:
+            print(f"end-to-end latency: mean {statistics.mean(self.latencies):.2f}s, "
+                  f"median {statistics.median(self.latencies):.2f}s, max {max(self.latencies):.2f}s")
@@ -0,0 +1,249 @@
+import hashlib
+import json
+import re
+from typing import Dict, Iterator, List, NamedTuple, Optional
+
+from pydantic import BaseModel
+
+from dataset_gen.create_prompts import PairSampler, Query, Topic, _parent_key, create_prompt_query
+
+
+class TopicRow(BaseModel):
+    id: int
+    topic: str
+    mixing: int
+    parent_id: Optional[int] = None
+
+
+class PromptRow(NamedTuple):
+    topic_1_id: int
+    topic_2_id: int
+    profession_id: int
+    hash: str
+
+
+def query_hash(query: str) -> str:
+    return hashlib.md5(query.encode("utf-8")).hexdigest()
+
+
+class TopicTable:
+    """Topics with their parents flattened into rows, each distinct node of the tree gets one id"""
+
+    def __init__(self, rows: Optional[List[TopicRow]] = None):
+        self.rows: List[TopicRow] = list(rows or [])  # row ids are their positions
+        self._ids: Dict[tuple, int] = {}
+        self._topics: Dict[int, Topic] = {}
+        for row in self.rows:
+            self._ids[self._key_of_row(row.id)] = row.id
+
+    def _key_of_row(self, id: int) -> tuple:
+        key = []
+        while id is not None:
+            row = self.rows[id]
+            key.append((row.topic, row.mixing))
+            id = row.parent_id
+        return tuple(key)
+
+    def add(self, topic: Topic) -> int:
+        key = ((topic.topic, topic.mixing),) + _parent_key(topic)
+        id = self._ids.get(key)
+        if id is not None:
+            return id
+        parent_id = self.add(topic.parent) if topic.parent is not None else None
+        id = len(self.rows)
+        self.rows.append(TopicRow(id=id, topic=topic.topic, mixing=topic.mixing, parent_id=parent_id))
+        self._ids[key] = id
+        return id
+
+    def topic(self, id: int) -> Topic:
+        """Rebuild the nested Topic, parents are shared between the topics built by the table"""
+        topic = self._topics.get(id)
+        if topic is None:
+            row = self.rows[id]
+            parent = self.topic(row.parent_id) if row.parent_id is not None else None
+            topic = Topic(topic=row.topic, mixing=row.mixing, parent=parent)
+            self._topics[id] = topic
+        return topic
+
+    def leaves(self) -> List[Topic]:
+        parents = {row.parent_id for row in self.rows}
+        return [self.topic(row.id) for row in self.rows if row.id not in parents]
+
+
+class PromptSet:
+    """
+    Compact prompt set, stored as a JSONL file whose first line is a header with the topic table and the professions,
+    and every following line one prompt row `[topic_1_id, topic_2_id, profession_id, hash]`.
+    The query text is rendered on demand with `create_prompt_query`, `hash` is the md5 of the query (the name of its generation file).
+    """
+
+    def __init__(self, topics: TopicTable, professions: List[str], rows: List[PromptRow]):
+        self.topics = topics
+        self.professions = professions
+        self.rows = rows
+
+    def __len__(self) -> int:
+        return len(self.rows)
+
+    def query(self, row: PromptRow) -> str:
+        return create_prompt_query(self.topics.topic(row.topic_1_id), self.topics.topic(row.topic_2_id), self.professions[row.profession_id])
+
+    def queries(self) -> Iterator[str]:
+        for row in self.rows:
+            yield self.query(row)
+
+    def to_queries(self) -> List[Query]:
+        """Legacy pydantic prompts"""
+        return [
+            Query(query=self.query(row), topic_1=self.topics.topic(row.topic_1_id), topic_2=self.topics.topic(row.topic_2_id))
+            for row in self.rows
+        ]
+
+
+def sample_prompt_set(sampler: PairSampler, professions: List[str], n: int) -> PromptSet:
+    table = TopicTable()
+    leaf_ids = [table.add(leaf) for leaf in sampler.leaves]
+    rows = []
+    for i, j, p in sampler.draw_pairs(professions, n):
+        query = create_prompt_query(sampler.leaves[i], sampler.leaves[j], professions[p])
+        rows.append(PromptRow(leaf_ids[i], leaf_ids[j], p, query_hash(query)))
+    return PromptSet(table, professions, rows)
+
+
+def write_prompt_set(path: str, prompt_set: PromptSet):
+    with open(path, "w") as file:
+        header = {"topics": [row.dict() for row in prompt_set.topics.rows], "professions": prompt_set.professions}
+        file.write(json.dumps(header) + "\n")
+        for row in prompt_set.rows:
+            file.write(json.dumps(list(row)) + "\n")
+
+
+def _read_header(line: str) -> tuple:
+    header = json.loads(line)
+    return TopicTable([TopicRow(**row) for row in header["topics"]]), header["professions"]
+
+
+def load_prompt_set(path: str) -> PromptSet:
+    with open(path, "r") as file:
+        topics, professions = _read_header(file.readline())
+        rows = [PromptRow(*json.loads(line)) for line in file if line.strip()]
+    return PromptSet(topics, professions, rows)
+
+
+def is_prompt_set(path: str) -> bool:
+    return str(path).endswith(".jsonl")
+
+
+def _iter_json_array(file, chunk_size: int = 1 << 20) -> Iterator:
+    """Decode the items of a top level JSON array one by one, without loading the whole document"""
+    decoder = json.JSONDecoder()
+    buffer = ""
+    position = 0
+    started = False
+    eof = False
+    while True:
+        while position < len(buffer) and buffer[position] in " \t\r\n,":
+            position += 1
+        if not started and position < len(buffer):
+            if buffer[position] != "[":
+                raise ValueError("expected a JSON array")
+            started = True
+            position += 1
+            continue
+        if started and position < len(buffer) and buffer[position] == "]":
+            return
+        try:
+            item, end = decoder.raw_decode(buffer, position)
+        except json.JSONDecodeError:
+            if eof:
+                raise
+            chunk = file.read(chunk_size)
+            eof = not chunk
+            buffer = buffer[position:] + chunk
+            position = 0
+            continue
+        if end == len(buffer) and not eof:
+            # a number could continue in the next chunk
+            chunk = file.read(chunk_size)
+            eof = not chunk
+            buffer = buffer[position:] + chunk
+            position = 0
+            continue
+        yield item
+        position = end
+
+
+def iter_queries(path: str) -> Iterator[tuple]:
+    """
+    Stream the prompts of a compact prompt set or of a legacy `prompts.json` as (hash, render) pairs,
+    `render()` returns the query so that skipped prompts are never rendered.
+    """
+    with open(path, "r") as file:
+        if is_prompt_set(path):
+            topics, professions = _read_header(file.readline())
+            prompt_set = PromptSet(topics, professions, [])
+            for line in file:
+                if not line.strip():
+                    continue
+                row = PromptRow(*json.loads(line))
+                yield row.hash, lambda row=row: prompt_set.query(row)
+        else:
+            for item in _iter_json_array(file):
+                query = item["query"]
+                yield query_hash(query), lambda query=query: query
+
+
+def unique_queries(path: str, n: int = 0) -> Iterator[str]:
+    """Distinct queries in file order, stops after `n` of them when `n` > 0"""
+    seen = set()
+    for hash, render in iter_queries(path):
+        if hash in seen:
+            continue
+        seen.add(hash)
+        yield render()
+        if n > 0 and len(seen) >= n:
+            return
+
+
+_PROFESSION = re.compile(r"Write it for a (.*)\. *\n")
+
+
+def convert_prompts(legacy_path: str, output_path: str) -> PromptSet:
+    """
+    Convert a legacy `prompts.json` (list of nested Query objects) to the compact format.
+    The profession is read back from the query text, the hash is the one of the original query.
+    """
+    with open(legacy_path, "r") as f:
+        lines = json.load(f)
+
+    table = TopicTable()
+    professions: List[str] = []
+    profession_ids: Dict[str, int] = {}
+    rows = []
+    for line in lines:
+        query = Query.parse_obj(line)
+        match = _PROFESSION.search(query.query)
+        profession = match.group(1) if match else ""
+        if profession not in profession_ids:
+            profession_ids[profession] = len(professions)
+            professions.append(profession)
+        rows.append(PromptRow(table.add(query.topic_1), table.add(query.topic_2), profession_ids[profession], query_hash(query.query)))
+
+    prompt_set = PromptSet(table, professions, rows)
+    write_prompt_set(output_path, prompt_set)
+    return prompt_set
+
+
+def write_topic_table(path: str, topics: List[Topic]):
+    """Topic tree as JSONL rows, e.g. for the leaves of `subsubtopics.json`"""
+    table = TopicTable()
+    for topic in topics:
+        table.add(topic)
+    with open(path, "w") as file:
+        for row in table.rows:
+            file.write(row.json() + "\n")
+
+
+def load_topic_table(path: str) -> TopicTable:
+    with open(path, "r") as file:
+        return TopicTable([TopicRow.parse_raw(line) for line in file if line.strip()])
@@ -4,11 +4,17 @@ import re
 import sys
 import os
 import json
+import threading
+import time
 
 import boto3
-from concurrent.futures import ThreadPoolExecutor
+import botocore.exceptions
+from collections import OrderedDict, defaultdict, deque
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, as_completed, wait
 from pydantic import BaseModel
 
+from falcon.metrics import CallRecord
+
 class GenerateParameters(dict):
     def __init__(self, 
                 best_of: int = None,
@@ -58,55 +64,229 @@ class LogProbs(BaseModel):
     normalized_log_prob: float
     token_log_probs: list[dict[str, float]] | None
 
+class HedgePolicy:
+    """
+    Decide when a slow request gets a duplicate (hedge). A request is hedged once it runs longer than
+    `percentile` of the recently observed latencies, and hedges are capped to `budget` times the number of requests.
+    The policy is thread safe and meant to be shared by all the generators of a run.
+    """
+
+    def __init__(self, percentile: float = 95.0, budget: float = 0.05, window: int = 500, min_samples: int = 20):
+        if not 0 < percentile < 100:
+            raise ValueError(f"hedge percentile must be between 0 and 100 (exclusive), got {percentile}")
+        if budget < 0:
+            raise ValueError(f"hedge budget must be non-negative, got {budget}")
+        self.percentile = percentile
+        self.budget = budget
+        self.min_samples = min_samples
+        self._latencies = deque(maxlen=window)
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.hedges = 0
+        self.hedge_wins = 0
+
+    def record(self, latency: float):
+        with self._lock:
+            self._latencies.append(latency)
+
+    def start_request(self):
+        with self._lock:
+            self.requests += 1
+
+    def delay(self) -> float | None:
+        """Time after which a pending request should be hedged, None while there is not enough history"""
+        with self._lock:
+            if len(self._latencies) < self.min_samples:
+                return None
+            latencies = sorted(self._latencies)
+        index = min(int(len(latencies) * self.percentile / 100), len(latencies) - 1)
+        return latencies[index]
+
+    def try_hedge(self) -> bool:
+        with self._lock:
+            if self.hedges + 1 > self.budget * self.requests:
+                return False
+            self.hedges += 1
+            return True
+
+    def hedge_won(self):
+        with self._lock:
+            self.hedge_wins += 1
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "requests": self.requests,
+                "hedges": self.hedges,
+                "hedge_wins": self.hedge_wins,
+                "extra_load": self.hedges / self.requests if self.requests else 0.0,
+            }
+
+SCORING_PARAMETERS = GenerateParameters(best_of=1, do_sample=False, max_new_tokens=1, decoder_input_details=True)
+CANDIDATE_CACHE_SIZE = 10000
+
+def _scoring_request(reference: str, candidate: str) -> GenerateRequest:
+    if re.search(r"^\s", candidate):
+        return GenerateRequest(reference + candidate, SCORING_PARAMETERS)
+    return GenerateRequest(reference + " " + candidate, SCORING_PARAMETERS)
+
+def _greedy_request(reference: str, length: int) -> GenerateRequest:
+    return GenerateRequest(reference, GenerateParameters(max_new_tokens=length, return_full_text=False, temperature=None, top_k=1))
+
+def _is_greedy(greedy_response, candidate_tokens) -> bool:
+    """The candidate is the greedy continuation if it matches the first tokens of the greedy generation"""
+    prefill = candidate_tokens[0]['details']['prefill']
+    greedy_tokens = greedy_response[0]['details']['tokens'][:len(prefill)]
+    return "".join([res['text'] for res in greedy_tokens]).lstrip() == "".join([can['text'] for can in prefill]).lstrip()
+
 class TGI:
     
-    def __init__(self, endpoint_name, region_name="us-east-1"):
+    def __init__(self, endpoint_name, region_name="us-east-1", hedge: HedgePolicy | None = None, observers: list | None = None):
         self._runtime = boto3.client("sagemaker-runtime", region_name=region_name)
         self.endpoint_name = endpoint_name
         self.region_name = region_name
+        self.hedge = hedge
+        self.observers = observers or []
+        self._candidate_cache = OrderedDict()
+        self._candidate_lock = threading.Lock()
 
-    def sm_query(self, payload):
+    def _invoke(self, payload) -> tuple[list, str, int]:
+        """Returns the decoded response, the endpoint that answered and the number of retries"""
         response = self._runtime.invoke_endpoint(
             EndpointName = self.endpoint_name,
             ContentType = "application/json",
             Body = json.dumps(payload),
         )
 
-        return json.loads(response["Body"].read().decode("utf8"))
+        return json.loads(response["Body"].read().decode("utf8")), self.endpoint_name, 0
+
+    def _notify(self, record: CallRecord):
+        for observer in self.observers:
+            observer.observe(record)
+
+    def sm_query(self, payload, kind: str = "default"):
+        start = time.monotonic()
+        try:
+            response, endpoint, retries = self._invoke(payload)
+        except Exception as e:
+            if self.observers:
+                self._notify(CallRecord(kind=kind, endpoint=self.endpoint_name, latency=time.monotonic() - start, error=repr(e)))
+            raise
+        if self.observers:
+            self._notify(CallRecord.from_response(kind, endpoint, payload, response, time.monotonic() - start, retries))
+        return response
     
 
-    def create_from_objects(self, reqs: list[GenerateRequest]) -> list[str]:
+    def _timed_query(self, payload, kind: str):
+        start = time.monotonic()
+        response = self.sm_query(payload, kind)
+        self.hedge.record(time.monotonic() - start)
+        return response
+
+    def _hedged_query(self, executor: ThreadPoolExecutor, payload, kind: str):
+        self.hedge.start_request()
+        primary = executor.submit(self._timed_query, payload, kind)
+        delay = self.hedge.delay()
+        if delay is None:
+            return primary.result()
+        done, _ = wait([primary], timeout=delay)
+        if done or not self.hedge.try_hedge():
+            return primary.result()
+
+        backup = executor.submit(self._timed_query, payload, kind)
+        pending = {primary, backup}
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is None:
+                    if future is backup:
+                        self.hedge.hedge_won()
+                    return future.result()
+        return primary.result()  # both failed, raise the original error
+
+    def create_from_objects(self, reqs: list[GenerateRequest], kind: str = "default") -> list[str]:
         
-        with ThreadPoolExecutor(max_workers=len(reqs)) as executor:
-            responses = list(executor.map(self.sm_query, reqs))
+        if self.hedge is None:
+            with ThreadPoolExecutor(max_workers=len(reqs)) as executor:
+                responses = list(executor.map(lambda req: self.sm_query(req, kind), reqs))
+        else:
+            # the losing request of a hedged pair is not waited for
+            queries = ThreadPoolExecutor(max_workers=2 * len(reqs))
+            try:
+                with ThreadPoolExecutor(max_workers=len(reqs)) as executor:
+                    responses = list(executor.map(lambda req: self._hedged_query(queries, req, kind), reqs))
+            finally:
+                queries.shutdown(wait=False)
             
         raw_responses = [res[0]['generated_text'] for res in responses]
         return raw_responses
     
+    def _candidate_tokens(self, executor: ThreadPoolExecutor, candidate: str) -> Future:
+        """Tokenization of a candidate, shared by every scoring of the same text"""
+        with self._candidate_lock:
+            future = self._candidate_cache.get(candidate)
+            if future is not None and not (future.done() and future.exception() is not None):
+                self._candidate_cache.move_to_end(candidate)
+                return future
+            future = executor.submit(self.sm_query, GenerateRequest(candidate, SCORING_PARAMETERS), "score")
+            self._candidate_cache[candidate] = future
+            if len(self._candidate_cache) > CANDIDATE_CACHE_SIZE:
+                self._candidate_cache.popitem(last=False)
+            return future
+
+    def _submit_greedy(self, executor: ThreadPoolExecutor, references: list[str], token_futures: list[Future]) -> list[Future]:
+        """
+        Send one greedy generation per distinct reference as soon as the tokenizations of all its candidates are known,
+        long enough to be compared with the longest of them.
+        """
+        by_reference = defaultdict(list)
+        for i, reference in enumerate(references):
+            by_reference[reference].append(i)
+        waiting = {reference: len(items) for reference, items in by_reference.items()}
+        items_by_future = defaultdict(list)
+        for i, future in enumerate(token_futures):
+            items_by_future[future].append(i)
+
+        greedy_by_reference = {}
+        for future in as_completed(items_by_future):
+            for i in items_by_future[future]:
+                reference = references[i]
+                waiting[reference] -= 1
+                if waiting[reference] == 0:
+                    length = max(len(token_futures[j].result()[0]['details']['prefill']) for j in by_reference[reference])
+                    greedy_by_reference[reference] = executor.submit(self.sm_query, _greedy_request(reference, length), "score")
+        return [greedy_by_reference[reference] for reference in references]
+
     def is_greedy_generation(self, reqs: list, candidates: list) -> list[bool]:
         
-        req_greedy = [GenerateRequest(req['reference'], GenerateParameters(max_new_tokens=len(length[0]['details']['prefill']), return_full_text=False, temperature=None, top_k=1)) for req, length in zip(reqs, candidates)]
+        req_greedy = [_greedy_request(req['reference'], len(length[0]['details']['prefill'])) for req, length in zip(reqs, candidates)]
         
         with ThreadPoolExecutor(max_workers=len(reqs)) as executor:
             responses = list(executor.map(self.sm_query, req_greedy))
         
-        is_greedy_list = ["".join([res['text'] for res in response[0]['details']['tokens']]).lstrip() == "".join([can['text'] for can in candidate[0]['details']['prefill']]).lstrip() for response, candidate in zip(responses, candidates)]  
+        is_greedy_list = [_is_greedy(response, candidate) for response, candidate in zip(responses, candidates)]
         return is_greedy_list
     
-    def select_from_objects(self, reqs: list) -> list:
-        parameter = GenerateParameters(best_of=1, do_sample=False, max_new_tokens=1, decoder_input_details=True)
-        candidates = [GenerateRequest(cand['candidates'][0], parameter) for cand in reqs]
-        requests = [GenerateRequest(req1['reference'] + req1['candidates'][0], parameter) if re.search(r"^\s", req1['candidates'][0]) else GenerateRequest(req1['reference'] + " " + req1['candidates'][0], parameter) for req1 in reqs]
-        assert len(candidates) == len(requests) == len(reqs)
-                
-        with ThreadPoolExecutor(max_workers=len(reqs)) as executor: #threads
-            candidates_tokens = list(executor.map(self.sm_query, candidates)) #to get the canditates tokens
-            responses = list(executor.map(self.sm_query, requests))
-        
-        if reqs[0]['is_greedy']:
-            greedy_list = self.is_greedy_generation(reqs, candidates_tokens)
-        else:
-            greedy_list = [False for _ in range(len(reqs))]
+    def select_from_objects(self, reqs: list, max_workers: int = 16) -> list:
+        """
+        Score the first candidate of each request by its log probability after the reference.
+        The candidate tokenization, the scoring and the optional greedy check of every item run on one bounded pool,
+        each request being sent as soon as what it depends on is available.
+        """
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            token_futures = [self._candidate_tokens(executor, req['candidates'][0]) for req in reqs] #to get the canditates tokens
+            score_futures = [executor.submit(self.sm_query, _scoring_request(req['reference'], req['candidates'][0]), "score") for req in reqs]
+            if reqs[0]['is_greedy']:
+                greedy_futures = self._submit_greedy(executor, [req['reference'] for req in reqs], token_futures)
+            else:
+                greedy_futures = None
+
+            candidates_tokens = [future.result() for future in token_futures]
+            responses = [future.result() for future in score_futures]
+            if greedy_futures is not None:
+                greedy_list = [_is_greedy(future.result(), candidate) for future, candidate in zip(greedy_futures, candidates_tokens)]
+            else:
+                greedy_list = [False for _ in range(len(reqs))]
 
         selected = []
         for response, l, is_greedy in zip(responses, candidates_tokens, greedy_list):
@@ -126,7 +306,171 @@ class TGI:
                     
         assert len(selected) == len(reqs)
         return selected
+
+    def score_candidates(self, reference: str, candidates: list[str], is_greedy: bool = False, max_workers: int = 16) -> list:
+        """Score many candidates against one shared reference, the greedy check is a single generation for all of them"""
+        reqs = [{'reference': reference, 'candidates': [candidate], 'is_greedy': is_greedy} for candidate in candidates]
+        return self.select_from_objects(reqs, max_workers)
     
+class _EndpointState:
+    def __init__(self, endpoint_name: str, region_name: str, weight: float):
+        self.client = TGI(endpoint_name, region_name)
+        self.endpoint_name = endpoint_name
+        self.region_name = region_name
+        self.weight = weight
+        self.outstanding = 0
+        self.requests = 0
+        self.errors = 0
+        self.consecutive_errors = 0
+        self.ejections = 0
+        self.ejected_until = 0.0
+        self.probing = False
+        self.total_latency = 0.0
+
+    @property
+    def name(self) -> str:
+        return f"{self.endpoint_name}@{self.region_name}"
+
+    def is_ejected(self, now: float) -> bool:
+        return self.ejected_until > now
+
+_ENDPOINT_ERROR_CODES = {"ThrottlingException", "Throttling", "TooManyRequestsException", "ServiceUnavailable", "InternalFailure", "ModelNotReadyException"}
+
+def is_endpoint_failure(error: Exception) -> bool:
+    """
+    Errors of the endpoint (throttling, 5xx, connection) as opposed to errors of the request (4xx validation,
+    e.g. an input that is too long), which would fail the same way on any other endpoint.
+    """
+    if isinstance(error, (ConnectionError, TimeoutError, botocore.exceptions.ConnectionError, botocore.exceptions.HTTPClientError)):
+        return True
+    if isinstance(error, botocore.exceptions.ClientError):
+        code = error.response.get("Error", {}).get("Code", "")
+        # ModelError carries the status returned by the container
+        status = error.response.get("OriginalStatusCode") or error.response.get("ResponseMetadata", {}).get("HTTPStatusCode") or 0
+        return code in _ENDPOINT_ERROR_CODES or status == 429 or status >= 500
+    return False
+
+class BalancedTGI(TGI):
+    """
+    Route requests over several SageMaker endpoints, possibly in different regions.
+    Each request goes to the healthy endpoint with the fewest outstanding requests relative to its weight.
+    Endpoints that keep failing (throttling, 5xx or connection errors) are ejected for a growing backoff, then probed
+    with a single request before receiving traffic again. Invalid requests are raised without failing over. The instance is thread safe and meant to be shared by all the generators of a run.
+    """
+
+    def __init__(self, endpoints: list[tuple[str, str, float]], max_failures: int = 3, eject_seconds: float = 30.0, max_eject_seconds: float = 600.0, hedge: HedgePolicy | None = None, observers: list | None = None):
+        assert len(endpoints) > 0, "at least one endpoint is needed"
+        self.hedge = hedge
+        self.observers = observers or []
+        self._candidate_cache = OrderedDict()
+        self._candidate_lock = threading.Lock()
+        self._endpoints = [_EndpointState(name, region, weight) for name, region, weight in endpoints]
+        self._lock = threading.Lock()
+        self._started = time.monotonic()
+        self.endpoint_name = ",".join(e.endpoint_name for e in self._endpoints)
+        self.region_name = ",".join(sorted({e.region_name for e in self._endpoints}))
+        self.max_failures = max_failures
+        self.eject_seconds = eject_seconds
+        self.max_eject_seconds = max_eject_seconds
+
+    def _acquire(self, exclude: set) -> _EndpointState:
+        now = time.monotonic()
+        with self._lock:
+            candidates = [e for e in self._endpoints if e.name not in exclude] or self._endpoints
+            eligible = []
+            for e in candidates:
+                if e.is_ejected(now):
+                    continue
+                if e.ejections > 0 and e.consecutive_errors > 0:
+                    # back from ejection: only one probe request at a time
+                    if e.probing:
+                        continue
+                    e.probing = True
+                eligible.append(e)
+            if not eligible:
+                # every endpoint is ejected, probe the one that comes back first rather than failing the request
+                eligible = [min(candidates, key=lambda e: e.ejected_until)]
+            state = min(eligible, key=lambda e: ((e.outstanding + 1) / e.weight, e.requests))
+            for e in eligible:
+                if e is not state:
+                    e.probing = False
+            state.outstanding += 1
+            state.requests += 1
+            return state
+
+    def _release(self, state: _EndpointState, latency: float, ok: bool):
+        with self._lock:
+            state.outstanding -= 1
+            state.total_latency += latency
+            state.probing = False
+            if ok:
+                state.consecutive_errors = 0
+                state.ejections = 0
+                return
+            state.errors += 1
+            state.consecutive_errors += 1
+            if state.consecutive_errors >= self.max_failures or state.ejections > 0:
+                state.ejections += 1
+                backoff = min(self.eject_seconds * 2 ** (state.ejections - 1), self.max_eject_seconds)
+                state.ejected_until = time.monotonic() + backoff
+
+    def _invoke(self, payload) -> tuple[list, str, int]:
+        tried = set()
+        while True:
+            state = self._acquire(tried)
+            tried.add(state.name)
+            start = time.monotonic()
+            try:
+                response = state.client.sm_query(payload)
+            except Exception as e:
+                if not is_endpoint_failure(e):
+                    # the endpoint answered, the request itself is invalid
+                    self._release(state, time.monotonic() - start, ok=True)
+                    raise
+                self._release(state, time.monotonic() - start, ok=False)
+                if len(tried) >= len(self._endpoints):
+                    raise
+                continue
+            self._release(state, time.monotonic() - start, ok=True)
+            return response, state.name, len(tried) - 1
+
+    def stats(self) -> dict[str, dict]:
+        now = time.monotonic()
+        elapsed = max(now - self._started, 1e-9)
+        with self._lock:
+            return {
+                e.name: {
+                    "weight": e.weight,
+                    "requests": e.requests,
+                    "errors": e.errors,
+                    "outstanding": e.outstanding,
+                    "ejected": e.is_ejected(now),
+                    "mean_latency": e.total_latency / e.requests if e.requests else 0.0,
+                    "requests_per_second": e.requests / elapsed,
+                }
+                for e in self._endpoints
+            }
+
+def parse_endpoints(spec: str, default_region: str = "us-west-2") -> list[tuple[str, str, float]]:
+    """
+    Parse a comma separated endpoint list of the form `name[@region][:weight]`,
+    e.g. `40B-a:2,40B-b@us-east-1`.
+    """
+    endpoints = []
+    for item in spec.split(","):
+        item = item.strip()
+        if not item:
+            continue
+        weight = 1.0
+        if ":" in item:
+            item, raw_weight = item.rsplit(":", 1)
+            weight = float(raw_weight)
+        if weight <= 0:
+            raise ValueError(f"endpoint weight must be positive, got {weight} for {item}")
+        name, _, region = item.partition("@")
+        endpoints.append((name, region or default_region, weight))
+    return endpoints
+
 if __name__ == "__main__":
     endpoint_name = "40B-py-over-ML-stack-ess-textbook-2024-02-05-08-00-11"
     region_name = "us-west-2"
@@ -0,0 +1,176 @@
+import json
+import threading
+import time
+from collections import Counter, defaultdict, deque
+
+from pydantic import BaseModel
+
+
+class CallRecord(BaseModel):
+    kind: str
+    endpoint: str
+    latency: float
+    retries: int = 0
+    max_new_tokens: int | None = None
+    prompt_tokens: int | None = None
+    generated_tokens: int | None = None
+    finish_reason: str | None = None
+    error: str | None = None
+
+    @classmethod
+    def from_response(cls, kind: str, endpoint: str, payload: dict, response, latency: float, retries: int = 0) -> "CallRecord":
+        """Read the token counts and finish reason from the `details` of a TGI response"""
+        parameters = payload.get("parameters") or {}
+        details = {}
+        if isinstance(response, list) and response:
+            details = response[0].get("details") or {}
+        prefill = details.get("prefill")
+        return cls(
+            kind=kind,
+            endpoint=endpoint,
+            latency=latency,
+            retries=retries,
+            max_new_tokens=parameters.get("max_new_tokens"),
+            prompt_tokens=len(prefill) if prefill else None,
+            generated_tokens=details.get("generated_tokens"),
+            finish_reason=details.get("finish_reason"),
+        )
+
+
+def percentile(values: list[float], q: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(int(len(values) * q / 100), len(values) - 1)]
+
+
+class _KindMetrics:
+    def __init__(self):
+        self.calls = 0
+        self.errors = 0
+        self.retries = 0
+        self.generation_retries = 0
+        self.accepted = 0
+        self.prompt_tokens = 0
+        self.generated_tokens = 0
+        self.latencies = []
+        self.finish_reasons = Counter()
+
+
+class MetricsRecorder:
+    """
+    Aggregate the CallRecords of every endpoint call by kind of request (exercise, solution, test).
+    Pass it as an observer to TGI. `cost_per_hour` is the hourly price of the endpoints used by the run,
+    it is spread over the accepted samples. Per call records are streamed to `calls_path` when given.
+    """
+
+    def __init__(self, cost_per_hour: float = 0.0, calls_path: str | None = None):
+        self.cost_per_hour = cost_per_hour
+        self._lock = threading.Lock()
+        self._started = time.monotonic()
+        self._kinds: dict[str, _KindMetrics] = defaultdict(_KindMetrics)
+        self._calls_file = open(calls_path, "w") if calls_path else None
+
+    def observe(self, record: CallRecord):
+        with self._lock:
+            metrics = self._kinds[record.kind]
+            metrics.calls += 1
+            metrics.retries += record.retries
+            metrics.latencies.append(record.latency)
+            if record.error is not None:
+                metrics.errors += 1
+            else:
+                metrics.prompt_tokens += record.prompt_tokens or 0
+                metrics.generated_tokens += record.generated_tokens or 0
+                metrics.finish_reasons[record.finish_reason] += 1
+            if self._calls_file is not None:
+                self._calls_file.write(record.json() + "\n")
+
+    def record_retry(self, kind: str):
+        """A generation retried by the mass generation loops"""
+        with self._lock:
+            self._kinds[kind].generation_retries += 1
+
+    def record_accepted(self, kind: str, n: int = 1):
+        with self._lock:
+            self._kinds[kind].accepted += n
+
+    def summary(self) -> dict:
+        elapsed = time.monotonic() - self._started
+        cost = self.cost_per_hour * elapsed / 3600
+        with self._lock:
+            kinds = {}
+            for kind, m in self._kinds.items():
+                kinds[kind] = {
+                    "calls": m.calls,
+                    "errors": m.errors,
+                    "retries": m.retries + m.generation_retries,
+                    "accepted": m.accepted,
+                    "prompt_tokens": m.prompt_tokens,
+                    "generated_tokens": m.generated_tokens,
+                    "generated_tokens_per_second": m.generated_tokens / elapsed if elapsed > 0 else 0.0,
+                    "mean_latency": sum(m.latencies) / len(m.latencies) if m.latencies else 0.0,
+                    "p50_latency": percentile(m.latencies, 50),
+                    "p99_latency": percentile(m.latencies, 99),
+                    "finish_reasons": {str(k): v for k, v in m.finish_reasons.items()},
+                    "cost_per_accepted": cost / m.accepted if m.accepted else None,
+                }
+        return {"elapsed_seconds": elapsed, "cost": cost, "kinds": kinds}
+
+    def export(self, path: str):
+        with open(path, "w") as file:
+            json.dump(self.summary(), file, indent=2)
+
+    def close(self):
+        if self._calls_file is not None:
+            self._calls_file.close()
+            self._calls_file = None
+
+
+class TokenBudget:
+    """
+    Learn the completion length of each kind of request from the recent calls and set max_new_tokens
+    to a high percentile of it plus some headroom, never above `ceiling`. Pass it as an observer to TGI.
+    Completions cut by a learned budget (finish reason `length` below the ceiling) are counted as truncated,
+    they also push the budget up since they sit at the top of the length distribution.
+    """
+
+    def __init__(self, ceiling: int = 512, percentile: float = 99.0, headroom: float = 0.2, window: int = 1000, min_samples: int = 50):
+        self.ceiling = ceiling
+        self.percentile = percentile
+        self.headroom = headroom
+        self.min_samples = min_samples
+        self._lock = threading.Lock()
+        self._lengths: dict[str, deque] = defaultdict(lambda: deque(maxlen=window))
+        self._calls = Counter()
+        self._truncated = Counter()
+
+    def max_new_tokens(self, kind: str) -> int:
+        with self._lock:
+            lengths = list(self._lengths[kind])
+        if len(lengths) < self.min_samples:
+            return self.ceiling
+        budget = int(percentile(lengths, self.percentile) * (1 + self.headroom)) + 1
+        return min(budget, self.ceiling)
+
+    def observe(self, record: CallRecord):
+        if record.error is not None or record.generated_tokens is None:
+            return
+        with self._lock:
+            self._lengths[record.kind].append(record.generated_tokens)
+            self._calls[record.kind] += 1
+            if record.finish_reason == "length" and record.max_new_tokens is not None and record.max_new_tokens < self.ceiling:
+                self._truncated[record.kind] += 1
+
+    def stats(self) -> dict:
+        with self._lock:
+            kinds = list(self._calls)
+        return {
+            kind: {
+                "calls": self._calls[kind],
+                "max_new_tokens": self.max_new_tokens(kind),
+                "truncated": self._truncated[kind],
+                "truncation_rate": self._truncated[kind] / self._calls[kind],
+            }
+            for kind in kinds
+        }
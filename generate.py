@@ -1,20 +1,102 @@
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
 import itertools
 import json
 import os
+import threading
 from pathlib import Path
 from typing import List
+import openai
 import pandas as pd
 from typer import Typer
 from rich.progress import track
 
-from codeT.execution import best_solution, pass_most_solution
-from dataset_gen.create_prompts import Query, Topic, create_prompts, create_prompt_query
-from dataset_gen.dataset_gen import FalconGenerator, MonkeyGenerator, load_exercises, load_leaves, load_prompts, mass_generation, mass_solutions_generation, mass_tests_generation, write_results_to_jsonl
-from dataset_gen.filtering import load_all_solutions, load_all_tests, load_and_filter_exos, load_solutions_with_tests, read_jsonl, merge_dicts, write_jsonl
-from falcon.TextGenerationInference import TGI, GenerateParameters, GenerateRequest
+from codeT.execution import TimeoutPolicy, best_solution, cluster_solutions, most_agreed_solution, pass_most_solution, run_candidates
+from codeT.prescreen import is_rejected
+from codeT.profiling import ExecutionProfile
+from codeT.scheduler import SandboxScheduler, host_memory
+from codeT._execution import MEMORY_EXCEEDED, exceeded_memory
+from dataset_gen.columnar import write_records
+from dataset_gen.create_prompts import MonkeyChat, OpenAIChat, PairSampler, Query, Topic, build_tree, create_prompts, create_prompt_query
+from dataset_gen.dataset_gen import ExerciseSolutions, ExerciseTests, FalconGenerator, MonkeyGenerator, generation, load_exercises, load_leaves, mass_generation, mass_solutions_generation, mass_tests_generation, solutions_generation, tests_generation
+from dataset_gen.prompt_set import convert_prompts as convert_prompt_set, is_prompt_set, sample_prompt_set, unique_queries, write_prompt_set, write_topic_table
+from dataset_gen.filtering import filter_bad_exos, filter_samples, iter_filtered_exos, iter_filtered_samples, load_solutions_with_tests, print_counts, remove_extra, Rejections
+from dataset_gen.jsonl_index import load_by_ids, parse_ids
+from dataset_gen.manifest import FilterManifest
+from dataset_gen.merge_join import merge_files
+from dataset_gen.near_dedup import MinHashLSH
+from dataset_gen.pipeline import Pipeline, Stage
+from falcon.TextGenerationInference import TGI, BalancedTGI, GenerateParameters, GenerateRequest, HedgePolicy, parse_endpoints
+from falcon.metrics import MetricsRecorder, TokenBudget
 
 app = Typer()
 
+def make_get_generator(endpoint: str, region: str, debug: bool, debug_speed: int, hedge: HedgePolicy | None = None, observers: list | None = None, budget: TokenBudget | None = None):
+    """
+    Build the generator factory shared by the generation commands.
+    `endpoint` can list several endpoints as `name[@region][:weight],...`, requests are then balanced over all of them.
+    Returns the factory and the shared balanced model (None when there is a single endpoint).
+    """
+    if debug:
+        def get_generator():
+            return MonkeyGenerator(speed=debug_speed)
+        return get_generator, None
+
+    endpoints = parse_endpoints(endpoint, region)
+    if budget is not None:
+        observers = (observers or []) + [budget]
+    model = BalancedTGI(endpoints, hedge=hedge, observers=observers) if len(endpoints) > 1 else None
+    endpoint_name, endpoint_region, _ = endpoints[0]
+
+    def get_generator():
+        return FalconGenerator(endpoint_name, endpoint_region, model=model, hedge=hedge, observers=observers, budget=budget)
+    return get_generator, model
+
+def make_hedge_policy(hedge_percentile: float, hedge_budget: float) -> HedgePolicy | None:
+    """Hedging is disabled with a percentile of 0"""
+    if hedge_percentile <= 0:
+        return None
+    return HedgePolicy(percentile=hedge_percentile, budget=hedge_budget)
+
+def make_timeout_policy(adaptive_timeouts: bool, timeout_factor: float, cpu_budget: float) -> TimeoutPolicy | None:
+    """Fixed timeouts without `adaptive_timeouts`, no CPU budget with a budget of 0"""
+    if not adaptive_timeouts:
+        return None
+    return TimeoutPolicy(factor=timeout_factor, ceiling=0.5, cpu_budget=cpu_budget or None)
+
+def make_scheduler(sandbox_workers: int, memory_limit_mb: int, memory_budget_mb: int, job_overhead_mb: int) -> SandboxScheduler:
+    """Options of 0 take the defaults, the memory budget is 80% of the host memory when only the limit is given"""
+    memory_limit = memory_limit_mb * 2**20 or None
+    memory_budget = (memory_budget_mb * 2**20 or int(0.8 * host_memory())) if memory_limit else None
+    return SandboxScheduler(sandbox_workers or None, memory_budget, memory_limit, job_overhead_mb * 2**20 or None)
+
+def print_generation_stats(model: BalancedTGI | None, hedge: HedgePolicy | None = None, metrics: MetricsRecorder | None = None, metrics_path: str = "", budget: TokenBudget | None = None):
+    if metrics is not None:
+        summary = metrics.summary()
+        for kind, stats in summary["kinds"].items():
+            cost = stats["cost_per_accepted"]
+            print(f"{kind}: {stats['calls']} calls, {stats['errors']} errors, {stats['retries']} retries, "
+                  f"{stats['prompt_tokens']} prompt / {stats['generated_tokens']} generated tokens "
+                  f"({stats['generated_tokens_per_second']:.1f} tokens/s), p99 latency {stats['p99_latency']:.2f}s, "
+                  f"{stats['accepted']} accepted" + (f", {cost:.4f} per accepted" if cost is not None else ""))
+        if metrics_path:
+            metrics.export(metrics_path)
+        metrics.close()
+    if budget is not None:
+        for kind, stats in budget.stats().items():
+            print(f"{kind}: max_new_tokens {stats['max_new_tokens']}, "
+                  f"{stats['truncated']}/{stats['calls']} truncated by the budget ({stats['truncation_rate']:.2%})")
+    if hedge is not None:
+        stats = hedge.stats()
+        print(f"hedging: {stats['hedges']} hedges for {stats['requests']} requests "
+              f"({stats['extra_load']:.1%} extra load), {stats['hedge_wins']} won by the hedge")
+    if model is None:
+        return
+    for name, stats in model.stats().items():
+        print(f"{name}: {stats['requests']} requests, {stats['errors']} errors, "
+              f"{stats['requests_per_second']:.2f} req/s, mean latency {stats['mean_latency']:.2f}s, "
+              f"{'ejected' if stats['ejected'] else 'healthy'}")
+
 @app.command()
 def generate(
     prompt_path: str,
@@ -26,25 +108,19 @@ def generate(
     retries: int = 5,
     pool_size: int = 2,
     n_prompts: int = 0,
-    
+    metrics_path: str = "",
+    cost_per_hour: float = 0.0,
+    adaptive_tokens: bool = False,
+    compression: str = "",
 ):
-    prompts = load_prompts(prompt_path)
-    prompts_selection = [i.query for i in prompts]
-    print(f"prompts: {len(prompts_selection)}")
-    solo_prompts = list(set(prompts_selection))
-    print(f"solo prompts: {len(solo_prompts)}")
-    if n_prompts > 0: 
-        solo_prompts = solo_prompts[:n_prompts]
+    solo_prompts = unique_queries(prompt_path, n_prompts)
     
     if not os.path.exists(output_path):
         os.makedirs(output_path)
 
-    if not debug:
-        def get_generator():
-            return FalconGenerator(endpoint, region)
-    else:
-        def get_generator():
-            return MonkeyGenerator(speed=debug_speed)
+    metrics = MetricsRecorder(cost_per_hour=cost_per_hour)
+    budget = TokenBudget() if adaptive_tokens else None
+    get_generator, model = make_get_generator(endpoint, region, debug, debug_speed, observers=[metrics], budget=budget)
     
     mass_generation(
         solo_prompts,
@@ -52,14 +128,21 @@ def generate(
         save_dir=output_path,
         pool_size=pool_size,
         retries=retries,
+        metrics=metrics,
+        total=n_prompts or None,
+        compression=compression,
     )
+    print_generation_stats(model, metrics=metrics, metrics_path=metrics_path, budget=budget)
     
     
 @app.command()
 def prompts(
     leaves_path: str = "dataset_gen/tree/subsubtopics.json",
-    debug: bool = True
+    debug: bool = True,
+    seed: int = 0,
+    output_path: str = "dataset_gen/tree/prompts.jsonl",
 ):
+    """Write the compact prompt set, or the legacy nested `prompts.json` when the output path ends with .json"""
     if debug:
         n_combinations = 2
     else:
@@ -70,38 +153,112 @@ def prompts(
     with open("dataset_gen/tree/professions.json", "r") as openfile:
         professions = list(json.load(openfile))
         
-    prompts: List[List[Query]] = [
-        create_prompts(
-            i,
-            combination_options=leaves,
-            professions=professions,
-            n=n_combinations,
-        )
-        for i in leaves
-    ]
-
-    prompts_list = list(itertools.chain(*prompts))
+    sampler = PairSampler(leaves, seed=seed)
+    if is_prompt_set(output_path):
+        prompt_set = sample_prompt_set(sampler, professions, n=n_combinations)
+        print(f"prompts: {len(prompt_set)}")
+        write_prompt_set(output_path, prompt_set)
+        return
+
+    prompts_list = sampler.create_prompts(professions, n=n_combinations)
+    print(f"prompts: {len(prompts_list)}")
     prompts_json = json.dumps([p.dict() for p in prompts_list])
-    with open("dataset_gen/tree/prompts.json", "w") as outfile:
+    with open(output_path, "w") as outfile:
         outfile.write(prompts_json)
 
 @app.command()
-def filter(exo_path: Path, dataset_file: str):
+def tree(
+    topics_path: str = "dataset_gen/tree/topics.csv",
+    output_dir: str = "",
+    cache_dir: str = "",
+    n_base_topics: int = 0,
+    n_subtopics: int = 10,
+    n_subsubtopics: int = 5,
+    workers: int = 8,
+    requests_per_second: float = 1.0,
+    debug: bool = False,
+):
+    """
+    Expand the topic tree with the chat model, node expansions are cached so reruns are incremental.
+    The tree is written to `dataset_gen/tree` (`dataset_gen/tree/debug` with `--debug`), the cache to `<output_dir>/cache`.
+    """
+    output_dir = output_dir or ("dataset_gen/tree/debug" if debug else "dataset_gen/tree")
+    cache_dir = cache_dir or os.path.join(output_dir, "cache")
+    if debug:
+        backend = MonkeyChat()
+    else:
+        openai.api_key = os.environ["OPENAI_API_KEY"]
+        backend = OpenAIChat()
+
+    leaves = build_tree(
+        topics_path,
+        output_dir,
+        backend,
+        cache_dir=cache_dir,
+        n_base_topics=n_base_topics,
+        n_subtopics=n_subtopics,
+        n_subsubtopics=n_subsubtopics,
+        workers=workers,
+        requests_per_second=requests_per_second,
+    )
+    print(f"leaves: {len(leaves)}")
+
+@app.command()
+def convert_prompts(legacy_path: str, output_path: str, leaves_path: str = "", leaves_output_path: str = ""):
+    """
+    Convert a legacy prompts.json (and optionally the leaves file) to the compact format.
+    The leaves are written to `--leaves-output-path`, by default a .jsonl of the same name next to `output_path`.
+    """
+    if leaves_output_path and not leaves_path:
+        raise ValueError("--leaves-output-path needs --leaves-path")
+    prompt_set = convert_prompt_set(legacy_path, output_path)
+    print(f"prompts: {len(prompt_set)}, topics: {len(prompt_set.topics.rows)}")
+    if leaves_path:
+        leaves_output_path = leaves_output_path or os.path.join(os.path.dirname(output_path), Path(leaves_path).stem + ".jsonl")
+        write_topic_table(leaves_output_path, load_leaves(leaves_path))
+        print(f"leaves: {leaves_output_path}")
+
+@app.command()
+def filter(exo_path: Path, dataset_file: str, near_dup_threshold: float = 0.0, workers: int = os.cpu_count(), rejected_path: str = "", incremental: bool = False):
     print(exo_path)
-    exos = load_and_filter_exos(exo_path)
-    write_results_to_jsonl(dataset_file, exos)
+    counts = Counter()
+    rejections = Rejections(rejected_path or None)
+    manifest = FilterManifest.open(dataset_file, "exercises", {"near_dup_threshold": near_dup_threshold}) if incremental else None
+    mode = manifest.prepare_dataset(dataset_file) if manifest is not None else "w"
+    write_records(dataset_file, iter_filtered_exos(exo_path, near_dup_threshold, workers, counts=counts, rejections=rejections, manifest=manifest), "exercises", mode)
+    if manifest is not None:
+        manifest.save(dataset_file)
+    rejections.close()
+    print_counts(counts)
+    print_counts(rejections.counts)
 
 @app.command()
-def filter_solutions(solutions_path: Path, dataset_file: str):
+def filter_solutions(solutions_path: Path, dataset_file: str, near_dup_threshold: float = 0.0, workers: int = os.cpu_count(), rejected_path: str = "", incremental: bool = False):
     print(solutions_path)
-    items = load_all_solutions(solutions_path)
-    write_results_to_jsonl(dataset_file, items)
+    counts = Counter()
+    rejections = Rejections(rejected_path or None)
+    manifest = FilterManifest.open(dataset_file, "solutions", {"near_dup_threshold": near_dup_threshold}) if incremental else None
+    mode = manifest.prepare_dataset(dataset_file) if manifest is not None else "w"
+    write_records(dataset_file, iter_filtered_samples(solutions_path, "solutions", near_dup_threshold, workers, counts=counts, rejections=rejections, manifest=manifest), "solutions", mode)
+    if manifest is not None:
+        manifest.save(dataset_file)
+    rejections.close()
+    print_counts(counts)
+    print_counts(rejections.counts)
 
 @app.command()
-def filter_tests(tests_path: Path, dataset_file: str):
+def filter_tests(tests_path: Path, dataset_file: str, near_dup_threshold: float = 0.0, workers: int = os.cpu_count(), rejected_path: str = "", incremental: bool = False):
     print(tests_path)
-    items = load_all_tests(tests_path)
-    write_results_to_jsonl(dataset_file, items)
+    counts = Counter()
+    rejections = Rejections(rejected_path or None)
+    manifest = FilterManifest.open(dataset_file, "tests", {"near_dup_threshold": near_dup_threshold}) if incremental else None
+    mode = manifest.prepare_dataset(dataset_file) if manifest is not None else "w"
+    write_records(dataset_file, iter_filtered_samples(tests_path, "tests", near_dup_threshold, workers, counts=counts, rejections=rejections, manifest=manifest), "tests", mode)
+    if manifest is not None:
+        manifest.save(dataset_file)
+    rejections.close()
+    print_counts(counts)
+    print_counts(rejections.counts)
 
 @app.command()
 def solutions(exercise_path: Path,
@@ -113,18 +270,22 @@ def solutions(exercise_path: Path,
               debug_speed: int = 2,
               pool_size: int = 8,
               retries: int = 5,
+              hedge_percentile: float = 0.0,
+              hedge_budget: float = 0.05,
+              metrics_path: str = "",
+              cost_per_hour: float = 0.0,
+              adaptive_tokens: bool = False,
+              compression: str = "",
 ):
     exercises = load_exercises(exercise_path)
     
     if not os.path.exists(output_path):
         os.makedirs(output_path)
 
-    if not debug:
-        def get_generator():
-            return FalconGenerator(endpoint, region)
-    else:
-        def get_generator():
-            return MonkeyGenerator(speed=debug_speed)
+    hedge = make_hedge_policy(hedge_percentile, hedge_budget)
+    metrics = MetricsRecorder(cost_per_hour=cost_per_hour)
+    budget = TokenBudget() if adaptive_tokens else None
+    get_generator, model = make_get_generator(endpoint, region, debug, debug_speed, hedge, observers=[metrics], budget=budget)
     
     mass_solutions_generation(
         exercises,
@@ -133,7 +294,10 @@ def solutions(exercise_path: Path,
         pool_size=pool_size,
         retries=retries,
         n_solutions=n_samples,
+        metrics=metrics,
+        compression=compression,
     )
+    print_generation_stats(model, hedge, metrics, metrics_path, budget)
     
 @app.command()
 def tests(exercise_path: Path,
@@ -145,18 +309,22 @@ def tests(exercise_path: Path,
               debug_speed: int = 2,
               pool_size: int = 8,
               retries: int = 5,
+              hedge_percentile: float = 0.0,
+              hedge_budget: float = 0.05,
+              metrics_path: str = "",
+              cost_per_hour: float = 0.0,
+              adaptive_tokens: bool = False,
+              compression: str = "",
 ):
     exercises = load_exercises(exercise_path)
     
     if not os.path.exists(output_path):
         os.makedirs(output_path)
 
-    if not debug:
-        def get_generator():
-            return FalconGenerator(endpoint, region)
-    else:
-        def get_generator():
-            return MonkeyGenerator(speed=debug_speed)
+    hedge = make_hedge_policy(hedge_percentile, hedge_budget)
+    metrics = MetricsRecorder(cost_per_hour=cost_per_hour)
+    budget = TokenBudget() if adaptive_tokens else None
+    get_generator, model = make_get_generator(endpoint, region, debug, debug_speed, hedge, observers=[metrics], budget=budget)
     
     mass_tests_generation(
         exercises,
@@ -165,38 +333,233 @@ def tests(exercise_path: Path,
         pool_size=pool_size,
         retries=retries,
         n_solutions=n_samples,
+        metrics=metrics,
+        compression=compression,
     )
+    print_generation_stats(model, hedge, metrics, metrics_path, budget)
 
 @app.command()
 def merge(
     solutions_path: Path,
     test_cases_path: Path,
-    output_path: str      
+    output_path: str,
+    outer: bool = False,
+    run_size: int = 100_000,
+    tmp_dir: str = "",
+    unmatched_path: str = "",
+    ids: str = "",
 ):
-    solutions = read_jsonl(solutions_path)
-    tests = read_jsonl(test_cases_path)
-    merged_data = merge_dicts(tests, solutions)
-    write_jsonl(merged_data, output_path)
-    
+    """
+    Join the solutions and the tests on exercise_id, the output is sorted by id. --outer keeps the exercises found on one side only.
+    --ids (comma separated, or a file with one id per line) merges only these exercises, read through the offset index of both files.
+    """
+    stats = merge_files(test_cases_path, solutions_path, output_path, outer, run_size, tmp_dir or None, parse_ids(ids) if ids else None)
+    print(f"tests: {stats.left}, solutions: {stats.right}, merged: {stats.merged}, written: {stats.written}")
+    print(f"unmatched tests: {len(stats.unmatched_left)}, unmatched solutions: {len(stats.unmatched_right)}")
+    if stats.spilled_runs:
+        print(f"external sort: {stats.spilled_runs} runs spilled to disk")
+    if unmatched_path:
+        with open(unmatched_path, "w") as file:
+            json.dump({"tests": stats.unmatched_left, "solutions": stats.unmatched_right}, file, indent=2)
+
 
 @app.command()
 def codet(
     data_path: Path,
-    output_path: str
+    output_path: str,
+    ids: str = "",
+    probe: int = 0,
+    mode: str = "tests",
+    adaptive_timeouts: bool = False,
+    timeout_factor: float = 10.0,
+    cpu_budget: float = 0.0,
+    profile_path: str = "",
+    sandbox_workers: int = 0,
+    memory_limit_mb: int = 0,
+    memory_budget_mb: int = 0,
+    job_overhead_mb: int = 0,
 ):
-    data = load_solutions_with_tests(data_path)
+    """
+    Keep the best solution of every exercise. `--mode tests` ranks the solutions by the generated assertions they pass,
+    `--mode clusters` runs them on the inputs of the assertions and keeps a solution of the largest cluster of identical outputs.
+    `--adaptive-timeouts` calibrates the time limit of each test case on the first candidates, `--cpu-budget` caps the
+    sandbox seconds spent per exercise. The resource usage of the sandbox runs is summarized at the end,
+    `--profile-path` exports the full report (slowest exercises, candidates and test cases).
+    `--memory-limit-mb` caps the memory of each sandbox, the sandboxes are then admitted against `--memory-budget-mb`
+    (80% of the host memory by default) so that `--sandbox-workers` can exceed the number of cores. Every sandbox also
+    reserves `--job-overhead-mb` for its worker processes (estimated from the memory of this process when 0).
+    """
+    data = load_by_ids(data_path, parse_ids(ids)) if ids else load_solutions_with_tests(data_path)
     dataset = []
-    for item in data:
-        result = best_solution(item, 0.5, 5)
+    executions = Counter()
+    timeouts = make_timeout_policy(adaptive_timeouts, timeout_factor, cpu_budget)
+    profile = ExecutionProfile()
+    with make_scheduler(sandbox_workers, memory_limit_mb, memory_budget_mb, job_overhead_mb) as scheduler:
+        for item in data:
+            if mode == "clusters":
+                result = cluster_solutions(item, 0.5, 5, scheduler=scheduler)
+            else:
+                result = best_solution(item, 0.5, 5, probe=probe, timeouts=timeouts, scheduler=scheduler)
+            executions["rejected by the pre-screen"] += sum(1 for r in result if is_rejected(r))
+            executions["executed"] += sum(1 for r in result if not is_rejected(r))
+            executions[MEMORY_EXCEEDED] += sum(1 for r in result if exceeded_memory(r))
+            executions["test cases over the memory limit"] += sum(r.get('memory_exceeded') or 0 for r in result)
+            profile.add(item['exercise_id'], result)
+            best = most_agreed_solution(result) if mode == "clusters" else pass_most_solution(result)
+            if best is None:
+                print(f"exercise {item['exercise_id']} solutions failed all test cases")
+                continue
+            dataset.append({"exercise_id": best['task_id'], "problem": best['prompt'], "solution": best['completion']})
+
+    write_records(output_path, dataset, "codet")
+    print_counts(executions)
+    if scheduler.admission_waits:
+        print(f"sandboxes delayed by the memory budget: {scheduler.admission_waits}")
+    profile.print_summary()
+    if profile_path:
+        profile.export(profile_path)
+
+
+@app.command()
+def pipeline(
+    prompt_path: str,
+    output_path: str,
+    endpoint: str,
+    region: str = "us-west-2",
+    debug: bool = False,
+    debug_speed: int = 2,
+    retries: int = 5,
+    n_prompts: int = 0,
+    n_solutions: int = 10,
+    n_tests: int = 10,
+    near_dup_threshold: float = 0.0,
+    generation_workers: int = 2,
+    filter_workers: int = 1,
+    solution_workers: int = 8,
+    test_workers: int = 8,
+    syntax_workers: int = 1,
+    codet_workers: int = 16,
+    queue_size: int = 0,
+    probe: int = 0,
+    adaptive_timeouts: bool = False,
+    timeout_factor: float = 10.0,
+    cpu_budget: float = 0.0,
+    sandbox_workers: int = 0,
+    memory_limit_mb: int = 0,
+    memory_budget_mb: int = 0,
+    job_overhead_mb: int = 0,
+    rejected_path: str = "",
+    hedge_percentile: float = 0.0,
+    hedge_budget: float = 0.05,
+    metrics_path: str = "",
+    cost_per_hour: float = 0.0,
+    adaptive_tokens: bool = False,
+):
+    """
+    Stream every prompt through exercise generation, exercise filtering and dedup, solution and test sampling,
+    syntax filtering of the samples and CodeT selection, without writing the intermediate datasets.
+    Each stage has its own workers and a bounded input queue (`--queue-size`, 2 * workers when 0). The solutions
+    (`--solution-workers` exercises at a time) and the tests (`--test-workers` pool) of an exercise are sampled concurrently,
+    the CodeT stage awaits `run_candidates` on an event loop with `--codet-workers` exercises in flight on the shared sandboxes.
+    The sandboxes and timeouts take the options of `codet` (`--sandbox-workers`, `--memory-limit-mb`, `--memory-budget-mb`,
+    `--job-overhead-mb`, `--adaptive-timeouts`, `--timeout-factor`, `--cpu-budget`).
+    The throughput of every stage and the end-to-end latency of the exercises are printed at the end.
+    """
+    hedge = make_hedge_policy(hedge_percentile, hedge_budget)
+    metrics = MetricsRecorder(cost_per_hour=cost_per_hour)
+    budget = TokenBudget() if adaptive_tokens else None
+    get_generator, model = make_get_generator(endpoint, region, debug, debug_speed, hedge, observers=[metrics], budget=budget)
+    rejections = Rejections(rejected_path or None)
+    lsh = MinHashLSH(near_dup_threshold) if near_dup_threshold > 0 else None
+    seen = set()
+    counts = Counter()
+    profile = ExecutionProfile()
+    timeouts = make_timeout_policy(adaptive_timeouts, timeout_factor, cpu_budget)
+    scheduler = make_scheduler(sandbox_workers, memory_limit_mb, memory_budget_mb, job_overhead_mb)
+    lock = threading.Lock()
+
+    def no_progress():
+        pass
+
+    def generate_exercises(prompt):
+        exercises = [e for e in generation(prompt, get_generator(), no_progress, retries, metrics) if e.exercise_id]
+        metrics.record_accepted("exercise", len(exercises))
+        return exercises
+
+    def filter_exercise(exercise):
+        local_rejections = Rejections()
+        clean_exos = filter_bad_exos([exercise], rejections=local_rejections)
+        remove_extra(clean_exos)
+        signature = lsh.hasher.signature(exercise.problem) if lsh is not None and clean_exos else None
+        with lock:
+            rejections.merge(local_rejections)
+            if not clean_exos:
+                return []
+            if exercise.exercise_id in seen:
+                counts["duplicate exercises"] += 1
+                return []
+            seen.add(exercise.exercise_id)
+            if lsh is not None and lsh.add(signature) is not None:
+                counts["near duplicate exercises"] += 1
+                return []
+        return clean_exos
+
+    def sample(exercise):
+        # the tests only need the exercise, they are sampled on their own pool while the solutions are
+        tests_future = test_pool.submit(tests_generation, exercise, n_tests, get_generator(), no_progress, retries, metrics)
+        solutions = solutions_generation(exercise, n_solutions, get_generator(), no_progress, retries, metrics)
+        tests = tests_future.result()
+        # failed generations are returned as lists
+        if isinstance(solutions, ExerciseSolutions):
+            metrics.record_accepted("solution", len(solutions.solutions))
+        if isinstance(tests, ExerciseTests):
+            metrics.record_accepted("test", len(tests.tests))
+        if not isinstance(solutions, ExerciseSolutions) or not isinstance(tests, ExerciseTests):
+            return []
+        return [(solutions, tests)]
+
+    def filter_samples_syntax(item):
+        solutions, tests = item
+        local_rejections = Rejections()
+        good_solutions = filter_samples(solutions.exercise_id, solutions.problem, solutions.solutions, near_dup_threshold, local_rejections)
+        good_tests = filter_samples(tests.exercise_id, tests.problem, tests.tests, near_dup_threshold, local_rejections)
+        with lock:
+            rejections.merge(local_rejections)
+        if not good_solutions or not good_tests:
+            return []
+        return [{"exercise_id": solutions.exercise_id, "problem": solutions.problem, "solutions": good_solutions, "tests": good_tests}]
+
+    async def select_solution(record):
+        result = await run_candidates(record, scheduler, 0.5, 5, probe=probe, timeouts=timeouts)
         best = pass_most_solution(result)
+        with lock:
+            profile.add(record['exercise_id'], result)
+            counts["rejected by the pre-screen"] += sum(1 for r in result if is_rejected(r))
+            counts["executed"] += sum(1 for r in result if not is_rejected(r))
+            counts[MEMORY_EXCEEDED] += sum(1 for r in result if exceeded_memory(r))
+            counts["solutions failed all test cases"] += best is None
         if best is None:
-            print(f"exercise {item['exercise_id']} solutions failed all test cases")
-            continue
-        dataset.append({"exercise_id": best['task_id'], "problem": best['prompt'], "solution": best['completion']})
+            return []
+        return [{"exercise_id": best['task_id'], "problem": best['prompt'], "solution": best['completion']}]
 
-    with open(output_path, 'w') as file:
-        for item in dataset:
-            file.write(json.dumps(item) + '\n')
+    stages = Pipeline([
+        Stage("exercises", generate_exercises, generation_workers, queue_size),
+        Stage("filter", filter_exercise, filter_workers, queue_size),
+        Stage("samples", sample, solution_workers, queue_size),
+        Stage("syntax", filter_samples_syntax, syntax_workers, queue_size),
+        Stage("codet", select_solution, codet_workers, queue_size),
+    ])
+    with scheduler, ThreadPoolExecutor(max_workers=test_workers) as test_pool:
+        written = write_records(output_path, stages.run(unique_queries(prompt_path, n_prompts)), "codet")
+    rejections.close()
+    print(f"written: {written}")
+    stages.print_stats()
+    print_counts(counts)
+    print_counts(rejections.counts)
+    if scheduler.admission_waits:
+        print(f"sandboxes delayed by the memory budget: {scheduler.admission_waits}")
+    profile.print_summary()
+    print_generation_stats(model, hedge, metrics, metrics_path, budget)
 
 
 if __name__ == "__main__":
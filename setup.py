@@ -14,5 +14,9 @@ setup(
         "openai==0.27.10"
         
     ],
+    extras_require={
+        "parquet": ["pyarrow>=14,<17"],
+        "zstd": ["zstandard"],
+    },
     packages=find_packages()
 )
\ No newline at end of file
@@ -1,10 +1,17 @@
+import argparse
 
 from codeT.execution import best_solution, pass_most_solution
 from dataset_gen.filtering import load_solutions_with_tests
+from dataset_gen.jsonl_index import load_by_ids, parse_ids
 
 
-# data = load_solutions_with_tests('/home/ec2-user/SyntheticCodes/data/40B_temp1_50k_v1/dataset_exercise_40B_temp1_50k_solutions_withtests_v1.jsonl')
-data = load_solutions_with_tests('/home/ec2-user/SyntheticCodes/test2.jsonl')
+parser = argparse.ArgumentParser()
+# parser.add_argument('data_path', nargs='?', default='/home/ec2-user/SyntheticCodes/data/40B_temp1_50k_v1/dataset_exercise_40B_temp1_50k_solutions_withtests_v1.jsonl')
+parser.add_argument('data_path', nargs='?', default='/home/ec2-user/SyntheticCodes/test2.jsonl')
+parser.add_argument('--ids', default='', help='comma separated exercise ids, or a file with one id per line')
+args = parser.parse_args()
+
+data = load_by_ids(args.data_path, parse_ids(args.ids)) if args.ids else load_solutions_with_tests(args.data_path)
 dataset = []
 for item in data:
     result = best_solution(item, 1, 5, True)
@@ -0,0 +1,69 @@
+import botocore.exceptions
+import pytest
+
+from falcon.TextGenerationInference import BalancedTGI, HedgePolicy, is_endpoint_failure
+
+
+def client_error(code, status, original_status=None):
+    response = {"Error": {"Code": code, "Message": code}, "ResponseMetadata": {"HTTPStatusCode": status}}
+    if original_status is not None:
+        response["OriginalStatusCode"] = original_status
+    return botocore.exceptions.ClientError(response, "InvokeEndpoint")
+
+
+class StubClient:
+    def __init__(self, error=None):
+        self.error = error
+        self.calls = 0
+
+    def sm_query(self, payload):
+        self.calls += 1
+        if self.error is not None:
+            raise self.error
+        return [{"generated_text": "ok"}]
+
+
+def balanced(first_error):
+    model = BalancedTGI([("a", "us-west-2", 1.0), ("b", "us-west-2", 1.0)], max_failures=1)
+    model._endpoints[0].client = StubClient(first_error)
+    model._endpoints[1].client = StubClient()
+    return model
+
+
+def test_validation_error_is_raised_without_failover():
+    model = balanced(client_error("ValidationError", 400))
+    with pytest.raises(botocore.exceptions.ClientError):
+        model._invoke({})
+    assert model._endpoints[1].client.calls == 0
+    assert model.stats()["a@us-west-2"]["errors"] == 0
+    assert not model.stats()["a@us-west-2"]["ejected"]
+
+
+@pytest.mark.parametrize("error", [
+    client_error("ThrottlingException", 400),
+    client_error("ModelError", 424, original_status=503),
+    client_error("InternalFailure", 500),
+    botocore.exceptions.EndpointConnectionError(endpoint_url="https://runtime.sagemaker"),
+])
+def test_endpoint_failure_fails_over(error):
+    model = balanced(error)
+    _, endpoint, retries = model._invoke({})
+    assert (endpoint, retries) == ("b@us-west-2", 1)
+    assert model.stats()["a@us-west-2"]["ejected"]
+
+
+def test_model_validation_error_is_not_an_endpoint_failure():
+    assert not is_endpoint_failure(client_error("ModelError", 424, original_status=422))
+    assert not is_endpoint_failure(ValueError("bad payload"))
+
+
+@pytest.mark.parametrize("percentile", [0, 100, 150])
+def test_hedge_percentile_is_validated(percentile):
+    with pytest.raises(ValueError, match="percentile"):
+        HedgePolicy(percentile=percentile)
+
+
+def test_hedge_budget_is_validated():
+    with pytest.raises(ValueError, match="budget"):
+        HedgePolicy(budget=-0.1)
+
@@ -0,0 +1,113 @@
+import asyncio
+import time
+
+import pytest
+
+from codeT._execution import MEMORY_EXCEEDED, check_correctness_with_test_cases, exceeded_memory, run_calls_with_outputs
+from codeT.execution import best_solution, pass_most_solution, run_candidates
+from codeT.prescreen import is_rejected
+from codeT.profiling import ExecutionProfile
+from codeT.scheduler import SandboxScheduler
+
+PROBLEM = 'def make(n):\n    """List of n zeros"""\n'
+MEMORY_LIMIT = 200 * 2**20
+
+
+def test_memory_error_fails_only_its_test_case():
+    test_cases = ["assert make(2) == [0, 0]", "assert len(make(10**9)) == 10**9", "assert make(0) == []"]
+    result = check_correctness_with_test_cases("t", PROBLEM, "    return [0] * n\n", test_cases, 2, memory_limit=MEMORY_LIMIT)
+    assert result["result"] == [True, False, True]
+    assert len(result["durations"]) == 3
+    assert result["memory_exceeded"] == 1
+    assert exceeded_memory(result)
+
+
+def test_memory_error_output_signature():
+    result = run_calls_with_outputs("t", PROBLEM, "    return [0] * n\n", ["make(2)", "make(10**9)"], 2, memory_limit=MEMORY_LIMIT)
+    assert result["result"][1] == "error: MemoryError"
+    assert result["memory_exceeded"] == 1
+
+
+def test_profile_counts_memory_failures():
+    test_cases = ["assert make(2) == [0, 0]", "assert len(make(10**9)) == 10**9"]
+    results = [
+        check_correctness_with_test_cases("t", PROBLEM, completion, test_cases, 2, memory_limit=MEMORY_LIMIT)
+        for completion in ["    return [0] * n\n", "    return [0] * min(n, 2)\n"]
+    ]
+    profile = ExecutionProfile()
+    profile.add("t", results)
+    assert profile.report()["memory_exceeded"] == 1
+
+
+def test_memory_error_outside_test_cases():
+    completion = "    return [0] * n\nzeros = [0] * 10**9\n"
+    result = check_correctness_with_test_cases("t", PROBLEM, completion, ["assert make(2) == [0, 0]"], 2, memory_limit=MEMORY_LIMIT)
+    assert result["result"] == MEMORY_EXCEEDED
+
+
+def test_crash_is_not_a_memory_failure():
+    completion = "    import ctypes\n    return ctypes.string_at(0)\n"
+    result = check_correctness_with_test_cases("t", PROBLEM, completion, ["assert make(2) == [0, 0]"], 2, memory_limit=MEMORY_LIMIT)
+    assert result["result"] == "failed: SIGSEGV"
+
+
+def test_scheduler_reserves_the_job_overhead():
+    # 150 bytes per job: the third job waits for one of the first two to complete
+    with SandboxScheduler(workers=4, memory_budget=300, memory_limit=100, job_overhead=50) as scheduler:
+        futures = [scheduler.submit(time.sleep, 0.3) for _ in range(3)]
+        for future in futures:
+            future.result()
+    assert scheduler.admission_waits == 1
+    assert scheduler._available == 300
+
+
+def test_budget_needs_a_limit():
+    with pytest.raises(ValueError):
+        SandboxScheduler(memory_budget=100)
+
+
+EXERCISES = [
+    {
+        "exercise_id": f"add{k}",
+        "problem": f'def add{k}(a, b):\n    """Add two numbers"""\n',
+        "solutions": ["    return a + b\n", "    return a - b\n", "    return b + a\n", "    pass\n"],
+        "tests": [f"assert add{k}(1, 2) == 3\nassert add{k}(0, 0) == 0\n", f"assert add{k}(2, 2) == 4\n"],
+    }
+    for k in range(3)
+]
+
+
+def test_run_candidates_on_a_shared_scheduler():
+    async def run_all(scheduler):
+        return await asyncio.gather(*(run_candidates(exercise, scheduler, probe=2) for exercise in EXERCISES))
+
+    # room for two sandboxes at a time
+    with SandboxScheduler(workers=4, memory_budget=2 * MEMORY_LIMIT, memory_limit=MEMORY_LIMIT, job_overhead=0) as scheduler:
+        results = asyncio.run(run_all(scheduler))
+    assert scheduler.admission_waits > 0
+    assert scheduler._available == 2 * MEMORY_LIMIT
+    for exercise, result in zip(EXERCISES, results):
+        assert len(result) == len(exercise["solutions"])
+        assert sum(is_rejected(r) for r in result) == 1
+        expected = best_solution(exercise, 0.5, 5, probe=2)
+        assert pass_most_solution(result)["completion"] == pass_most_solution(expected)["completion"] == "    return a + b\n"
+
+
+def test_cancelled_run_does_not_hold_the_budget():
+    async def main(scheduler):
+        first = asyncio.ensure_future(scheduler.run(time.sleep, 0.5))
+        await asyncio.sleep(0.1)
+        waiting = asyncio.ensure_future(scheduler.run(time.sleep, 0.5))
+        await asyncio.sleep(0.1)
+        waiting.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await waiting
+        await first
+
+    with SandboxScheduler(workers=2, memory_budget=100, memory_limit=100, job_overhead=0) as scheduler:
+        start = time.monotonic()
+        asyncio.run(main(scheduler))
+        # the withdrawn job never ran after the first one
+        assert time.monotonic() - start < 0.9
+    assert scheduler.admission_waits == 1
+    assert scheduler._available == 100
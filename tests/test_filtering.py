@@ -0,0 +1,20 @@
+import pytest
+
+from dataset_gen.dataset_gen import Exercise, get_function_name
+from dataset_gen.filtering import Rejections, filter_bad_exos
+
+
+@pytest.mark.parametrize("name", ["default_value", "undefined_check", "redefine", "add"])
+def test_get_function_name(name):
+    assert get_function_name(f'def {name}(x):\n    """Return the definition of x"""') == name
+
+
+def test_filter_bad_exos_entry_point():
+    exos = [
+        Exercise(exercise_id=name, problem=f'def {name}(x):\n    """Docstring"""', solution="\n    return x\n")
+        for name in ["default_value", "undefined_check", "redefine"]
+    ]
+    exos.append(Exercise(exercise_id="none", problem='x = 1\n"""Docstring"""', solution="\nprint(x)\n"))
+    rejections = Rejections()
+    assert [e.exercise_id for e in filter_bad_exos(exos, rejections=rejections)] == ["default_value", "undefined_check", "redefine"]
+    assert rejections.counts == {"no entry point": 1}
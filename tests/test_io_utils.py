@@ -0,0 +1,22 @@
+import json
+
+import pytest
+
+from codeT.io_utils import Tools, open_file
+from dataset_gen.compression import open_file as open_dataset_file
+
+
+@pytest.mark.parametrize("extension", [".jsonl", ".jsonl.gz", ".jsonl.zst"])
+def test_reads_framed_datasets(tmp_path, extension):
+    if extension == ".jsonl.zst":
+        pytest.importorskip("zstandard")
+    path = str(tmp_path / f"tasks{extension}")
+    with open_dataset_file(path, "w", frame_size=64) as f:
+        for i in range(20):
+            f.write(json.dumps({"task_id": i}) + "\n")
+    assert [task["task_id"] for task in Tools.load_jsonl(path)] == list(range(20))
+
+
+def test_compressed_files_are_read_only(tmp_path):
+    with pytest.raises(ValueError):
+        open_file(tmp_path / "tasks.jsonl.gz", "w")
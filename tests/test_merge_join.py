@@ -0,0 +1,43 @@
+import json
+
+import pytest
+
+from dataset_gen.columnar import iter_records, write_records
+from dataset_gen.merge_join import merge_files
+
+TESTS = [
+    {"exercise_id": "b", "problem": "def b():", "tests": ["b() == 1"]},
+    {"exercise_id": "a", "problem": "def a():", "tests": ["a() == 0"]},
+    {"exercise_id": "c", "problem": "def c():", "tests": ["c() == 2"]},
+]
+SOLUTIONS = [
+    {"exercise_id": "c", "problem": "def c():", "solutions": ["return 2"]},
+    {"exercise_id": "a", "problem": "def a():", "solutions": ["return 0"]},
+]
+
+
+def merge(tmp_path, suffix, output_suffix=".jsonl", run_size=1):
+    tests_path, solutions_path = str(tmp_path / f"tests{suffix}"), str(tmp_path / f"solutions{suffix}")
+    write_records(tests_path, TESTS, "tests")
+    write_records(solutions_path, SOLUTIONS, "solutions")
+    output_path = str(tmp_path / f"merged{output_suffix}")
+    stats = merge_files(tests_path, solutions_path, output_path, run_size=run_size, tmp_dir=str(tmp_path))
+    return stats, list(iter_records(output_path))
+
+
+def test_merge_jsonl(tmp_path):
+    stats, records = merge(tmp_path, ".jsonl")
+    assert [r["exercise_id"] for r in records] == ["a", "c"]
+    assert records[0] == {"exercise_id": "a", "problem": "def a():", "tests": ["a() == 0"], "solutions": ["return 0"]}
+    assert stats.unmatched_left == ["b"]
+    assert stats.spilled_runs > 0
+
+
+@pytest.mark.parametrize("suffix", [".parquet", ".jsonl.gz"])
+def test_merge_other_formats(tmp_path, suffix):
+    if suffix == ".parquet":
+        pytest.importorskip("pyarrow")
+    (tmp_path / "jsonl").mkdir()
+    _, expected = merge(tmp_path / "jsonl", ".jsonl")
+    _, records = merge(tmp_path, suffix, output_suffix=suffix)
+    assert records == expected
@@ -0,0 +1,120 @@
+import asyncio
+import json
+import os
+
+import pytest
+from typer.testing import CliRunner
+
+from dataset_gen.pipeline import Pipeline, Stage
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def stub_stages(queue_size=2):
+    def exercises(prompt):
+        return [f"{prompt}-{i}" for i in range(3)]
+
+    def filter_exercise(exercise):
+        if exercise.endswith("-2"):
+            return []
+        return [exercise]
+
+    def samples(exercise):
+        if exercise == "p3-0":
+            raise ValueError("generation failed")
+        return [(exercise, ["solution"], ["test"])]
+
+    def syntax(item):
+        exercise, solutions, tests = item
+        return [{"exercise_id": exercise, "solutions": solutions, "tests": tests}]
+
+    async def codet(record):
+        await asyncio.sleep(0.01)
+        return [dict(record, solution=record["solutions"][0])]
+
+    def output(record):
+        return [record["exercise_id"]]
+
+    return [
+        Stage("exercises", exercises, 2, queue_size),
+        Stage("filter", filter_exercise, 1, queue_size),
+        Stage("samples", samples, 3, queue_size),
+        Stage("syntax", syntax, 1, queue_size),
+        Stage("codet", codet, 4, queue_size),
+        Stage("output", output, 2, queue_size),
+    ]
+
+
+def test_pipeline_runs_every_stage():
+    pipeline = Pipeline(stub_stages())
+    outputs = list(pipeline.run(f"p{i}" for i in range(5)))
+    assert sorted(outputs) == sorted(f"p{i}-{j}" for i in range(5) for j in range(2) if (i, j) != (3, 0))
+    stats = {s.name: s for s in pipeline.stats}
+    assert (stats["exercises"].received, stats["exercises"].emitted) == (5, 15)
+    assert (stats["filter"].received, stats["filter"].emitted) == (15, 10)
+    assert (stats["samples"].emitted, stats["samples"].errors) == (9, 1)
+    assert stats["codet"].emitted == stats["output"].received == 9
+    assert all(s.max_queue <= s.queue_size for s in pipeline.stats)
+    assert len(pipeline.latencies) == 9
+
+
+def test_source_error_is_raised_after_draining():
+    def prompts():
+        yield "p0"
+        raise FileNotFoundError("prompts.jsonl")
+
+    pipeline = Pipeline(stub_stages())
+    outputs = []
+    with pytest.raises(FileNotFoundError):
+        for output in pipeline.run(prompts()):
+            outputs.append(output)
+    assert sorted(outputs) == ["p0-0", "p0-1"]
+
+
+def test_pipeline_command_debug(tmp_path, monkeypatch):
+    import generate
+
+    monkeypatch.chdir(ROOT)
+    runner = CliRunner()
+    prompts_path, output_path = str(tmp_path / "prompts.jsonl"), str(tmp_path / "codet.jsonl")
+    result = runner.invoke(generate.app, ["prompts", "--output-path", prompts_path])
+    assert result.exit_code == 0, result.output
+    result = runner.invoke(generate.app, [
+        "pipeline", prompts_path, output_path, "endpoint", "--debug", "--debug-speed", "0",
+        "--n-prompts", "2", "--n-solutions", "2", "--n-tests", "2",
+    ])
+    assert result.exit_code == 0, result.output
+    with open(output_path) as f:
+        records = [json.loads(line) for line in f]
+    # every debug exercise passes the filter and has a passing solution
+    assert len(records) == 2 * 10
+    assert all(r["solution"].strip() == "return 0" for r in records)
+
+
+def test_pipeline_command_sandbox_options(tmp_path, monkeypatch):
+    import generate
+
+    schedulers = []
+
+    def make_scheduler(*args):
+        schedulers.append(make_scheduler_of_codet(*args))
+        return schedulers[-1]
+
+    make_scheduler_of_codet = generate.make_scheduler
+    monkeypatch.setattr(generate, "make_scheduler", make_scheduler)
+    monkeypatch.chdir(ROOT)
+    runner = CliRunner()
+    prompts_path, output_path = str(tmp_path / "prompts.jsonl"), str(tmp_path / "codet.jsonl")
+    assert runner.invoke(generate.app, ["prompts", "--output-path", prompts_path]).exit_code == 0
+    result = runner.invoke(generate.app, [
+        "pipeline", prompts_path, output_path, "endpoint", "--debug", "--debug-speed", "0",
+        "--n-prompts", "1", "--n-solutions", "2", "--n-tests", "2",
+        "--sandbox-workers", "3", "--memory-limit-mb", "200", "--memory-budget-mb", "1000", "--job-overhead-mb", "50",
+        "--adaptive-timeouts", "--timeout-factor", "5", "--cpu-budget", "10",
+    ])
+    assert result.exit_code == 0, result.output
+    scheduler, = schedulers
+    assert scheduler._executor._max_workers == 3
+    assert (scheduler.memory_limit, scheduler.memory_budget, scheduler.job_overhead) == (200 * 2**20, 1000 * 2**20, 50 * 2**20)
+    with open(output_path) as f:
+        assert len(f.readlines()) == 10
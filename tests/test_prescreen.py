@@ -0,0 +1,30 @@
+from codeT.execution import best_solution, pass_most_solution
+from codeT.prescreen import is_rejected, prescreen
+
+PROMPT = 'def f(x):\n    """Add one"""\n'
+
+
+def test_prescreen_rejections():
+    assert prescreen(PROMPT, "   \n", "f") == "empty completion"
+    assert prescreen(PROMPT, "    return (\n", "f").startswith("syntax error")
+    assert prescreen(PROMPT, "    pass\n", "f") == "trivial body"
+    assert prescreen(PROMPT, "    raise NotImplementedError()\n", "f") == "trivial body"
+    assert prescreen("", "def g(x):\n    return x + 1\n", "f") == "entry point f not defined"
+    assert prescreen(PROMPT, "    return x + 1\n", "f") is None
+
+
+def test_prescreen_checks_the_definition_exec_binds():
+    assert prescreen(PROMPT, "def f(x):\n    return x + 1\n", "f") is None
+    assert prescreen(PROMPT, "    return x + 1\n\ndef f(x):\n    pass\n", "f") == "trivial body"
+
+
+def test_restated_function_is_executed():
+    exercise = {
+        "exercise_id": "sq",
+        "problem": 'def sq(x):\n    """Square of x"""\n',
+        "solutions": ["def sq(x):\n    return x * x\n", "    return x + x\n"],
+        "tests": ["assert sq(3) == 9\nassert sq(1) == 1\n"],
+    }
+    results = best_solution(exercise, 0.5, 5)
+    assert not any(is_rejected(r) for r in results)
+    assert pass_most_solution(results)["completion"] == "def sq(x):\n    return x * x\n"
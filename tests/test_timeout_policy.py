@@ -0,0 +1,44 @@
+import pytest
+
+from codeT.execution import TimeoutPolicy
+
+
+def run(result, durations):
+    return {"result": result, "durations": durations}
+
+
+def test_calibrate_uses_the_passing_runs():
+    policy = TimeoutPolicy(factor=10.0, floor=0.05, ceiling=0.5)
+    results = [
+        run([True, True, True], [0.001, 0.02, 0.01]),
+        run([True, True, False], [0.002, 0.03, 0.001]),
+        run([True, False, True], [0.003, 0.001, 0.02]),
+    ]
+    # floor, median of the passing runs times the factor, capped by the ceiling
+    assert policy.calibrate(results, 3) == [0.05, 0.25, 0.15]
+
+
+def test_calibrate_keeps_the_ceiling_when_nothing_passes():
+    policy = TimeoutPolicy(ceiling=0.5)
+    # wrong answers failing fast must not cut the limit of a slower correct candidate
+    results = [run([False, True], [0.0001, 0.01]), run([False, True], [0.0002, 0.01])]
+    assert policy.calibrate(results, 2) == [0.5, 0.1]
+
+
+def test_calibrate_ignores_runs_without_durations():
+    policy = TimeoutPolicy(ceiling=0.5)
+    results = [
+        {"result": "timed out", "durations": None},
+        run([True], [0.6]),  # over the ceiling
+        run([True, True], [0.01, 0.01]),  # other test cases
+    ]
+    assert policy.calibrate(results, 1) == [0.5]
+
+
+def test_deadline():
+    assert TimeoutPolicy().deadline([0.1, 0.2], 4, 0.0) == pytest.approx(0.3)
+    policy = TimeoutPolicy(cpu_budget=1.0)
+    # what the calibration left of the budget is shared between the candidates
+    assert policy.deadline([0.1, 0.2], 4, 0.6) == pytest.approx(0.1)
+    assert policy.deadline([0.1, 0.2], 4, 2.0) == 0.0
+    assert policy.deadline([0.1, 0.2], 0, 0.6) == pytest.approx(0.3)
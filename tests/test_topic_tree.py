@@ -0,0 +1,68 @@
+import json
+import os
+
+import pytest
+
+from dataset_gen.create_prompts import MonkeyChat, Topic, build_tree, expand_topic, parse_subtopics
+
+
+class CountingChat(MonkeyChat):
+    def __init__(self, name="monkey"):
+        super().__init__()
+        self.name = name
+        self.calls = 0
+
+    def complete(self, query):
+        self.calls += 1
+        return super().complete(query)
+
+
+@pytest.fixture
+def topics_csv(tmp_path):
+    path = tmp_path / "topics.csv"
+    path.write_text("Topic,Use,Mixing,\n1. Loops,1,1,\n2. Strings,1,0,\n3. Classes,0,,\n")
+    return str(path)
+
+
+def test_expand_topic_reuses_the_cache(tmp_path):
+    topic = Topic(topic="Loops", mixing=1)
+    backend = CountingChat()
+    subtopics = expand_topic(topic, 3, backend, cache_dir=str(tmp_path))
+    assert [t.topic for t in subtopics] == ["Loops 0", "Loops 1", "Loops 2"]
+    assert all(t.parent == topic for t in subtopics)
+
+    assert expand_topic(topic, 3, backend, cache_dir=str(tmp_path)) == subtopics
+    assert backend.calls == 1
+
+
+def test_cache_is_keyed_by_backend(tmp_path):
+    topic = Topic(topic="Loops", mixing=1)
+    expand_topic(topic, 3, CountingChat(), cache_dir=str(tmp_path))
+    other = CountingChat(name="openai/gpt-4")
+    expand_topic(topic, 3, other, cache_dir=str(tmp_path))
+    assert other.calls == 1
+
+
+def test_build_tree_rerun_is_served_by_the_cache(tmp_path, topics_csv):
+    output_dir, cache_dir = str(tmp_path / "tree"), str(tmp_path / "cache")
+    backend = CountingChat()
+    leaves = build_tree(topics_csv, output_dir, backend, cache_dir=cache_dir, n_subtopics=2, n_subsubtopics=3, requests_per_second=0)
+    # 2 used base topics, 2 subtopics each, 3 sub-subtopics per subtopic
+    assert len(leaves) == 12
+    assert backend.calls == 2 + 4
+    with open(os.path.join(output_dir, "subsubtopics.json")) as f:
+        assert [t["topic"] for t in json.load(f)] == [t.topic for t in leaves]
+
+    rerun = CountingChat()
+    assert build_tree(topics_csv, output_dir, rerun, cache_dir=cache_dir, n_subtopics=2, n_subsubtopics=3, requests_per_second=0) == leaves
+    assert rerun.calls == 0
+
+
+def test_parse_subtopics():
+    assert parse_subtopics("Here you go:\n```python\n['Loops', \"While loops\"]\n```") == ["Loops", "While loops"]
+    with pytest.raises(ValueError):
+        parse_subtopics("no list here")
+    with pytest.raises(ValueError):
+        parse_subtopics("[__import__('os').system('ls')]")
+    with pytest.raises(ValueError):
+        parse_subtopics("[1, 2]")